@@ -1,7 +1,21 @@
+import datetime
+import functools
+import math
 import os
+import random
+import time
 from flask import Flask, render_template, request
 from flask import redirect, url_for, flash
+from flask import Response, stream_with_context
+from flask import g, jsonify, session, abort
 from models import *
+import export
+import rollups
+from snapshot import catalogue
+from auth import admin_auth, Busy, RateLimited, SessionTokens
+from instrumentation import RouteMetrics, SlowQueryLog
+from cache import LRUCache
+from versions import VERSIONED_MODELS, read_versions
 
 
 app = Flask(__name__)
@@ -13,27 +27,226 @@ app.config.update(dict(
     # DATABASE='devdatabase',
     # CHARSET='utf8',
     # HOST=os.getenv('DB_HOST', 'localhost'),
-    DEBUG=True
+    DEBUG=True,
+    # In debug mode requests issuing more queries than this get logged
+    QUERY_COUNT_LIMIT=20,
+    # Share of requests whose queries are profiled, debug mode
+    # profiles every request to fill the X-Query-* headers
+    PROFILE_SAMPLE_RATE=0.01,
+    # Queries slower than this many seconds are logged, None disables
+    SLOW_QUERY_SECONDS=0.5,
+    # Endpoints that never read from a replica
+    PRIMARY_ENDPOINTS=('update_publisher', 'bulk_edit'),
+    # Seconds a client reads from the primary after it wrote, so the
+    # page it is redirected to shows its change despite replication lag
+    READ_YOUR_WRITES_SECONDS=5,
+    # Seconds a rendered page is kept. Pages are keyed on the versions
+    # of their tables so a write is never hidden, this only bounds how
+    # long a page rendered from a lagging replica lives.
+    PAGE_CACHE_SECONDS=60,
+    # Admin pages need a login, off until an administrator exists, see
+    # "python auth.py create-admin"
+    ADMIN_LOGIN_REQUIRED=False,
+    # Seconds an admin stays logged in
+    ADMIN_SESSION_SECONDS=8 * 3600
 ))
 
+route_metrics = RouteMetrics()
+page_cache = LRUCache(max_size=1000, ttl=app.config['PAGE_CACHE_SECONDS'])
+admin_sessions = SessionTokens(app.config['SECRET_KEY'],
+                               max_age=app.config['ADMIN_SESSION_SECONDS'])
+
+
+def conditional(*models):
+    """Serve the GET requests of a view conditionally.
+
+    The response gets an ETag and Last-Modified from the versions of the
+    tables of models, see versions.py. A client that has the current
+    version gets a 304 without the view running, other clients get the
+    page from page_cache, which renders it at most once per version and
+    url.
+    """
+    unversioned = [model.__name__ for model in models
+                   if model not in VERSIONED_MODELS]
+    if unversioned:
+        raise ValueError("No table versions of %s"
+                         % ', '.join(unversioned))
+
+    def decorator(view):
+        @functools.wraps(view)
+        def conditional_view(*args, **kwargs):
+            # Flashed messages are part of the page and shown only once.
+            if request.method not in ('GET', 'HEAD') or \
+                    '_flashes' in session:
+                return view(*args, **kwargs)
+            # Read before the rows and from the same database, so a
+            # lagging replica gives its own, older version.
+            tag, modified = read_versions(models)
+            source = db.reading_from()
+            # Last-Modified has whole seconds, as the version. It is only
+            # given once its second is over, so no later write can share
+            # that second.
+            modified += 1
+            if modified > time.time():
+                modified = None
+            else:
+                modified = datetime.datetime.utcfromtimestamp(modified)
+            if request.if_none_match.contains(tag) or (
+                    not request.if_none_match and modified is not None and
+                    request.if_modified_since is not None and
+                    request.if_modified_since >= modified):
+                response = app.response_class(status=304)
+            else:
+                key = 'page:%s:%s' % (tag, request.full_path)
+                body = page_cache.get(key)
+                if body is None:
+                    response = app.make_response(view(*args, **kwargs))
+                    # Rows read elsewhere than the version, e.g. after a
+                    # replica failed, may be older than the tag says.
+                    if response.status_code != 200 or \
+                            response.is_streamed or \
+                            db.reading_from() is not source:
+                        return response
+                    page_cache.set(key, response.get_data())
+                else:
+                    response = app.response_class(body)
+            response.set_etag(tag)
+            response.last_modified = modified
+            # Revalidated on every view, which costs a 304 at most.
+            response.cache_control.no_cache = True
+            return response
+        return conditional_view
+    return decorator
+
+
+@app.before_first_request
+def register_query_hooks():
+    # Registered on first use so it lands on the database db points to
+    # by then, e.g. a SQLite file swapped in with db.initialize().
+    if app.config['SLOW_QUERY_SECONDS'] is not None:
+        db.add_query_hook(SlowQueryLog(app.config['SLOW_QUERY_SECONDS']))
 
 @app.before_request
 def before_request():
+    g.started = time.time()
+    if app.debug or random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        db.start_profile()
+    if request.endpoint in app.config['PRIMARY_ENDPOINTS'] or \
+            session.get('primary_until', 0) > time.time():
+        db.force_primary()
     db.connect()
+    # The signed token and the cached admin row, no query on a hit.
+    g.admin_id = admin_sessions.verify(session.get('admin'))
+    if app.config['ADMIN_LOGIN_REQUIRED'] and g.admin_id is None and \
+            request.path.startswith('/admin/') and \
+            request.endpoint not in ('login', 'logout'):
+        return redirect(url_for('login', next=request.path))
+
+def _header(value, length=200):
+    # Header values have to fit on one line of latin-1.
+    value = ' '.join(str(value).split())[:length]
+    return value.encode('latin-1', 'replace').decode('latin-1')
 
 @app.after_request
 def after_request(response):
-    db.close()
+    # Queries of streamed responses run later and are not counted.
+    profile = db.stop_profile()
+    if db.has_written():
+        session['primary_until'] = (time.time() +
+                                    app.config['READ_YOUR_WRITES_SECONDS'])
+    route_metrics.observe(request.endpoint or 'unmatched',
+                          time.time() - g.started, profile)
+    if app.debug and profile is not None:
+        response.headers['X-Query-Count'] = str(profile.queries)
+        response.headers['X-DB-Time'] = '%.2fms' % (1000 * profile.seconds)
+        response.headers['X-Rows'] = str(profile.rows)
+        if profile.slowest is not None:
+            seconds, sql, params = profile.slowest
+            response.headers['X-Slowest-Query'] = _header(
+                '%.2fms %s %r' % (1000 * seconds, sql, params))
+        if profile.queries > app.config['QUERY_COUNT_LIMIT']:
+            app.logger.warning("%s issued %d queries, the limit is %d",
+                               request.path, profile.queries,
+                               app.config['QUERY_COUNT_LIMIT'])
     return response
 
+@app.teardown_request
+def teardown_request(exception):
+    # Runs even when the view raised, so the connection always
+    # goes back to the pool and no profile leaks into the next request.
+    db.stop_profile()
+    if not db.is_closed():
+        db.close()
+
+def _local_url(url):
+    # Only redirect to pages of this site after a login. Browsers read
+    # /\evil.com as //evil.com and drop tabs and newlines.
+    if url and url.startswith('/') and url[1:2] not in ('/', '\\') and \
+            not any(ord(char) < 32 or ord(char) == 127 for char in url):
+        return url
+    return None
+
+@app.route('/admin/login', methods=['GET', 'POST'])
+def login():
+    next_url = _local_url(request.args.get('next'))
+    if request.method == 'POST':
+        try:
+            admin = admin_auth.authenticate(request.form.get('email', ''),
+                                            request.form.get('password', ''),
+                                            client=request.remote_addr)
+        except RateLimited as error:
+            flash("Too many failed logins, try again in %d seconds"
+                  % math.ceil(error.retry_after))
+            return render_template('login.html', next=next_url), 429
+        except Busy:
+            flash("Too many logins at once, try again shortly")
+            return render_template('login.html', next=next_url), 503
+        if admin is None:
+            flash("Unknown email or wrong password")
+            return render_template('login.html', next=next_url), 401
+        session['admin'] = admin_sessions.issue(admin.id)
+        return redirect(next_url or url_for('view_publishers'))
+    return render_template('login.html', next=next_url)
+
+@app.route('/admin/logout')
+def logout():
+    # The signed token stays valid until it is revoked, also when a copy
+    # of the cookie outlives the session.
+    if g.admin_id is not None:
+        admin_sessions.revoke(g.admin_id)
+    session.pop('admin', None)
+    return redirect(url_for('login'))
+
 @app.route('/admin/publisher')
+@conditional(Publisher)
 def view_publishers():
-    publishers = Publisher.select_all()
+    try:
+        publishers = Publisher.select_page(
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            page_size=request.args.get('per_page', 20, type=int),
+            sort=request.args.get('sort', 'id'))
+    except ValueError:
+        flash("Invalid page requested")
+        return redirect(url_for('view_publishers'))
     return render_template('admin_publisher.html',
                            publishers=publishers)
 
+@app.route('/admin/publisher/all')
+def view_all_publishers():
+    # Stream the page so the whole table is never held in memory,
+    # the rows are fetched in chunks while the template renders.
+    publishers = None
+    if Publisher.select_all() is not None:
+        publishers = Publisher.iterate_all()
+    context = dict(publishers=publishers)
+    app.update_template_context(context)
+    template = app.jinja_env.get_template('admin_publisher.html')
+    return Response(stream_with_context(template.stream(context)))
+
 @app.route('/admin/publisher/update/<int:publisher_id>',
            methods=['GET', 'POST'])
+@conditional(Publisher)
 def update_publisher(publisher_id):
     if request.method == 'POST':
         publisher = Publisher.update_selected(
@@ -52,7 +265,7 @@ def update_publisher(publisher_id):
                                    publisher_id=publisher_id)
     else:
         try:
-            publisher = Publisher.get(Publisher.id == publisher_id)
+            publisher = Publisher.get_cached(publisher_id)
         except Publisher.DoesNotExist:
             flash("Publisher %d does not exist" % publisher_id)
             return redirect(url_for('view_publishers'))
@@ -81,11 +294,113 @@ def delete_publisher(publisher_id):
     flash("Publisher %d does not exist" % publisher_id)
     return redirect(url_for('view_publishers'))
 
+@app.route('/admin/bulk', methods=['POST'])
+def bulk_edit():
+    # Body like {"publishers": [{"id": 1, "city": "Leiden"},
+    # {"id": 2, "delete": true}], "authors": [...]}, applied in one
+    # transaction so the batch pays for a single commit.
+    edits = request.get_json(silent=True)
+    if not isinstance(edits, dict):
+        return jsonify(error="Expected a JSON object"), 400
+    try:
+        results = apply_bulk_edits(edits)
+    except (KeyError, TypeError, ValueError) as error:
+        return jsonify(error="Invalid edit: %s" % error), 400
+    return jsonify(results)
+
+@app.route('/admin/export/<kind>.<fmt>')
+def export_table(kind, fmt):
+    # e.g. /admin/export/lends.csv, streamed in chunks from a server side
+    # cursor so memory stays flat however many rows there are.
+    if kind not in export.EXPORTS or fmt not in export.WRITERS:
+        abort(404)
+    return Response(stream_with_context(export.stream(kind, fmt)),
+                    mimetype=export.WRITERS[fmt].content_type,
+                    headers={'Content-Disposition':
+                             'attachment; filename=%s.%s' % (kind, fmt)})
+
+@app.route('/admin/lending')
+@conditional(Watermark, Book, Genre)
+def view_lending():
+    # Read from the rollups only, e.g. /admin/lending?month=2017-03, a
+    # month costs the same however many lends it had.
+    try:
+        month = datetime.datetime.strptime(
+            request.args.get('month') or
+            datetime.date.today().strftime('%Y-%m'), '%Y-%m').date()
+    except ValueError:
+        flash("Invalid month requested")
+        return redirect(url_for('view_lending'))
+    end = rollups.month_of(month + datetime.timedelta(days=31)) - \
+        datetime.timedelta(days=1)
+    days = rollups.series(month, end)
+    books = rollups.top('book', month, end)
+    genres = rollups.breakdown('genre', month)
+    titles = dict(Book.select(Book.id, Book.title)
+                  .where(Book.id << ([key for key, _ in books] or [0]))
+                  .tuples())
+    names = dict(Genre.select(Genre.id, Genre.genre)
+                 .where(Genre.id << ([row.key_id for row in genres] or [0]))
+                 .tuples())
+    return render_template('admin_lending.html', month=month,
+                           total=rollups.series(month, month,
+                                                period='month')[0],
+                           days=days, books=books, titles=titles,
+                           genres=genres, names=names,
+                           previous=(month - datetime.timedelta(days=1))
+                           .strftime('%Y-%m'),
+                           next=(end + datetime.timedelta(days=1))
+                           .strftime('%Y-%m'))
+
+@app.route('/catalogue')
+@conditional(Book, Author, Publisher, BookGenre, Genre)
+def view_catalogue():
+    try:
+        books = Book.catalogue_page(
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            page_size=request.args.get('per_page', 20, type=int),
+            sort=request.args.get('sort', 'id'))
+    except ValueError:
+        flash("Invalid page requested")
+        return redirect(url_for('view_catalogue'))
+    return render_template('catalogue.html', books=books)
+
+
+@app.route('/search')
+@conditional(Book, Author, BookGenre, Genre)
+def search_catalogue():
+    query = request.args.get('q', '')
+    books = Book.search(query,
+                        genre=request.args.get('genre') or None,
+                        language=request.args.get('language') or None,
+                        limit=max(1, min(request.args.get('limit', 20,
+                                                          type=int), 100)))
+    return render_template('search.html', query=query, books=books)
+
+
+@app.route('/metrics')
+def view_metrics():
+    # Prometheus text format, latency of every route and database time
+    # of the profiled requests.
+    return Response(route_metrics.render(),
+                    mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
     db.init(host=os.getenv('DB_HOST', 'localhost'),
             user='development',
             password='devpassword',
             database='devdatabase',
-            charset='utf8')
+            charset='utf8',
+            max_connections=int(os.getenv('DB_POOL_SIZE', 20)),
+            stale_timeout=int(os.getenv('DB_POOL_STALE_TIMEOUT', 300)),
+            timeout=int(os.getenv('DB_POOL_TIMEOUT', 10)))
+    # e.g. DB_REPLICAS="replica1,replica2", reads are spread over them
+    for host in filter(None, os.getenv('DB_REPLICAS', '').split(',')):
+        db.add_replica(host=host)
+    # Made by "python snapshot.py build", mapped once per worker
+    # and shared through the page cache.
+    if os.getenv('CATALOGUE_SNAPSHOT'):
+        catalogue.load(os.getenv('CATALOGUE_SNAPSHOT'))
     app.run()
@@ -0,0 +1,593 @@
+"""Async entry point serving the same routes and templates as app.py.
+
+peewee and PyMySQL block, and the asyncio MySQL drivers need a newer
+PyMySQL than requirements.txt pins. The views therefore hand their model
+calls to a thread pool exactly as large as the connection pool: the event
+loop keeps accepting requests while queries run, and a slow query only
+holds one of the pool's connections instead of the whole worker.
+
+The queries of one request share a routing session, see routing.py, on
+whichever pool threads they run: the request reads its own writes and
+sticks to one replica, as a request of app.py does.
+
+Run "python async_app.py" after installing requirements-async.txt.
+"""
+import asyncio
+import datetime
+import functools
+import math
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from itsdangerous import URLSafeSerializer, BadSignature
+from jinja2 import Environment, FileSystemLoader
+from models import *
+import export
+import rollups
+from snapshot import catalogue
+from auth import admin_auth, Busy, RateLimited, SessionTokens
+from instrumentation import QueryProfile, RouteMetrics, SlowQueryLog
+from cache import LRUCache
+from routing import RoutingSession
+from versions import VERSIONED_MODELS, read_versions
+
+SECRET_KEY = 'development key'
+FLASH_COOKIE = 'flashes'
+ADMIN_COOKIE = 'admin'
+PRIMARY_COOKIE = 'primary'
+# The settings of app.py, see there.
+PROFILE_SAMPLE_RATE = 0.01
+SLOW_QUERY_SECONDS = 0.5
+PRIMARY_ENDPOINTS = ('update_publisher', 'bulk_edit')
+READ_YOUR_WRITES_SECONDS = 5
+PAGE_CACHE_SECONDS = 60
+TEMPLATES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'templates')
+
+# Same settings as the flask environment so the templates render alike.
+jinja_env = Environment(loader=FileSystemLoader(TEMPLATES), autoescape=True,
+                        extensions=['jinja2.ext.autoescape',
+                                    'jinja2.ext.with_'])
+
+
+def _with_connection(session, profile, func, args):
+    # Runs in a pool thread, the connection goes back to the pool even
+    # when func raises.
+    with db.session(session):
+        if profile is not None:
+            db.start_profile(profile)
+        try:
+            db.connect()
+            return func(*args)
+        finally:
+            db.stop_profile()
+
+
+async def run_db(request, func, *args):
+    """Run func(*args) in the database thread pool and return its result.
+
+    The queries run in the routing session of the request.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        request.app['executor'], _with_connection, request['db_session'],
+        request['profile'], func, args)
+
+
+def _etag_matches(header, tag):
+    # e.g. If-None-Match: "a", W/"b", weak tags match as well.
+    tags = [value.strip() for value in header.split(',')]
+    return '*' in tags or any(
+        (value[2:] if value.startswith('W/') else value).strip('"') == tag
+        for value in tags)
+
+
+def conditional(*models):
+    """Serve the GET requests of a handler conditionally, as
+    app.conditional() does.
+
+    The rendered pages are kept in the page cache of the application.
+    """
+    unversioned = [model.__name__ for model in models
+                   if model not in VERSIONED_MODELS]
+    if unversioned:
+        raise ValueError("No table versions of %s"
+                         % ', '.join(unversioned))
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def conditional_handler(request):
+            # Flashed messages are part of the page and shown only once.
+            if request.method not in ('GET', 'HEAD') or request['flashes']:
+                return await handler(request)
+            # Read before the rows and from the same database, so a
+            # lagging replica gives its own, older version.
+            tag, modified = await run_db(request, read_versions, models)
+            session = request['db_session']
+            source = session.reading_from()
+            # Whole seconds, given once the second of the version is over.
+            modified += 1
+            if modified > time.time():
+                modified = None
+            else:
+                modified = datetime.datetime.fromtimestamp(
+                    modified, datetime.timezone.utc)
+            if_none_match = request.headers.get('If-None-Match')
+            if (if_none_match and _etag_matches(if_none_match, tag)) or (
+                    not if_none_match and modified is not None and
+                    request.if_modified_since is not None and
+                    request.if_modified_since >= modified):
+                response = web.Response(status=304)
+            else:
+                page_cache = request.app['page_cache']
+                key = 'page:%s:%s' % (tag, request.path_qs)
+                body = page_cache.get(key)
+                if body is None:
+                    response = await handler(request)
+                    # Rows read elsewhere than the version, e.g. after a
+                    # replica failed, may be older than the tag says.
+                    if response.status != 200 or \
+                            not isinstance(response, web.Response) or \
+                            session.reading_from() is not source:
+                        return response
+                    page_cache.set(key, response.body)
+                else:
+                    response = web.Response(body=body,
+                                            content_type='text/html')
+            response.headers['ETag'] = '"%s"' % tag
+            if modified is not None:
+                response.last_modified = modified
+            # Revalidated on every view, which costs a 304 at most.
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return conditional_handler
+    return decorator
+
+
+def url_for(request, endpoint, **values):
+    """Build the url of a named route like flask.url_for.
+
+    Values not used in the path are added as query arguments, None values
+    are left out.
+    """
+    resource = request.app.router[endpoint]
+    info = resource.get_info()
+    names = re.findall(r'{(\w+)}', info.get('formatter', ''))
+    parts = dict((name, str(values.pop(name))) for name in names)
+    query = dict((key, str(value)) for key, value in values.items()
+                 if value is not None)
+    url = resource.url_for(**parts)
+    return str(url.with_query(query) if query else url)
+
+
+def flash(request, message):
+    """Show message on the next rendered page, like flask.flash."""
+    request['flashes'].append(message)
+
+
+def redirect(request, endpoint, **values):
+    raise web.HTTPFound(url_for(request, endpoint, **values))
+
+
+def render_template(request, name, **context):
+    def get_flashed_messages():
+        messages, request['flashes'][:] = list(request['flashes']), []
+        return messages
+
+    context.update(url_for=lambda endpoint, **values: url_for(
+        request, endpoint, **values),
+        get_flashed_messages=get_flashed_messages)
+    return jinja_env.get_template(name).render(context)
+
+
+def html(body, status=200):
+    return web.Response(text=body, content_type='text/html', status=status)
+
+
+def _int_arg(request, name, default):
+    try:
+        return int(request.query.get(name, default))
+    except ValueError:
+        return default
+
+
+@web.middleware
+async def database_session(request, handler):
+    # One routing session per request, on the primary for the routes that
+    # never read stale rows and for a while after the client wrote.
+    started = time.time()
+    route = request.match_info.route.name
+    request['db_session'] = session = RoutingSession(
+        primary=route in PRIMARY_ENDPOINTS or
+        PRIMARY_COOKIE in request.cookies)
+    request['profile'] = QueryProfile() \
+        if random.random() < PROFILE_SAMPLE_RATE else None
+    try:
+        try:
+            response = await handler(request)
+        except web.HTTPException as exc:
+            response = exc
+            if response.status < 300 or response.status >= 400:
+                raise
+        if session.wrote:
+            # Expires on its own, so the client's clock does not matter.
+            response.set_cookie(PRIMARY_COOKIE, '1', httponly=True,
+                                max_age=READ_YOUR_WRITES_SECONDS)
+        if isinstance(response, web.HTTPException):
+            raise response
+        return response
+    finally:
+        request.app['metrics'].observe(route or 'unmatched',
+                                       time.time() - started,
+                                       request['profile'])
+
+
+@web.middleware
+async def flash_messages(request, handler):
+    # Messages survive a redirect in a signed cookie, just like flask
+    # keeps them in its session cookie.
+    serializer = request.app['serializer']
+    cookie = request.cookies.get(FLASH_COOKIE)
+    try:
+        request['flashes'] = serializer.loads(cookie) if cookie else []
+    except BadSignature:
+        request['flashes'] = []
+    try:
+        response = await handler(request)
+    except web.HTTPException as exc:
+        response = exc
+        if response.status < 300 or response.status >= 400:
+            raise
+    if request['flashes']:
+        response.set_cookie(FLASH_COOKIE,
+                            serializer.dumps(request['flashes']),
+                            httponly=True)
+    elif cookie:
+        response.del_cookie(FLASH_COOKIE)
+    if isinstance(response, web.HTTPException):
+        raise response
+    return response
+
+
+@web.middleware
+async def admin_login(request, handler):
+    # The signed token and the cached admin row, no query on a hit.
+    token = request.cookies.get(ADMIN_COOKIE)
+    request['admin_id'] = None
+    if token:
+        request['admin_id'] = await run_db(
+            request, request.app['sessions'].verify, token)
+    if request.app['login_required'] and request['admin_id'] is None and \
+            request.path.startswith('/admin/') and \
+            request.match_info.route.name not in ('login', 'logout'):
+        redirect(request, 'login', next=request.path)
+    return await handler(request)
+
+
+def _local_url(url):
+    # Only redirect to pages of this site after a login. Browsers read
+    # /\evil.com as //evil.com and drop tabs and newlines.
+    if url and url.startswith('/') and url[1:2] not in ('/', '\\') and \
+            not any(ord(char) < 32 or ord(char) == 127 for char in url):
+        return url
+    return None
+
+
+async def login(request):
+    next_url = _local_url(request.query.get('next'))
+    if request.method == 'POST':
+        form = await request.post()
+        try:
+            admin = await run_db(request, admin_auth.authenticate,
+                                 form.get('email', ''),
+                                 form.get('password', ''), request.remote)
+        except RateLimited as error:
+            flash(request, "Too many failed logins, try again in %d seconds"
+                  % math.ceil(error.retry_after))
+            return html(render_template(request, 'login.html',
+                                        next=next_url), 429)
+        except Busy:
+            flash(request, "Too many logins at once, try again shortly")
+            return html(render_template(request, 'login.html',
+                                        next=next_url), 503)
+        if admin is None:
+            flash(request, "Unknown email or wrong password")
+            return html(render_template(request, 'login.html',
+                                        next=next_url), 401)
+        sessions = request.app['sessions']
+        response = web.HTTPFound(next_url or
+                                 url_for(request, 'view_publishers'))
+        response.set_cookie(ADMIN_COOKIE, sessions.issue(admin.id),
+                            max_age=sessions.max_age, httponly=True)
+        raise response
+    return html(render_template(request, 'login.html', next=next_url))
+
+
+async def logout(request):
+    if request['admin_id'] is not None:
+        await run_db(request, request.app['sessions'].revoke,
+                     request['admin_id'])
+    response = web.HTTPFound(url_for(request, 'login'))
+    response.del_cookie(ADMIN_COOKIE)
+    raise response
+
+
+@conditional(Publisher)
+async def view_publishers(request):
+    try:
+        publishers = await run_db(
+            request, Publisher.select_page,
+            request.query.get('after'),
+            request.query.get('before'),
+            _int_arg(request, 'per_page', 20),
+            request.query.get('sort', 'id'))
+    except ValueError:
+        flash(request, "Invalid page requested")
+        redirect(request, 'view_publishers')
+    return html(render_template(request, 'admin_publisher.html',
+                                publishers=publishers))
+
+
+async def view_all_publishers(request):
+    # The template renders in a pool thread that holds one connection
+    # while the rows are fetched in chunks, each rendered chunk is
+    # written out from the event loop.
+    loop = asyncio.get_event_loop()
+    response = web.StreamResponse()
+    response.content_type = 'text/html'
+    await response.prepare(request)
+
+    def render():
+        publishers = None
+        if Publisher.select_all() is not None:
+            publishers = Publisher.iterate_all()
+        template = jinja_env.get_template('admin_publisher.html')
+        stream = template.stream(
+            publishers=publishers,
+            url_for=lambda endpoint, **values: url_for(request, endpoint,
+                                                       **values),
+            get_flashed_messages=lambda: [])
+        for chunk in stream:
+            asyncio.run_coroutine_threadsafe(
+                response.write(chunk.encode('utf-8')), loop).result()
+
+    await run_db(request, render)
+    await response.write_eof()
+    return response
+
+
+@conditional(Publisher)
+async def update_publisher(request):
+    publisher_id = int(request.match_info['publisher_id'])
+    if request.method == 'POST':
+        form = await request.post()
+        publisher = await run_db(request, Publisher.update_selected,
+                                 publisher_id, form.get('name', ''),
+                                 form.get('city', ''))
+        if publisher:
+            redirect(request, 'view_publishers')
+        elif publisher is None:
+            flash(request, "Publisher %d does not exist" % publisher_id)
+            redirect(request, 'view_publishers')
+        else:
+            flash(request, "Input should be less than 266 characters")
+            return html(render_template(request, 'update_publisher.html',
+                                        publisher_id=publisher_id))
+    else:
+        try:
+            await run_db(request, Publisher.get_cached, publisher_id)
+        except Publisher.DoesNotExist:
+            flash(request, "Publisher %d does not exist" % publisher_id)
+            redirect(request, 'view_publishers')
+        return html(render_template(request, 'update_publisher.html',
+                                    publisher_id=publisher_id))
+
+
+async def add_new_publisher(request):
+    if request.method == 'POST':
+        form = await request.post()
+        if form.get('name') and form.get('city'):
+            await run_db(request, Publisher.add_publisher, form['name'],
+                         form['city'])
+            redirect(request, 'view_publishers')
+        else:
+            flash(request, "Both fields are required")
+    return html(render_template(request, 'add_publisher.html'))
+
+
+async def delete_publisher(request):
+    publisher_id = int(request.match_info['publisher_id'])
+    if await run_db(request, Publisher.delete_selected, publisher_id):
+        flash(request, "Publisher %d has been deleted" % publisher_id)
+        redirect(request, 'view_publishers')
+
+    flash(request, "Publisher %d does not exist" % publisher_id)
+    redirect(request, 'view_publishers')
+
+
+async def bulk_edit(request):
+    try:
+        edits = await request.json()
+    except ValueError:
+        edits = None
+    if not isinstance(edits, dict):
+        return web.json_response(dict(error="Expected a JSON object"),
+                                 status=400)
+    try:
+        results = await run_db(request, apply_bulk_edits, edits)
+    except (KeyError, TypeError, ValueError) as error:
+        return web.json_response(dict(error="Invalid edit: %s" % error),
+                                 status=400)
+    return web.json_response(results)
+
+
+async def export_table(request):
+    # e.g. /admin/export/lends.csv, written out chunk by chunk from a pool
+    # thread reading a server side cursor, as view_all_publishers() does.
+    kind, fmt = request.match_info['kind'], request.match_info['fmt']
+    if kind not in export.EXPORTS or fmt not in export.WRITERS:
+        raise web.HTTPNotFound()
+    loop = asyncio.get_event_loop()
+    response = web.StreamResponse(headers={
+        'Content-Type': export.WRITERS[fmt].content_type,
+        'Content-Disposition': 'attachment; filename=%s.%s' % (kind, fmt)})
+    await response.prepare(request)
+
+    def write():
+        for chunk in export.stream(kind, fmt):
+            asyncio.run_coroutine_threadsafe(response.write(chunk),
+                                             loop).result()
+
+    await run_db(request, write)
+    await response.write_eof()
+    return response
+
+
+def _lending(month):
+    # The queries of app.view_lending() in one pool job.
+    end = rollups.month_of(month + datetime.timedelta(days=31)) - \
+        datetime.timedelta(days=1)
+    books = rollups.top('book', month, end)
+    genres = rollups.breakdown('genre', month)
+    return dict(
+        month=month,
+        total=rollups.series(month, month, period='month')[0],
+        days=rollups.series(month, end), books=books, genres=genres,
+        titles=dict(Book.select(Book.id, Book.title)
+                    .where(Book.id << ([key for key, _ in books] or [0]))
+                    .tuples()),
+        names=dict(Genre.select(Genre.id, Genre.genre)
+                   .where(Genre.id << ([row.key_id for row in genres] or
+                                       [0]))
+                   .tuples()),
+        previous=(month - datetime.timedelta(days=1)).strftime('%Y-%m'),
+        next=(end + datetime.timedelta(days=1)).strftime('%Y-%m'))
+
+
+@conditional(Watermark, Book, Genre)
+async def view_lending(request):
+    try:
+        month = datetime.datetime.strptime(
+            request.query.get('month') or
+            datetime.date.today().strftime('%Y-%m'), '%Y-%m').date()
+    except ValueError:
+        flash(request, "Invalid month requested")
+        redirect(request, 'view_lending')
+    context = await run_db(request, _lending, month)
+    return html(render_template(request, 'admin_lending.html', **context))
+
+
+@conditional(Book, Author, Publisher, BookGenre, Genre)
+async def view_catalogue(request):
+    try:
+        books = await run_db(
+            request, Book.catalogue_page,
+            request.query.get('after'),
+            request.query.get('before'),
+            _int_arg(request, 'per_page', 20),
+            request.query.get('sort', 'id'))
+    except ValueError:
+        flash(request, "Invalid page requested")
+        redirect(request, 'view_catalogue')
+    return html(render_template(request, 'catalogue.html', books=books))
+
+
+@conditional(Book, Author, BookGenre, Genre)
+async def search_catalogue(request):
+    query = request.query.get('q', '')
+    books = await run_db(request, Book.search, query,
+                         request.query.get('genre') or None,
+                         request.query.get('language') or None,
+                         max(1, min(_int_arg(request, 'limit', 20), 100)))
+    return html(render_template(request, 'search.html', query=query,
+                                books=books))
+
+
+async def view_metrics(request):
+    # Prometheus text format, as app.view_metrics().
+    return web.Response(text=request.app['metrics'].render(),
+                        headers={'Content-Type':
+                                 'text/plain; version=0.0.4'})
+
+
+async def add_slow_query_log(app):
+    if SLOW_QUERY_SECONDS is not None:
+        app['slow_query_log'] = SlowQueryLog(SLOW_QUERY_SECONDS)
+        db.add_query_hook(app['slow_query_log'])
+
+
+async def close_executor(app):
+    app['executor'].shutdown(wait=True)
+    if app.get('slow_query_log') is not None:
+        db.remove_query_hook(app['slow_query_log'])
+
+
+def create_app(workers=None, secret_key=SECRET_KEY, login_required=False):
+    """Return the aiohttp application.
+
+    workers - amount of threads running queries, defaults to the size
+        of the connection pool so a request never waits on the pool
+        while holding a thread
+    secret_key - signs the cookies that carry flashed messages and the
+        admin session
+    login_required - admin pages need a login, see auth.py
+    """
+    app = web.Application(middlewares=[database_session, flash_messages,
+                                       admin_login])
+    app['executor'] = ThreadPoolExecutor(
+        max_workers=workers or getattr(db, 'max_connections', 20))
+    app['serializer'] = URLSafeSerializer(secret_key, salt='flash')
+    app['sessions'] = SessionTokens(secret_key)
+    app['login_required'] = login_required
+    app['page_cache'] = LRUCache(max_size=1000, ttl=PAGE_CACHE_SECONDS)
+    app['metrics'] = RouteMetrics()
+    app.on_startup.append(add_slow_query_log)
+    app.on_cleanup.append(close_executor)
+    router = app.router
+    resource = router.add_resource('/admin/login', name='login')
+    resource.add_route('GET', login)
+    resource.add_route('POST', login)
+    router.add_get('/admin/logout', logout, name='logout')
+    router.add_get('/admin/publisher', view_publishers,
+                   name='view_publishers')
+    router.add_get('/admin/publisher/all', view_all_publishers,
+                   name='view_all_publishers')
+    for path, handler in [
+            (r'/admin/publisher/update/{publisher_id:\d+}',
+             update_publisher),
+            ('/admin/publisher/add', add_new_publisher)]:
+        resource = router.add_resource(path, name=handler.__name__)
+        resource.add_route('GET', handler)
+        resource.add_route('POST', handler)
+    router.add_get(r'/admin/publisher/delete/{publisher_id:\d+}',
+                   delete_publisher, name='delete_publisher')
+    router.add_post('/admin/bulk', bulk_edit, name='bulk_edit')
+    router.add_get(r'/admin/export/{kind:[^./]+}.{fmt:[^./]+}',
+                   export_table, name='export_table')
+    router.add_get('/admin/lending', view_lending, name='view_lending')
+    router.add_get('/catalogue', view_catalogue, name='view_catalogue')
+    router.add_get('/search', search_catalogue, name='search_catalogue')
+    router.add_get('/metrics', view_metrics, name='view_metrics')
+    return app
+
+
+if __name__ == '__main__':
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8',
+            max_connections=int(os.getenv('DB_POOL_SIZE', 20)),
+            stale_timeout=int(os.getenv('DB_POOL_STALE_TIMEOUT', 300)),
+            timeout=int(os.getenv('DB_POOL_TIMEOUT', 10)))
+    for host in filter(None, os.getenv('DB_REPLICAS', '').split(',')):
+        db.add_replica(host=host)
+    # Made by "python snapshot.py build", mapped once per worker
+    # and shared through the page cache.
+    if os.getenv('CATALOGUE_SNAPSHOT'):
+        catalogue.load(os.getenv('CATALOGUE_SNAPSHOT'))
+    web.run_app(create_app(), port=int(os.getenv('PORT', 8080)))
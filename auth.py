@@ -0,0 +1,360 @@
+"""Password hashing and login for customers and administrators.
+
+bcrypt at a safe cost takes a few hundred milliseconds of CPU, so hashes
+are computed in a pool of worker processes. The pool is bounded in
+processes and in queued jobs: a request thread waits for its job
+without holding the GIL, and when the queue is full a login fails fast
+with Busy instead of piling up behind the others.
+
+A login whose hash has another cost than the hasher's rounds is rehashed
+in the same pool job, so raising BCRYPT_ROUNDS only needs users to log
+in again.
+
+Failed logins are limited per email and per client. After a login the
+admin gets a signed session token, requests carrying it are trusted on
+its signature and the revocation time of the cached admin row, and never
+check the password again.
+
+Run "python auth.py create-admin --email admin@example.com" to add an
+administrator.
+"""
+import argparse
+import concurrent.futures
+import getpass
+import multiprocessing
+import os
+import threading
+import time
+
+import bcrypt
+from concurrent.futures.process import BrokenProcessPool
+from itsdangerous import URLSafeSerializer, BadSignature
+from models import *
+from cache import LRUCache, model_cache
+
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', 12))
+
+
+class Busy(Exception):
+    """Raised when the hashing queue stays full."""
+
+
+class RateLimited(Exception):
+    """Raised when a key used up its failed attempts.
+
+    retry_after - seconds until the key may try again
+    """
+
+    def __init__(self, key, retry_after):
+        super(RateLimited, self).__init__(
+            "Too many failed attempts for %s, retry in %d seconds"
+            % (key, retry_after))
+        self.key = key
+        self.retry_after = retry_after
+
+
+def _rounds(hashed):
+    # A bcrypt hash looks like $2b$12$<salt and hash>.
+    try:
+        return int(hashed.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def normalize_email(email):
+    """Return the email as logins store, look up and limit it."""
+    return email.strip().lower()
+
+
+def hash_password(password, rounds=BCRYPT_ROUNDS):
+    """Return the bcrypt hash of password, computed in this process.
+
+    raises - ValueError when the password contains a NUL character
+    """
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('ascii')
+
+
+def check_password(password, hashed, rounds=BCRYPT_ROUNDS):
+    """Check a password against its hash, computed in this process.
+
+    return - (True when it matches, the hash at rounds when it matches
+        but hashed has another cost, else None)
+    """
+    try:
+        matches = bcrypt.checkpw(password.encode('utf-8'),
+                                 hashed.encode('ascii'))
+    except ValueError:
+        # Not a bcrypt hash, or a NUL in the password.
+        return False, None
+    if matches and _rounds(hashed) != rounds:
+        return True, hash_password(password, rounds)
+    return matches, None
+
+
+class PasswordHasher(object):
+    """Runs bcrypt in a bounded pool of worker processes.
+
+    The processes start on first use, so every forked web worker gets
+    its own pool.
+
+    workers - amount of processes, defaults to the amount of CPUs
+    max_pending - jobs queued or running at once, defaults to four per
+        process
+    wait - seconds a job waits for room in the queue
+    rounds - cost of new hashes
+    """
+
+    def __init__(self, workers=None, max_pending=None, wait=1,
+                 rounds=BCRYPT_ROUNDS):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 4 * self.workers
+        self.wait = wait
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                if multiprocessing.current_process().daemon:
+                    # May not have children, e.g. in a multiprocessing
+                    # pool. bcrypt releases the GIL, so threads still
+                    # hash in parallel, only in this process.
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        self.workers)
+                else:
+                    self._executor = \
+                        concurrent.futures.ProcessPoolExecutor(self.workers)
+            return self._executor
+
+    def submit(self, func, *args):
+        """Queue func(*args) in the pool and return its future.
+
+        raises - Busy when the queue stays full for wait seconds
+        """
+        if not self._slots.acquire(timeout=self.wait):
+            raise Busy("%d password jobs are queued already"
+                       % self.max_pending)
+        try:
+            future = self._pool().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def _run(self, func, *args):
+        try:
+            return self.submit(func, *args).result()
+        except BrokenProcessPool:
+            # A worker died, e.g. killed for memory, start a new pool.
+            self.close()
+            raise
+
+    def hash(self, password):
+        """Return the bcrypt hash of password at rounds."""
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, password, hashed):
+        """Check a password, see check_password()."""
+        return self._run(check_password, password, hashed, self.rounds)
+
+    def close(self):
+        """Stop the processes, they start again on the next job."""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+class RateLimiter(object):
+    """Counts failed attempts per key in fixed windows.
+
+    Every attempt adds one to the counter of the current window in a
+    single step of the backend, so concurrent failures can not overwrite
+    each other's counts.
+
+    limit - failed attempts allowed per window
+    window - seconds
+    backend - LRUCache or MemcacheBackend, share one between processes
+        to count the attempts on all of them
+    """
+
+    def __init__(self, limit=5, window=300, backend=None):
+        self.limit = limit
+        self.window = window
+        self.backend = backend if backend is not None else \
+            LRUCache(max_size=100000, ttl=window)
+
+    def _key(self, key):
+        started = int(time.time() // self.window) * self.window
+        return 'attempts:%s:%d' % (key, started), started
+
+    def attempts(self, key):
+        """Return the failed attempts of key in the current window."""
+        return self.backend.get(self._key(key)[0]) or 0
+
+    def check(self, key):
+        """raises - RateLimited when key used up its attempts"""
+        counter, started = self._key(key)
+        if (self.backend.get(counter) or 0) >= self.limit:
+            raise RateLimited(key, started + self.window - time.time())
+
+    def failed(self, key):
+        self.backend.incr(self._key(key)[0], 1, self.window)
+
+    def reset(self, key):
+        self.backend.delete(self._key(key)[0])
+
+
+class SessionTokens(object):
+    """Signed tokens that stand in for a checked password.
+
+    A token holds a user id and the time it was issued. revoke() stores
+    its time on the user row, so it lasts as long as the tokens do and
+    reaches every process. verify() reads that time through the model
+    cache and needs no query while the row is cached, with a backend per
+    process other processes see a revocation once their cached row
+    expires.
+
+    secret_key - key signing the tokens
+    max_age - seconds a token stays valid
+    model - model of the users, with a sessions_revoked_at field
+    salt - keeps the tokens of different kinds of users apart
+    """
+
+    def __init__(self, secret_key, max_age=8 * 3600, model=Administrator,
+                 salt='admin-session'):
+        self.serializer = URLSafeSerializer(secret_key, salt=salt)
+        self.max_age = max_age
+        self.model = model
+
+    def issue(self, user_id):
+        return self.serializer.dumps([user_id, time.time()])
+
+    def verify(self, token):
+        """Return the user id of a token, None when it is invalid,
+        expired or revoked, or its user was deleted.
+        """
+        if not token:
+            return None
+        try:
+            user_id, issued = self.serializer.loads(token)
+        except (BadSignature, TypeError, ValueError):
+            return None
+        if issued + self.max_age < time.time():
+            return None
+        try:
+            user = model_cache.get(self.model, user_id)
+        except self.model.DoesNotExist:
+            return None
+        if issued <= user.sessions_revoked_at:
+            return None
+        return user_id
+
+    def revoke(self, user_id):
+        """Reject every token of the user issued until now, e.g. after
+        a password change.
+        """
+        self.model.update_by_id(user_id,
+                                dict(sessions_revoked_at=time.time()))
+
+
+class Authenticator(object):
+    """Login for a model with email and password fields.
+
+    model - Customer or Administrator
+    hasher - PasswordHasher, defaults to password_hasher
+    limiter - RateLimiter for failed logins
+    """
+
+    def __init__(self, model, hasher=None, limiter=None):
+        self.model = model
+        self.hasher = hasher
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self._dummy = None
+
+    @property
+    def _hasher(self):
+        return self.hasher if self.hasher is not None else password_hasher
+
+    def _dummy_hash(self):
+        # Checked for unknown emails, so they take as long to answer as
+        # known ones and do not give away who has an account.
+        if self._dummy is None or _rounds(self._dummy) != \
+                self._hasher.rounds:
+            self._dummy = self._hasher.hash('')
+        return self._dummy
+
+    def authenticate(self, email, password, client=None):
+        """Check the password of the user with email.
+
+        The password is rehashed when its hash has another cost than the
+        rounds of the hasher.
+
+        email - compared and limited as normalize_email() returns it
+        client - e.g. the remote address, limited apart from the email
+        return - the user when the password matches, None otherwise
+        raises - RateLimited when the email or client used up its
+            attempts, before anything is hashed, Busy when the hashing
+            queue is full
+        """
+        email = normalize_email(email)
+        keys = ['email:%s' % email]
+        if client:
+            keys.append('client:%s' % client)
+        for key in keys:
+            self.limiter.check(key)
+        model = self.model
+        user = model.select().where(model.email == email).first()
+        hashed = user.password if user is not None else self._dummy_hash()
+        matches, new_hash = self._hasher.check(password, hashed)
+        if user is None or not matches:
+            for key in keys:
+                self.limiter.failed(key)
+            return None
+        self.limiter.reset(keys[0])
+        if new_hash is not None:
+            # Unless the password changed while it was checked.
+            (model.update(password=new_hash)
+             .where((model.id == user.id) & (model.password == hashed))
+             .execute())
+            model_cache.invalidate(model)
+            user.password = new_hash
+        return user
+
+    def set_password(self, user_id, password):
+        """Hash and store a new password.
+
+        return - True when the user exists, False otherwise
+        """
+        return self.model.update_by_id(
+            user_id, dict(password=self._hasher.hash(password)))
+
+
+password_hasher = PasswordHasher(
+    workers=int(os.getenv('AUTH_WORKERS', 0)) or None)
+admin_auth = Authenticator(Administrator)
+customer_auth = Authenticator(Customer)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['create-admin'])
+    parser.add_argument('--email', required=True)
+    args = parser.parse_args(argv)
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+    password = getpass.getpass("Password for %s: " % args.email)
+    admin = Administrator.create(email=normalize_email(args.email),
+                                 password=hash_password(password))
+    print("Administrator %d created" % admin.id)
+
+
+if __name__ == '__main__':
+    main()
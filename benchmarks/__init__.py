@@ -0,0 +1,5 @@
+"""Benchmarks for the library management system.
+
+Each module can be run with "python -m benchmarks.<name> --help" and
+uses a SQLite file as a local stand-in for MySQL.
+"""
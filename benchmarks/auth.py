@@ -0,0 +1,149 @@
+"""Measure login throughput with bcrypt inline and in the process pool.
+
+Run "python -m benchmarks.auth --concurrency 16 --logins 200" to seed a
+SQLite file with administrators and log them in from concurrent threads,
+like the threads of a web worker. Each mode reports logins/sec, login
+latency percentiles, and the latency of a bystander that keeps doing a
+millisecond of Python work meanwhile, which is what the other requests
+of the worker see.
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from models import Administrator, db
+from routing import RoutingSqliteDatabase
+from migrate import MigrationRunner
+import auth
+
+MODES = ['inline', 'pool']
+
+
+class InlineHasher(object):
+    """Checks passwords in the calling thread, as without the pool."""
+
+    def __init__(self, rounds):
+        self.rounds = rounds
+
+    def hash(self, password):
+        return auth.hash_password(password, self.rounds)
+
+    def check(self, password, hashed):
+        return auth.check_password(password, hashed, self.rounds)
+
+
+def seed(path, admins, rounds):
+    """Create a SQLite file with administrators, all with password
+    'secret' hashed at rounds.
+    """
+    database = RoutingSqliteDatabase(path)
+    db.initialize(database)
+    MigrationRunner(database).upgrade()
+    hashed = auth.hash_password('secret', rounds)
+    with database.atomic():
+        for i in range(admins):
+            Administrator.create(email='admin%d@example.com' % i,
+                                 password=hashed)
+    database.close()
+
+
+def _percentile(timings, share):
+    return 1000 * timings[min(len(timings) - 1, int(len(timings) * share))]
+
+
+def _bystander(stop, timings):
+    while not stop.is_set():
+        started = time.time()
+        total = 0
+        for i in range(20000):
+            total += i
+        timings.append(time.time() - started)
+        time.sleep(0.01)
+
+
+def run(mode, logins, concurrency, admins, rounds, workers):
+    """Log in from concurrent threads and return the statistics."""
+    if mode == 'pool':
+        hasher = auth.PasswordHasher(workers=workers, rounds=rounds,
+                                     max_pending=logins, wait=60)
+        # Start the processes before timing.
+        hasher.check('secret', auth.hash_password('secret', rounds))
+    else:
+        hasher = InlineHasher(rounds)
+    # A limit no benchmark reaches, the logins all succeed.
+    authenticator = auth.Authenticator(
+        Administrator, hasher, auth.RateLimiter(limit=logins + 1))
+    timings, failures, lock = [], [], threading.Lock()
+    stop, bystander = threading.Event(), []
+    counter = iter(range(logins))
+
+    def client():
+        while True:
+            with lock:
+                number = next(counter, None)
+            if number is None:
+                return
+            db.connect()
+            started = time.time()
+            try:
+                admin = authenticator.authenticate(
+                    'admin%d@example.com' % (number % admins), 'secret')
+            finally:
+                db.close()
+            with lock:
+                timings.append(time.time() - started)
+                if admin is None:
+                    failures.append(number)
+
+    watcher = threading.Thread(target=_bystander, args=(stop, bystander))
+    watcher.start()
+    started = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    stop.set()
+    watcher.join()
+    if mode == 'pool':
+        hasher.close()
+    timings.sort()
+    bystander.sort()
+    return dict(logins=len(timings), failures=len(failures),
+                logins_per_second=len(timings) / elapsed,
+                median_ms=_percentile(timings, 0.5),
+                p95_ms=_percentile(timings, 0.95),
+                bystander_median_ms=_percentile(bystander, 0.5),
+                bystander_p95_ms=_percentile(bystander, 0.95))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help="threads logging in at once")
+    parser.add_argument('--admins', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=auth.BCRYPT_ROUNDS,
+                        help="bcrypt cost of the stored hashes")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="processes of the pool, defaults to the CPUs")
+    parser.add_argument('--mode', action='append', choices=MODES,
+                        default=None)
+    args = parser.parse_args(argv)
+    directory = tempfile.mkdtemp(prefix='lms-auth-')
+    path = os.path.join(directory, 'auth.db')
+    seed(path, args.admins, args.rounds)
+    results = dict(meta=dict(rounds=args.rounds, cpus=os.cpu_count(),
+                             concurrency=args.concurrency))
+    for mode in args.mode or MODES:
+        results[mode] = run(mode, args.logins, args.concurrency,
+                            args.admins, args.rounds, args.workers)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Compare the compiled fixed queries with building them in peewee.
+
+Run "python -m benchmarks.compiled" to time the queries behind
+Publisher.get_by_id(), update_selected() and select_all() per call on an
+in-memory SQLite database, once built by peewee on every call as before
+and once through compiled.py. The sql rows time only making the SQL and
+its parameters, without running it, which is the part compiling saves.
+"""
+import argparse
+import json
+import random
+import time
+
+from peewee import SqliteDatabase, Using
+from models import *
+from models import _select_by_id, _update_by_id
+
+
+def _peewee_get(pk):
+    return Publisher.get(Publisher.id == pk)
+
+
+def _peewee_update(pk):
+    return Publisher.update(city="Leiden").where(
+        Publisher.id == pk).execute()
+
+
+def _peewee_exists(pk):
+    return Publisher.select().exists()
+
+
+def _compiled_get(pk):
+    return Publisher.get_by_id(pk)
+
+
+def _compiled_update(pk):
+    return _update_by_id.rowcount(Publisher, dict(city="Leiden", pk=pk),
+                                  (('city',),))
+
+
+def _compiled_exists(pk):
+    return Publisher.has_rows()
+
+
+def _peewee_sql(pk):
+    return Publisher.select().where(Publisher.id == pk).limit(1).sql()
+
+
+def _compiled_sql(pk):
+    return _select_by_id.sql(Publisher, dict(pk=pk))
+
+
+CALLS = dict(
+    get=(_peewee_get, _compiled_get),
+    update=(_peewee_update, _compiled_update),
+    exists=(_peewee_exists, _compiled_exists),
+    sql=(_peewee_sql, _compiled_sql),
+)
+
+
+def measure(func, ids):
+    """Return the microseconds per call of func over ids."""
+    func(ids[0])
+    started = time.time()
+    for pk in ids:
+        func(pk)
+    return (time.time() - started) / len(ids) * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args(argv)
+    database = SqliteDatabase(':memory:')
+    with Using(database, MODELS, with_transaction=False):
+        database.create_tables([Publisher])
+        with database.atomic():
+            for i in range(args.rows):
+                Publisher.insert(name="Publisher %d" % i,
+                                 city="Amsterdam").execute()
+        rng = random.Random(0)
+        ids = [rng.randint(1, args.rows) for _ in range(args.calls)]
+        results = {}
+        with database.atomic():
+            for name, (peewee_call, compiled_call) in sorted(CALLS.items()):
+                peewee_us = measure(peewee_call, ids)
+                compiled_us = measure(compiled_call, ids)
+                results[name] = dict(peewee_us=peewee_us,
+                                     compiled_us=compiled_us,
+                                     speedup=peewee_us / compiled_us)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""Generate a library of realistic size for the benchmarks.
+
+Run "python -m benchmarks.data --path library.db" to seed a SQLite file
+with 1M books, 10M lends and 5M reviews, or shrink every volume with
+e.g. --scale 0.01 for a quick run. Popular books and authors get most of
+the lends and reviews, like in a real library.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import time
+
+from models import *
+from routing import RoutingSqliteDatabase
+from migrate import MigrationRunner
+from snapshot import latest_change, prune_changes
+import rollups
+
+VOLUMES = dict(publishers=5000, authors=50000, books=1000000,
+               customers=200000, lends=10000000, reviews=5000000)
+
+GENRES = ['fantasy', 'science fiction', 'thriller', 'crime', 'romance',
+          'horror', 'history', 'biography', 'poetry', 'drama', 'epic',
+          'war', 'travel', 'cooking', 'science', 'philosophy', 'religion',
+          'children', 'young adult', 'comics', 'art', 'music', 'sports',
+          'business', 'economics', 'politics', 'law', 'medicine',
+          'psychology', 'education']
+LANGUAGES = ['English'] * 6 + ['Dutch'] * 2 + ['German', 'French']
+BOOK_TYPES = ['paperback', 'hardcover', 'ebook']
+CITIES = ['Amsterdam', 'London', 'New York', 'Berlin', 'Paris', 'Madrid',
+          'Toronto', 'Sydney', 'Tokyo', 'Rotterdam']
+RATINGS = [1, 2, 3, 3, 4, 4, 4, 5, 5, 5]
+VOCABULARY = ['w%04d' % i for i in range(5000)]
+TODAY = datetime.date(2016, 6, 1)
+
+
+def volumes(scale=1.0, **overrides):
+    """Return the amount of rows per table scaled by scale.
+
+    overrides - exact amounts for single tables, e.g. books=1000
+    """
+    amounts = dict((name, max(1, int(amount * scale)))
+                   for name, amount in VOLUMES.items())
+    amounts.update((name, amount) for name, amount in overrides.items()
+                   if amount is not None)
+    return amounts
+
+
+def _popular(rng, amount):
+    # Skewed towards low ids, the first 1% gets about a fifth of the
+    # picks and the first 10% almost half.
+    return 1 + int(amount * rng.random() ** 3)
+
+
+def _words(rng, amount):
+    return ' '.join(VOCABULARY[_popular(rng, len(VOCABULARY)) - 1]
+                    for _ in range(amount))
+
+
+def _insert(database, table, columns, rows, chunk_size=10000):
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        table, ', '.join(columns),
+        ', '.join([database.interpolation] * len(columns)))
+    cursor = database.get_cursor()
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            with database.atomic():
+                cursor.executemany(sql, chunk)
+            chunk = []
+    if chunk:
+        with database.atomic():
+            cursor.executemany(sql, chunk)
+
+
+def _date(rng, start, end):
+    return start + datetime.timedelta(
+        days=rng.randint(0, (end - start).days))
+
+
+def generate(database, amounts, seed_value=0, progress=None):
+    """Fill an empty database with generated rows.
+
+    The schema is created with the migrations. Models have to point at
+    the database already, e.g. through db.initialize(database).
+
+    amounts - rows per table, see volumes()
+    progress - called with the name of each table before it is filled
+    return - dict of seconds spent per table
+    """
+    rng = random.Random(seed_value)
+    timings = {}
+    MigrationRunner(database).upgrade()
+
+    def step(name, table, columns, rows):
+        if progress is not None:
+            progress(name)
+        started = time.time()
+        _insert(database, table, columns, rows)
+        timings[name] = time.time() - started
+
+    def column(field):
+        return field.db_column
+
+    step('publishers', 'publisher', ['name', 'city'],
+         (('Publisher %d' % i, rng.choice(CITIES))
+          for i in range(amounts['publishers'])))
+    step('authors', 'author', ['name', 'biography', 'age'],
+         ((_words(rng, 2), _words(rng, 40), rng.randint(20, 90))
+          for _ in range(amounts['authors'])))
+    step('genres', 'genre', ['genre'], ((genre,) for genre in GENRES))
+
+    copies = []
+
+    def books():
+        for i in range(amounts['books']):
+            amount = rng.randint(1, 5)
+            copies.append(amount)
+            yield ('978%010d' % i, _words(rng, 3)[:32],
+                   _popular(rng, amounts['authors']),
+                   rng.randint(1, amounts['publishers']),
+                   rng.randint(50, 1200), rng.randint(1, 5),
+                   rng.randint(1, 10), _words(rng, 60),
+                   _date(rng, datetime.date(1950, 1, 1), TODAY),
+                   rng.choice(LANGUAGES), rng.choice(BOOK_TYPES), amount,
+                   amount)
+    step('books', 'book',
+         ['isbn', 'title', column(Book.author_id), column(Book.publisher_id),
+          'amount_of_pages', 'book_print', 'edition', 'summary',
+          'published_at', 'language', 'book_type', 'amount', 'available'],
+         books())
+
+    def book_genres():
+        for book_id in range(1, amounts['books'] + 1):
+            for genre_id in rng.sample(range(1, len(GENRES) + 1),
+                                       rng.randint(1, 3)):
+                yield book_id, genre_id, 0.0
+    step('book_genres', 'bookgenre',
+         [column(BookGenre.book_id), column(BookGenre.genre_id), 'average'],
+         book_genres())
+    step('customers', 'customer',
+         ['email', 'password', 'first_name', 'surname'],
+         (('customer%d@example.com' % i, 'x' * 60, _words(rng, 1),
+           _words(rng, 1)) for i in range(amounts['customers'])))
+
+    def lends():
+        lent_out = {}
+        for _ in range(amounts['lends']):
+            book_id = _popular(rng, amounts['books'])
+            lent_at = _date(rng, datetime.date(2000, 1, 1), TODAY)
+            return_date = lent_at + datetime.timedelta(days=21)
+            returned_at = lent_at + datetime.timedelta(
+                days=rng.randint(1, 30))
+            # Lends of the last weeks may still be open, as long as a
+            # copy of the book is left.
+            if return_date > TODAY - datetime.timedelta(days=60) and \
+                    lent_out.get(book_id, 0) < copies[book_id - 1] and \
+                    rng.random() < 0.5:
+                returned_at = None
+                lent_out[book_id] = lent_out.get(book_id, 0) + 1
+            yield (book_id, rng.randint(1, amounts['customers']), lent_at,
+                   return_date, returned_at)
+    step('lends', 'lend',
+         [column(Lend.book_id), column(Lend.customer_id), 'lent_at',
+          'return_date', 'returned_at'], lends())
+    step('reviews', 'review',
+         [column(Review.customer_id), column(Review.book_id), 'text',
+          'published_at', 'rating'],
+         ((rng.randint(1, amounts['customers']),
+           _popular(rng, amounts['books']), _words(rng, 30),
+           _date(rng, datetime.date(2000, 1, 1), TODAY),
+           rng.choice(RATINGS)) for _ in range(amounts['reviews'])))
+
+    if progress is not None:
+        progress('summaries')
+    started = time.time()
+    BookRating.rebuild()
+    Book.recount_available()
+    # Snapshots and rollups start from the generated tables, not from
+    # their logs.
+    prune_changes(latest_change())
+    rollups.prune_changes(rollups.latest_change())
+    timings['summaries'] = time.time() - started
+    return timings
+
+
+def open_sqlite(path):
+    """Point models.db at a SQLite file and return the database."""
+    database = RoutingSqliteDatabase(
+        path, pragmas=[('synchronous', 'off'), ('journal_mode', 'wal')])
+    db.initialize(database)
+    return database
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', required=True,
+                        help="SQLite file to create")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiply every volume by this")
+    for name in sorted(VOLUMES):
+        parser.add_argument('--' + name, type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if os.path.exists(args.path):
+        parser.error("%s already exists" % args.path)
+    amounts = volumes(args.scale, **dict(
+        (name, getattr(args, name)) for name in VOLUMES))
+    open_sqlite(args.path)
+    timings = generate(db.obj, amounts, args.seed,
+                       progress=lambda name: print("Generating %s" % name))
+    print(json.dumps(dict(volumes=amounts, seconds=timings), indent=2,
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
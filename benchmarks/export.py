@@ -0,0 +1,117 @@
+"""Compare exports through models with the streaming export.
+
+Run "python -m benchmarks.export --path library.db" on a file made by
+benchmarks.data. Every mode exports the same rows to a temporary file in
+a forked process of its own and reports rows/sec and how far the memory
+of that process grew:
+
+    models - iterates the select query as model instances
+    stream - export.export() with a single process
+    parallel - export.export() with --workers processes, the memory is
+        that of the parent
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from models import *
+from benchmarks.data import open_sqlite
+import export
+
+MODES = ['models', 'stream', 'parallel']
+
+
+def memory():
+    """Return the current and peak RSS of this process in bytes."""
+    values = {}
+    with open('/proc/self/status') as status:
+        for line in status:
+            name, _, rest = line.partition(':')
+            if name in ('VmRSS', 'VmHWM'):
+                values[name] = int(rest.split()[0]) * 1024
+    return values['VmRSS'], values['VmHWM']
+
+
+def _export_models(kind, path):
+    columns = [name for name, _ in export.EXPORTS[kind].columns]
+    rows = 0
+    with open(path, 'w') as out:
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        query = export.EXPORTS[kind].query().order_by(
+            export.EXPORTS[kind].model._meta.primary_key)
+        for instance in query.naive():
+            # Raw foreign keys from _data, reading the attribute would
+            # query the related row. Joined columns are attributes of
+            # the instance, the names of books collide but only the
+            # time and memory count here.
+            writer.writerow([instance._data[name] if name in instance._data
+                             else getattr(instance, name, None)
+                             for name in columns])
+            rows += 1
+    return rows
+
+
+def _worker(mode, kind, fmt, path, workers, results):
+    started_rss, _ = memory()
+    output = tempfile.mktemp(prefix='lms-export-')
+    started = time.time()
+    try:
+        if mode == 'models':
+            rows = _export_models(kind, output)
+        else:
+            rows = export.export(kind, output, fmt,
+                                 workers if mode == 'parallel' else 1)
+        elapsed = time.time() - started
+        size = os.path.getsize(output)
+    finally:
+        if os.path.exists(output):
+            os.remove(output)
+    _, peak = memory()
+    results.put(dict(rows=rows, seconds=elapsed, bytes=size,
+                     rows_per_second=rows / elapsed,
+                     memory_growth_mb=(peak - started_rss) / 2.0 ** 20))
+
+
+def measure(mode, kind, fmt, path, workers):
+    """Export in a forked process and return its statistics."""
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    process = context.Process(target=_worker, args=(
+        mode, kind, fmt, path, workers, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', required=True,
+                        help="SQLite file made by benchmarks.data")
+    parser.add_argument('--kind', choices=sorted(export.EXPORTS),
+                        default='lends')
+    parser.add_argument('--format', choices=sorted(export.WRITERS),
+                        default='csv', help="format of the export modes, "
+                        "the models mode always writes CSV")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--mode', action='append', choices=MODES,
+                        default=None)
+    args = parser.parse_args(argv)
+    open_sqlite(args.path)
+    # No connection may be open while forking.
+    db.close_all()
+    results = dict(meta=dict(kind=args.kind, format=args.format,
+                             workers=args.workers, cpus=os.cpu_count()))
+    for mode in args.mode or MODES:
+        results[mode] = measure(mode, args.kind, args.format, args.path,
+                                args.workers)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Load test app.py against async_app.py with the same requests.
+
+Run "python -m benchmarks.load --concurrency 32 --requests 2000" to seed a
+SQLite file, serve it with each app in turn and report requests/sec and
+latency percentiles. --latency adds a sleep to every query to stand in
+for the round trip to a MySQL server, which is where a blocking worker
+loses its time.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from models import db
+from routing import RoutingSqliteDatabase
+from benchmarks.search import seed as seed_books
+
+HOST = '127.0.0.1'
+
+
+def seed(database, publishers, books):
+    """Fill an empty database with publishers and books."""
+    seed_books(database, books)
+    cursor = database.get_cursor()
+    with database.atomic():
+        cursor.executemany('INSERT INTO publisher (name, city) VALUES (?, ?)',
+                           (('Publisher %d' % i, 'City %d' % (i % 100))
+                            for i in range(1, publishers)))
+
+
+def _serve(kind, path, port, workers, latency, threaded):
+    # Runs in a child process so client and server do not share a GIL.
+    database = RoutingSqliteDatabase(path, max_connections=workers)
+    if latency:
+        database.add_query_hook(lambda sql, params, seconds:
+                                time.sleep(latency))
+    db.initialize(database)
+    if kind == 'sync':
+        from werkzeug.serving import make_server
+        from app import app
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        make_server(HOST, port, app, threaded=threaded).serve_forever()
+    else:
+        from aiohttp import web
+        from async_app import create_app
+        web.run_app(create_app(workers), host=HOST, port=port,
+                    print=None, access_log=None)
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind((HOST, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("Server on port %d did not start" % port)
+
+
+def _paths(amount, publishers, seed_value=0):
+    rng = random.Random(seed_value)
+    paths = []
+    for _ in range(amount):
+        pick = rng.random()
+        if pick < 0.4:
+            paths.append('/admin/publisher?sort=%s'
+                         % rng.choice(['id', 'name', 'city']))
+        elif pick < 0.7:
+            paths.append('/admin/publisher/update/%d'
+                         % rng.randint(1, publishers))
+        else:
+            paths.append('/catalogue?sort=%s'
+                         % rng.choice(['id', 'title', 'published_at']))
+    return paths
+
+
+def _fire(port, paths, concurrency):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    todo = iter(paths)
+
+    def client():
+        while True:
+            with lock:
+                path = next(todo, None)
+            if path is None:
+                return
+            started = time.time()
+            try:
+                urlopen('http://%s:%d%s' % (HOST, port, path)).read()
+                failed = False
+            except (HTTPError, OSError):
+                failed = True
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += failed
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.time() - started
+    latencies.sort()
+    return dict(requests=len(latencies), errors=errors[0],
+                requests_per_second=len(latencies) / total,
+                p50_ms=1000 * latencies[len(latencies) // 2],
+                p99_ms=1000 * latencies[int(len(latencies) * 0.99)])
+
+
+def run(kind, path, paths, concurrency, workers, latency, threaded):
+    port = _free_port()
+    server = multiprocessing.Process(
+        target=_serve, args=(kind, path, port, workers, latency, threaded))
+    server.start()
+    try:
+        _wait_for(port)
+        # Warm up the caches and the connection pool before measuring.
+        _fire(port, paths[:concurrency], concurrency)
+        return _fire(port, paths, concurrency)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--publishers', type=int, default=10000)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--workers', type=int, default=20,
+                        help="connection pool size of both apps")
+    parser.add_argument('--latency', type=float, default=0.002,
+                        help="seconds added to every query")
+    parser.add_argument('--sync-threaded', action='store_true',
+                        help="serve app.py with a thread per request, "
+                             "app.run() serves one request at a time")
+    parser.add_argument('--path', default=None,
+                        help="SQLite file, reused when it already exists")
+    args = parser.parse_args(argv)
+    path = args.path or os.path.join(tempfile.mkdtemp(), 'load.db')
+    if not os.path.exists(path):
+        database = RoutingSqliteDatabase(path)
+        db.initialize(database)
+        seed(database, args.publishers, args.books)
+        database.close_all()
+    paths = _paths(args.requests, args.publishers)
+    results = dict(requests=args.requests, concurrency=args.concurrency,
+                   workers=args.workers, latency=args.latency,
+                   sync_threaded=args.sync_threaded)
+    for kind in ['sync', 'async']:
+        results[kind] = run(kind, path, paths, args.concurrency,
+                            args.workers, args.latency, args.sync_threaded)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""Time the overdue scan over a large lend history.
+
+Run "python -m benchmarks.overdue --lends 10000000" to seed a SQLite file
+and scan it once with the Lend.Meta indexes and once without them.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+
+from peewee import SqliteDatabase, Using
+from models import MODELS, Book, Lend
+from overdue import scan_overdue
+
+TODAY = datetime.date(2016, 6, 1)
+
+
+def seed(database, lends, open_ratio=0.02, overdue_ratio=0.5, seed_value=0):
+    """Fill an empty database with customers, books and lends.
+
+    open_ratio of the lends is not returned yet, overdue_ratio of those
+    is past its return date.
+    """
+    rng = random.Random(seed_value)
+    customers = max(1, lends // 50)
+    books = max(1, lends // 10)
+    database.create_tables(MODELS, safe=True)
+    cursor = database.get_cursor()
+    with database.atomic():
+        cursor.execute("INSERT INTO publisher (name, city) VALUES ('p', 'c')")
+        cursor.execute("INSERT INTO author (name, biography, age) "
+                       "VALUES ('a', '', 1)")
+        cursor.executemany(
+            'INSERT INTO book (isbn, title, %s, %s, amount_of_pages, '
+            'book_print, edition, summary, published_at, language, '
+            'book_type, amount, available) VALUES '
+            "(?, ?, 1, 1, 1, 1, 1, '', '2000-01-01', 'en', 'pb', 1, 1)"
+            % (Book.author_id.db_column, Book.publisher_id.db_column),
+            (('isbn-%d' % i, 'Book %d' % i) for i in range(books)))
+        cursor.executemany(
+            'INSERT INTO customer (email, password, first_name, surname) '
+            "VALUES (?, '', 'First', 'Last')",
+            (('%d@example.com' % i,) for i in range(customers)))
+
+        def lend_rows():
+            for _ in range(lends):
+                return_date = TODAY - datetime.timedelta(
+                    days=rng.randint(-30, 3650))
+                returned_at = return_date
+                if rng.random() < open_ratio:
+                    returned_at = None
+                    if rng.random() < overdue_ratio:
+                        return_date = TODAY - datetime.timedelta(
+                            days=rng.randint(1, 60))
+                    else:
+                        return_date = TODAY + datetime.timedelta(
+                            days=rng.randint(0, 30))
+                yield (rng.randint(1, books), rng.randint(1, customers),
+                       return_date - datetime.timedelta(days=21),
+                       return_date, returned_at)
+
+        cursor.executemany(
+            'INSERT INTO lend (%s, %s, lent_at, return_date, returned_at) '
+            'VALUES (?, ?, ?, ?, ?)' % (Lend.book_id.db_column,
+                                        Lend.customer_id.db_column),
+            lend_rows())
+
+
+def scan(batch_size):
+    started = time.time()
+    notices = lends = 0
+    for notice in scan_overdue(TODAY, batch_size):
+        notices += 1
+        lends += len(notice.lends)
+    return dict(seconds=time.time() - started, notices=notices,
+                overdue_lends=lends)
+
+
+def run(lends, batch_size, path):
+    database = SqliteDatabase(path)
+    with Using(database, MODELS, with_transaction=False):
+        result = dict(lends=lends, batch_size=batch_size)
+        if not database.get_tables():
+            started = time.time()
+            seed(database, lends)
+            result['seed_s'] = time.time() - started
+        result['indexed'] = scan(batch_size)
+        indexes = [i.name for i in database.get_indexes('lend')
+                   if 'returned_at' in i.columns]
+        for name in indexes:
+            database.execute_sql('DROP INDEX "%s"' % name)
+        try:
+            result['unindexed'] = scan(batch_size)
+        finally:
+            database.create_tables([Lend], safe=True)
+        return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lends', type=int, default=10000000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--path', default=None,
+                        help="SQLite file, reused when it already exists")
+    args = parser.parse_args(argv)
+    path = args.path or os.path.join(tempfile.mkdtemp(), 'overdue.db')
+    print(json.dumps(run(args.lends, args.batch_size, path), indent=2,
+                     sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
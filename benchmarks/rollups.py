@@ -0,0 +1,120 @@
+"""Compare the lending dashboard on the rollups with live queries.
+
+Run "python -m benchmarks.rollups --path library.db" on a file made by
+benchmarks.data. It builds the rollups, times a refresh after a day of
+new lends, and then answers the questions of /admin/lending for the
+last --months months twice: from the rollups and by grouping the lend
+table itself. The live answers are checked against the rollups.
+"""
+import argparse
+import datetime
+import json
+import random
+import time
+
+from models import *
+from migrate import MigrationRunner
+from benchmarks.data import open_sqlite
+import rollups
+
+
+def _timed(func, *args, **kwargs):
+    started = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - started
+
+
+def live_month(month, end):
+    """Return (loans per day, top books, loans per genre) of a month
+    from the lend table.
+    """
+    days = dict(Lend.select(Lend.lent_at, fn.COUNT(Lend.id))
+                .where(Lend.lent_at.between(month, end))
+                .group_by(Lend.lent_at)
+                .tuples())
+    books = list(Lend.select(Lend.book_id, fn.COUNT(Lend.id))
+                 .where(Lend.lent_at.between(month, end))
+                 .group_by(Lend.book_id)
+                 .order_by(fn.COUNT(Lend.id).desc(), Lend.book_id)
+                 .limit(10)
+                 .tuples())
+    genres = dict(Lend.select(BookGenre.genre_id, fn.COUNT(Lend.id))
+                  .join(BookGenre, on=(Lend.book_id == BookGenre.book_id))
+                  .where(Lend.lent_at.between(month, end))
+                  .group_by(BookGenre.genre_id)
+                  .tuples())
+    return sum(days.values()), books, genres
+
+
+def rollup_month(month, end):
+    """Return the same answers as live_month() from the rollups."""
+    days = rollups.series(month, end)
+    books = rollups.top('book', month, end)
+    # Genres with only returns or overdues have rows as well.
+    genres = dict((row.key_id, row.loans)
+                  for row in rollups.breakdown('genre', month)
+                  if row.loans)
+    return sum(row.loans for row in days), books, genres
+
+
+def measure_refresh(today, lends):
+    """Lend books for a day and time the refresh that folds them in."""
+    rng = random.Random(0)
+    books = Book.select(fn.MAX(Book.id)).scalar()
+    customers = Customer.select(fn.MAX(Customer.id)).scalar()
+    with db.atomic():
+        for _ in range(lends):
+            Lend.create(book_id=rng.randint(1, books),
+                        customer_id=rng.randint(1, customers),
+                        lent_at=today, return_date=today)
+    days, seconds = _timed(rollups.refresh, today)
+    return dict(lends=lends, days=days, seconds=seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', required=True,
+                        help="SQLite file made by benchmarks.data")
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--lends', type=int, default=1000,
+                        help="lends added before the refresh")
+    args = parser.parse_args(argv)
+    database = open_sqlite(args.path)
+    MigrationRunner(database).upgrade()
+    # SQLite gives the maximum back as text.
+    newest = datetime.datetime.strptime(
+        str(Lend.select(fn.MAX(Lend.lent_at)).scalar()), '%Y-%m-%d')
+    today = rollups.month_of(newest.date()) + datetime.timedelta(days=40)
+
+    days, seconds = _timed(rollups.build, today)
+    results = dict(lends=Lend.select().count(),
+                   build=dict(days=days, seconds=seconds,
+                              rows=LendRollup.select().count()))
+    results['refresh'] = measure_refresh(today, args.lends)
+
+    timings = dict(live=[], rollups=[])
+    month = rollups.month_of(today)
+    for _ in range(args.months):
+        month = rollups.month_of(month - datetime.timedelta(days=1))
+        end = rollups.month_of(month + datetime.timedelta(days=31)) - \
+            datetime.timedelta(days=1)
+        live, live_seconds = _timed(live_month, month, end)
+        rolled, rollup_seconds = _timed(rollup_month, month, end)
+        # Ties in the top books may come in another order.
+        if live[0] != rolled[0] or live[2] != rolled[2] or \
+                [total for _, total in live[1]] != \
+                [total for _, total in rolled[1]]:
+            raise AssertionError("Rollups of %s differ from the lends"
+                                 % month)
+        timings['live'].append(live_seconds)
+        timings['rollups'].append(rollup_seconds)
+    for name, values in timings.items():
+        values.sort()
+        results['month_' + name] = dict(
+            median_ms=values[len(values) // 2] * 1000,
+            max_ms=values[-1] * 1000)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""Compare Book.search() with LIKE scans over a large catalogue.
+
+Run "python -m benchmarks.search --books 1000000" to seed a SQLite file
+with generated books and time both approaches for the same words.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import tempfile
+import time
+
+from peewee import SqliteDatabase, Using
+from models import MODELS, Author, Book
+from search import create_search_index
+from versions import create_version_log
+
+VOCABULARY_SIZE = 20000
+
+
+def _words(rng, vocabulary, amount):
+    # A skewed pick so some words are common and most are rare.
+    return ' '.join(vocabulary[int(rng.paretovariate(1.0)) %
+                               len(vocabulary)] for _ in range(amount))
+
+
+def seed(database, books, seed_value=0):
+    """Fill an empty database with generated authors and books, with the
+    table versions the conditional pages read."""
+    rng = random.Random(seed_value)
+    vocabulary = ['w%05d' % i for i in range(VOCABULARY_SIZE)]
+    authors = max(1, books // 20)
+    database.create_tables(MODELS, safe=True)
+    cursor = database.get_cursor()
+    with database.atomic():
+        cursor.execute('INSERT INTO publisher (name, city) '
+                       "VALUES ('Publisher', 'City')")
+        cursor.executemany(
+            'INSERT INTO author (id, name, biography, age) '
+            'VALUES (?, ?, ?, ?)',
+            ((i, _words(rng, vocabulary, 2), _words(rng, vocabulary, 30),
+              rng.randint(20, 90)) for i in range(1, authors + 1)))
+        published_at = datetime.date(2000, 1, 1)
+        cursor.executemany(
+            'INSERT INTO book (isbn, title, %s, %s, amount_of_pages, '
+            'book_print, edition, summary, published_at, language, '
+            'book_type, amount, available) '
+            'VALUES (?, ?, ?, 1, 200, 1, 1, ?, ?, ?, ?, 1, 1)'
+            % (Book.author_id.db_column, Book.publisher_id.db_column),
+            (('isbn-%d' % i, _words(rng, vocabulary, 3)[:32],
+              rng.randint(1, authors), _words(rng, vocabulary, 60),
+              published_at, rng.choice(['English', 'Dutch']), 'paperback')
+             for i in range(books)))
+    # The pages of the apps take their ETags from the table versions.
+    create_version_log(database)
+    return vocabulary
+
+
+def like_search(word, limit):
+    pattern = '%' + word + '%'
+    query = (Book.select()
+             .join(Author)
+             .where((Book.title ** pattern) | (Book.summary ** pattern) |
+                    (Author.name ** pattern) |
+                    (Author.biography ** pattern))
+             .limit(limit))
+    return list(query)
+
+
+def _time(func, words, limit):
+    timings = []
+    for word in words:
+        started = time.time()
+        func(word, limit)
+        timings.append(time.time() - started)
+    timings.sort()
+    return dict(median_ms=1000 * timings[len(timings) // 2],
+                p95_ms=1000 * timings[int(len(timings) * 0.95)],
+                total_s=sum(timings))
+
+
+def run(books, queries, limit, path):
+    database = SqliteDatabase(path)
+    with Using(database, MODELS, with_transaction=False):
+        if not database.get_tables():
+            started = time.time()
+            vocabulary = seed(database, books)
+            seeded = time.time() - started
+            started = time.time()
+            create_search_index(database)
+            indexed = time.time() - started
+        else:
+            vocabulary = ['w%05d' % i for i in range(VOCABULARY_SIZE)]
+            seeded = indexed = 0.0
+        rng = random.Random(1)
+        words = [rng.choice(vocabulary) for _ in range(queries)]
+        return dict(books=books, queries=queries, limit=limit,
+                    seed_s=seeded, index_s=indexed,
+                    fulltext=_time(lambda w, n: Book.search(w, limit=n),
+                                   words, limit),
+                    like=_time(like_search, words, limit))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--books', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--path', default=None,
+                        help="SQLite file, reused when it already exists")
+    args = parser.parse_args(argv)
+    path = args.path or os.path.join(tempfile.mkdtemp(), 'search.db')
+    print(json.dumps(run(args.books, args.queries, args.limit, path),
+                     indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+"""Compare the catalogue snapshot with live queries.
+
+Run "python -m benchmarks.snapshot --path library.db" on a file made by
+benchmarks.data. It builds a snapshot next to it and forks --workers
+processes that each read every catalogue row, either through the mapped
+snapshot or into dicts of their own, and reports the memory of every
+worker. Then it times book lookups and catalogue pages on the snapshot
+and on the database.
+
+RSS counts a mapped page in every worker that touched it. PSS splits
+shared pages over the processes mapping them, so it shows what one more
+worker costs.
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import time
+
+from models import *
+from migrate import MigrationRunner
+from pagination import encode_cursor
+from benchmarks.data import open_sqlite
+import snapshot
+
+MODES = ['snapshot', 'dicts']
+
+
+def memory():
+    """Return the RSS and PSS of this process in bytes, PSS is None
+    where the kernel does not report it.
+    """
+    values = {}
+    try:
+        with open('/proc/self/smaps_rollup') as smaps:
+            for line in smaps:
+                name, _, rest = line.partition(':')
+                if name in ('Rss', 'Pss'):
+                    values[name] = int(rest.split()[0]) * 1024
+    except (IOError, OSError):
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    values['Rss'] = int(line.split()[1]) * 1024
+    return values.get('Rss'), values.get('Pss')
+
+
+def _worker(mode, path, snapshot_path, barrier, results):
+    before = memory()
+    if mode == 'snapshot':
+        catalogue = snapshot.Catalogue()
+        catalogue.load(snapshot_path)
+        rows = sum(1 for table in snapshot.TABLES
+                   for _ in catalogue.snapshot.rows(table))
+        held = catalogue
+    else:
+        # Own connection, the one of the parent must not be shared.
+        open_sqlite(path)
+        held = dict((table, dict((row[0], row)
+                                 for row in snapshot.read_rows(table)))
+                    for table in snapshot.TABLES)
+        rows = sum(len(table) for table in held.values())
+    # Measure once every worker holds its copy, so PSS sees the sharing.
+    barrier.wait()
+    after = memory()
+    barrier.wait()
+    results.put(dict(mode=mode, rows=rows, rss_before=before[0],
+                     rss=after[0], pss=after[1]))
+    del held
+
+
+def measure_workers(mode, path, snapshot_path, workers):
+    """Fork workers that all read the catalogue in one way.
+
+    mode - 'snapshot' or 'dicts'
+    return - list of dicts with the RSS and PSS of every worker
+    """
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=_worker,
+                                 args=(mode, path, snapshot_path, barrier,
+                                       results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    measured = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return measured
+
+
+def _stats(timings):
+    timings = sorted(timings)
+    return dict(operations=len(timings),
+                median_ms=1000 * timings[len(timings) // 2],
+                p95_ms=1000 * timings[int(len(timings) * 0.95)])
+
+
+def _time(func, calls):
+    timings = []
+    for args in calls:
+        started = time.time()
+        func(*args)
+        timings.append(time.time() - started)
+    return _stats(timings)
+
+
+def _live_book(book_id):
+    # What a BookRecord holds, read from the database.
+    book = (Book.select(Book, Author, Publisher)
+            .join(Author)
+            .switch(Book)
+            .join(Publisher)
+            .where(Book.id == book_id)
+            .get())
+    book.genres = [genre for genre, in
+                   Genre.select(Genre.genre)
+                   .join(BookGenre)
+                   .where(BookGenre.book_id == book_id)
+                   .order_by(Genre.genre)
+                   .tuples()]
+    return book
+
+
+def measure_lookups(catalogue, repeat, seed_value=0):
+    """Time lookups of random books and pages at random cursors on the
+    snapshot and on the database.
+    """
+    rng = random.Random(seed_value)
+    ids = catalogue.snapshot.ids('book')
+    book_ids = [ids[rng.randrange(len(ids))] for _ in range(repeat)]
+    pages = []
+    for book_id in book_ids:
+        sort = rng.choice(Book.sortable_fields)
+        book = catalogue.book(book_id)
+        pages.append((encode_cursor(getattr(book, sort), book.id), None,
+                      20, sort))
+
+    results = dict(book_snapshot=_time(catalogue.book,
+                                       [(i,) for i in book_ids]),
+                   book_live=_time(_live_book, [(i,) for i in book_ids]))
+    # catalogue_page() answers from the module catalogue when loaded.
+    snapshot.catalogue.load(catalogue.path)
+    try:
+        results['page_snapshot'] = _time(Book.catalogue_page, pages)
+    finally:
+        snapshot.catalogue.unload()
+    results['page_live'] = _time(Book.catalogue_page, pages)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', required=True,
+                        help="SQLite file made by benchmarks.data")
+    parser.add_argument('--snapshot', default=None,
+                        help="snapshot file, defaults to PATH.snapshot")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=1000,
+                        help="lookups and pages timed")
+    parser.add_argument('--mode', action='append', choices=MODES,
+                        default=None, help="only measure these workers")
+    args = parser.parse_args(argv)
+    snapshot_path = args.snapshot or args.path + '.snapshot'
+    database = open_sqlite(args.path)
+    MigrationRunner(database).upgrade()
+
+    started = time.time()
+    size, change_id = snapshot.build(snapshot_path)
+    results = dict(snapshot=dict(bytes=size,
+                                 build_seconds=time.time() - started))
+    # No connection may be open while forking.
+    database.close()
+    for mode in args.mode or MODES:
+        results['workers_' + mode] = measure_workers(
+            mode, args.path, snapshot_path, args.workers)
+
+    catalogue = snapshot.Catalogue()
+    catalogue.load(snapshot_path)
+    results['lookups'] = measure_lookups(catalogue, args.repeat)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""Time model operations and request paths on a generated library.
+
+Run "python -m benchmarks.suite --path library.db --output base.json" on
+a file made by benchmarks.data to record a baseline, and later
+"python -m benchmarks.suite --path library.db --compare base.json" to
+exit with status 1 when a case got slower than the baseline by more
+than --threshold. Writes run in a transaction that is rolled back, so
+the library stays the same between runs.
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import sqlite3
+import sys
+import time
+
+from models import *
+from benchmarks.data import GENRES, VOCABULARY, open_sqlite
+
+CASES = []
+
+
+class Case(object):
+    """A named benchmark.
+
+    prepare - called with the Context, returns the list of
+        (function, args) calls to time, one per operation
+    writes - run inside a transaction that is rolled back afterwards
+    repeat - upper bound on the amount of operations, for slow cases
+    """
+
+    def __init__(self, name, prepare, writes=False, repeat=None):
+        self.name = name
+        self.prepare = prepare
+        self.writes = writes
+        self.repeat = repeat
+
+
+def case(name, writes=False, repeat=None):
+    def register(prepare):
+        CASES.append(Case(name, prepare, writes, repeat))
+        return prepare
+    return register
+
+
+class Context(object):
+    """What the cases need to know about the library."""
+
+    def __init__(self, repeat, seed_value=0):
+        self.repeat = repeat
+        self.rng = random.Random(seed_value)
+        self.counts = dict((model._meta.db_table, model.select().count())
+                           for model in MODELS)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from app import app
+            self._client = app.test_client()
+        return self._client
+
+    def random_id(self, model):
+        return self.rng.randint(1, self.counts[model._meta.db_table])
+
+
+@case('publisher.add_publisher', writes=True)
+def _add_publisher(ctx):
+    return [(Publisher.add_publisher, ("Publisher bench %d" % i, "City"))
+            for i in range(ctx.repeat)]
+
+
+@case('publisher.select_all', repeat=20)
+def _select_all_publishers(ctx):
+    return [(lambda: list(Publisher.select_all()), ())] * ctx.repeat
+
+
+@case('publisher.update_selected', writes=True)
+def _update_publisher(ctx):
+    return [(Publisher.update_selected,
+             (ctx.random_id(Publisher), "Renamed %d" % i, "City"))
+            for i in range(ctx.repeat)]
+
+
+@case('publisher.delete_selected', writes=True)
+def _delete_publisher(ctx):
+    # Fresh publishers, deleting seeded ones could break foreign keys.
+    ids = [Publisher.create(name="Deleted %d" % i, city="City").id
+           for i in range(ctx.repeat)]
+    return [(Publisher.delete_selected, (pk,)) for pk in ids]
+
+
+@case('author.add_author', writes=True)
+def _add_author(ctx):
+    return [(Author.add_author, ("Author bench %d" % i, "Biography", 50))
+            for i in range(ctx.repeat)]
+
+
+@case('author.select_all', repeat=5)
+def _select_all_authors(ctx):
+    return [(lambda: list(Author.select_all()), ())] * ctx.repeat
+
+
+@case('author.update_selected', writes=True)
+def _update_author(ctx):
+    return [(Author.update_selected,
+             (ctx.random_id(Author), "Renamed %d" % i, "Biography", 40))
+            for i in range(ctx.repeat)]
+
+
+@case('author.delete_selected', writes=True)
+def _delete_author(ctx):
+    ids = [Author.create(name="Deleted %d" % i, biography="", age=40).id
+           for i in range(ctx.repeat)]
+    return [(Author.delete_selected, (pk,)) for pk in ids]
+
+
+@case('book.insert', writes=True)
+def _insert_book(ctx):
+    def insert(i, author_id, publisher_id):
+        return Book.create(isbn='bench-%d' % i, title="Bench %d" % i,
+                           author_id=author_id, publisher_id=publisher_id,
+                           amount_of_pages=300, book_print=1, edition=1,
+                           summary="", published_at=datetime.date.today(),
+                           language="English", book_type="paperback",
+                           amount=3)
+    return [(insert, (i, ctx.random_id(Author), ctx.random_id(Publisher)))
+            for i in range(ctx.repeat)]
+
+
+@case('book.get_with_relations')
+def _book_with_relations(ctx):
+    def get(book_id):
+        book = Book.get(Book.id == book_id)
+        return book.author_id.name, book.publisher_id.name
+    return [(get, (ctx.random_id(Book),)) for _ in range(ctx.repeat)]
+
+
+@case('bookgenre.books_in_genre')
+def _books_in_genre(ctx):
+    def books(genre):
+        return list(Book.select()
+                    .join(BookGenre)
+                    .join(Genre)
+                    .where(Genre.genre == genre)
+                    .order_by(Book.id)
+                    .limit(20))
+    return [(books, (ctx.rng.choice(GENRES),)) for _ in range(ctx.repeat)]
+
+
+@case('bookgenre.genres_of_book')
+def _genres_of_book(ctx):
+    def genres(book_id):
+        return list(Genre.select()
+                    .join(BookGenre)
+                    .where(BookGenre.book_id == book_id))
+    return [(genres, (ctx.random_id(Book),)) for _ in range(ctx.repeat)]
+
+
+@case('bookgenre.top_rated')
+def _top_rated(ctx):
+    return [(BookRating.top_rated, (ctx.rng.choice(GENRES),))
+            for _ in range(ctx.repeat)]
+
+
+@case('book.catalogue_page')
+def _catalogue_page(ctx):
+    return [(Book.catalogue_page, (None, None, 20, sort))
+            for sort in [ctx.rng.choice(['id', 'title', 'published_at'])
+                         for _ in range(ctx.repeat)]]
+
+
+def _get(ctx, url):
+    response = ctx.client.get(url)
+    if response.status_code != 200:
+        raise RuntimeError("GET %s returned %d" % (url, response.status_code))
+
+
+@case('route.view_publishers')
+def _route_publishers(ctx):
+    return [(_get, (ctx, '/admin/publisher?sort=%s' % sort))
+            for sort in [ctx.rng.choice(['id', 'name', 'city'])
+                         for _ in range(ctx.repeat)]]
+
+
+@case('route.update_publisher')
+def _route_update_publisher(ctx):
+    return [(_get, (ctx, '/admin/publisher/update/%d'
+                    % ctx.random_id(Publisher)))
+            for _ in range(ctx.repeat)]
+
+
+@case('route.catalogue')
+def _route_catalogue(ctx):
+    return [(_get, (ctx, '/catalogue?sort=title'))] * ctx.repeat
+
+
+@case('route.search')
+def _route_search(ctx):
+    return [(_get, (ctx, '/search?q=%s' % ctx.rng.choice(VOCABULARY[:500])))
+            for _ in range(ctx.repeat)]
+
+
+def _time(calls):
+    timings = []
+    for func, args in calls:
+        started = time.time()
+        func(*args)
+        timings.append(time.time() - started)
+    return timings
+
+
+def run_case(bench, ctx):
+    """Time one case and return its statistics in milliseconds."""
+    repeat = min(ctx.repeat, bench.repeat or ctx.repeat)
+    saved, ctx.repeat = ctx.repeat, repeat
+    try:
+        if bench.writes:
+            with db.transaction() as transaction:
+                timings = _time(bench.prepare(ctx))
+                transaction.rollback(False)
+        else:
+            timings = _time(bench.prepare(ctx))
+    finally:
+        ctx.repeat = saved
+    timings.sort()
+    total = sum(timings)
+    return dict(operations=len(timings),
+                median_ms=1000 * timings[len(timings) // 2],
+                p95_ms=1000 * timings[int(len(timings) * 0.95)],
+                ops_per_second=len(timings) / total if total else None)
+
+
+def run(repeat, names=None, progress=None):
+    """Run the cases and return the results with the library volumes.
+
+    names - only run cases whose name starts with one of these
+    """
+    ctx = Context(repeat)
+    results = {}
+    for bench in CASES:
+        if names and not any(bench.name.startswith(n) for n in names):
+            continue
+        if progress is not None:
+            progress(bench.name)
+        results[bench.name] = run_case(bench, ctx)
+    return dict(meta=dict(volumes=ctx.counts, repeat=repeat,
+                          python=platform.python_version(),
+                          sqlite=sqlite3.sqlite_version,
+                          created_at=datetime.datetime.now().isoformat()),
+                results=results)
+
+
+def compare(baseline, current, threshold):
+    """Return (name, baseline ms, current ms, change) for every case in
+    both runs, and the names of the cases that regressed.
+
+    A case regresses when its median got slower by more than threshold,
+    e.g. 0.2 for 20%.
+    """
+    rows, regressed = [], []
+    for name in sorted(current['results']):
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['median_ms']
+        after = current['results'][name]['median_ms']
+        change = (after - before) / before if before else 0.0
+        rows.append((name, before, after, change))
+        if change > threshold:
+            regressed.append(name)
+    return rows, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--path', required=True,
+                        help="SQLite file made by benchmarks.data")
+    parser.add_argument('--repeat', type=int, default=200,
+                        help="operations per case")
+    parser.add_argument('--case', action='append', default=None,
+                        help="only run cases starting with this name")
+    parser.add_argument('--output', default=None,
+                        help="write the JSON results to this file")
+    parser.add_argument('--compare', default=None,
+                        help="JSON results of a baseline run")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="allowed slowdown of the median, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+    open_sqlite(args.path)
+    results = run(args.repeat, args.case,
+                  progress=lambda name: print("Running %s" % name,
+                                              file=sys.stderr))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as results_file:
+            results_file.write(output + '\n')
+    else:
+        print(output)
+    if args.compare is None:
+        return 0
+
+    with open(args.compare) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline['meta']['volumes'] != results['meta']['volumes']:
+        print("Warning: the baseline ran on a library of another size",
+              file=sys.stderr)
+    rows, regressed = compare(baseline, results, args.threshold)
+    for name, before, after, change in rows:
+        print("%-30s %9.3f ms %9.3f ms %+7.1f%%%s"
+              % (name, before, after, 100 * change,
+                 '  REGRESSED' if name in regressed else ''))
+    if regressed:
+        print("%d of %d cases regressed more than %d%%"
+              % (len(regressed), len(rows), 100 * args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
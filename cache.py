@@ -0,0 +1,260 @@
+"""Read-through cache for primary key lookups and small listings.
+
+Rows are cached as plain dicts of column values, keyed on the table,
+a per-table version token and the primary key. Every write bumps the
+table's version token, so entries cached before the write can never be
+read again and simply age out. The version token lives in the same
+backend as the rows, which keeps invalidation correct when the backend
+is shared between processes.
+
+The version tokens start with the time of the write. Pages take their
+ETag from the versions in the database instead, see versions.py, since
+the tokens only change on the writes of processes sharing the backend.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """In-process cache with a size bound and per-entry expiry.
+
+    max_size - maximum amount of entries, the least recently used entry
+        is evicted when a new one does not fit
+    ttl - default seconds an entry stays valid, None keeps it forever
+    """
+
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, evictions=0, expirations=0)
+
+    def get(self, key):
+        """Return the cached value or None when missing or expired."""
+        with self._lock:
+            try:
+                expires, value = self._entries[key]
+            except KeyError:
+                self._stats['misses'] += 1
+                return None
+            if expires is not None and expires < time.time():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl=-1):
+        """Store value for ttl seconds, None never expires.
+
+        ttl - defaults to the ttl of the cache
+        """
+        if ttl == -1:
+            ttl = self.ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def incr(self, key, delta=1, ttl=-1):
+        """Add delta to a counter in one step and return the new count.
+
+        A missing or expired counter starts at delta and expires after
+        ttl, adding keeps its expiry.
+        """
+        if ttl == -1:
+            ttl = self.ttl
+        now = time.time()
+        with self._lock:
+            expires, value = self._entries.get(key, (None, None))
+            if value is None or expires is not None and expires < now:
+                expires, value = None if ttl is None else now + ttl, 0
+            self._entries[key] = (expires, value + delta)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+            return value + delta
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hits, misses, evictions, expirations and size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
+
+
+class MemcacheBackend(object):
+    """Adapter for a shared memcached style client.
+
+    client - obj with get(key), set(key, value, expire), delete(key) and
+        the counters add(key, value, expire, noreply) and incr(key, value),
+        such as a pymemcache client with a pickle serializer
+    prefix - prepended to every key so several apps can share a server
+    """
+
+    def __init__(self, client, prefix='lms:'):
+        self.client = client
+        self.prefix = prefix
+        self._stats = dict(hits=0, misses=0)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        self._stats['hits' if value is not None else 'misses'] += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ttl or 0)
+
+    def incr(self, key, delta=1, ttl=None):
+        """Add delta to a counter on the server and return the new count.
+
+        A missing counter is added at delta, when another process adds
+        it first the delta goes to theirs.
+        """
+        key = self.prefix + key
+        value = self.client.incr(key, delta)
+        if value is None:
+            if self.client.add(key, delta, ttl or 0, noreply=False):
+                return delta
+            value = self.client.incr(key, delta)
+        return int(value) if value is not None else delta
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def stats(self):
+        return dict(self._stats)
+
+
+class ModelCache(object):
+    """Read-through cache in front of peewee models.
+
+    backend - LRUCache, MemcacheBackend or any obj with the same
+        get/set/delete methods
+    ttl - seconds a cached row stays valid
+    """
+
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend if backend is not None else LRUCache()
+        self.ttl = ttl
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, invalidations=0)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _version(self, model):
+        key = 'version:%s' % model._meta.db_table
+        version = self.backend.get(key)
+        if version is None:
+            version = _new_version()
+            self.backend.set(key, version, None)
+        return version
+
+    def versions(self, models):
+        """Return the combined version of the tables of several models.
+
+        An evicted version is replaced by a new one, which only makes the
+        version change more often than the tables do.
+
+        return - (tag, timestamp) where tag changes on every write to one
+            of the tables and timestamp is the time of the last write
+        """
+        tokens = [self._version(model) for model in models]
+        tag = hashlib.sha1(' '.join(tokens).encode('ascii')).hexdigest()
+        return tag[:20], max(_version_time(token) for token in tokens)
+
+    def _key(self, model, suffix):
+        return '%s:%s:%s' % (model._meta.db_table, self._version(model),
+                             suffix)
+
+    def invalidate(self, model):
+        """Forget every cached row and listing of the model."""
+        self._count('invalidations')
+        self.backend.set('version:%s' % model._meta.db_table,
+                         _new_version(), None)
+
+    def get(self, model, pk_value):
+        """Return the row with the primary key, loading it on a miss.
+
+        raises - model.DoesNotExist when the row does not exist
+        """
+        if not self.enabled:
+            return model.get_by_id(pk_value)
+        key = self._key(model, pk_value)
+        data = self.backend.get(key)
+        if data is None:
+            self._count('misses')
+            instance = model.get_by_id(pk_value)
+            self.backend.set(key, dict(instance._data), self.ttl)
+            return instance
+        self._count('hits')
+        return _build(model, data)
+
+    def select_all(self, model):
+        """Return a list of all rows of a small table."""
+        if not self.enabled:
+            return list(model.select())
+        key = self._key(model, 'all')
+        rows = self.backend.get(key)
+        if rows is None:
+            self._count('misses')
+            instances = list(model.select().order_by(
+                model._meta.primary_key))
+            self.backend.set(key, [dict(i._data) for i in instances],
+                             self.ttl)
+            return instances
+        self._count('hits')
+        return [_build(model, data) for data in rows]
+
+    def stats(self):
+        """Return read-through hits, misses and invalidations.
+
+        The counters of the backend, e.g. evictions, are under 'backend'.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['backend'] = self.backend.stats()
+        return stats
+
+
+def _new_version():
+    return '%.6f-%s' % (time.time(), uuid.uuid4().hex)
+
+
+def _version_time(token):
+    try:
+        return float(token.split('-', 1)[0])
+    except ValueError:
+        # Token of an older release, without the time of the write.
+        return 0.0
+
+
+def _build(model, data):
+    # Fresh instance per read so callers can not change the cached copy.
+    instance = model(**data)
+    instance._prepare_instance()
+    return instance
+
+
+model_cache = ModelCache()
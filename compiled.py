@@ -0,0 +1,122 @@
+"""Compile the fixed queries of the models once.
+
+peewee builds a tree of nodes for every query and walks it to generate
+the SQL on every execution, which for a lookup by primary key costs
+more than running it. A CompiledQuery builds its query once per kind of
+database with a Slot for every value that changes between calls, keeps
+the SQL and the places of the slots, and afterwards only fills in the
+values before handing the SQL to execute_sql(). Routing, query hooks and
+profiling see the queries as before.
+
+Unchanging SQL text also lets the driver reuse its prepared statements
+where it can: sqlite3 keeps the last cached_statements statements of a
+connection prepared, keyed on their text. PyMySQL only speaks the text
+protocol of MySQL, there the Python side is all that is saved.
+"""
+from peewee import Model, Passthrough, Proxy
+
+
+class Slot(object):
+    """Place of a value given when a compiled query runs.
+
+    name - keyword of the value
+    conv - turns the value into its column value, e.g. field.db_value
+    """
+
+    __slots__ = ('name', 'conv')
+
+    def __init__(self, name, conv=None):
+        self.name = name
+        self.conv = conv
+
+
+def slot(name, field=None):
+    """Return a query parameter filled in with the value of name.
+
+    field - field whose db_value() converts the value
+    """
+    # A Passthrough, a Param would be converted by the field it is
+    # compared with.
+    return Passthrough(Slot(name, field.db_value if field is not None
+                            else None))
+
+
+class CompiledQuery(object):
+    """A query of a model built and compiled once per kind of database
+    and shape.
+
+    build - function called with the model and the shape, returning the
+        peewee query with slot() parameters in place of the values
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self._compiled = {}
+
+    def compile(self, model, *shape):
+        """Return (query, sql, params) of a shape, params holds a Slot
+        where a value goes.
+        """
+        database = model._meta.database
+        if isinstance(database, Proxy):
+            database = database.obj
+        # The SQL of SQLite and MySQL differs in quotes and placeholders,
+        # and the database of a model may be swapped, e.g. with Using.
+        key = (model, type(database)) + shape
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            query = self.build(model, *shape)
+            compiled = self._compiled[key] = (query,) + query.sql()
+        return compiled
+
+    def execute(self, model, shape, values, require_commit=True):
+        """Run the query of a shape with values for its slots.
+
+        shape - tuple passed to build after the model, e.g. the names of
+            the changed fields
+        values - dict of slot name to value
+        return - the cursor
+        """
+        sql, params = self.sql(model, values, shape)
+        return model._meta.database.execute_sql(sql, params,
+                                                require_commit)
+
+    def sql(self, model, values, shape=()):
+        """Return the SQL and parameters of a shape with values, like
+        query.sql() does.
+        """
+        _, sql, params = self.compile(model, *shape)
+        return sql, [_fill(param, values) for param in params]
+
+    def rows(self, model, values, shape=()):
+        """Return the rows of a select query as tuples of raw values."""
+        return self.execute(model, shape, values, False).fetchall()
+
+    def instances(self, model, values, shape=()):
+        """Return the rows of a select query as model instances."""
+        query = self.compile(model, *shape)[0]
+        columns = [(field.name, field.python_value)
+                   for field in query._select]
+        instances = []
+        for row in self.rows(model, values, shape):
+            instance = model()
+            for (name, conv), value in zip(columns, row):
+                instance._data[name] = conv(value)
+            instance._prepare_instance()
+            instances.append(instance)
+        return instances
+
+    def rowcount(self, model, values, shape=()):
+        """Return the amount of rows an UPDATE or DELETE matched."""
+        return model._meta.database.rows_affected(
+            self.execute(model, shape, values))
+
+
+def _fill(param, values):
+    if not isinstance(param, Slot):
+        return param
+    value = values[param.name]
+    if isinstance(value, Model):
+        # As peewee does for a model compared with its key.
+        value = value._get_pk_value()
+    return param.conv(value) if param.conv is not None else value
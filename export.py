@@ -0,0 +1,407 @@
+"""Stream books and lends to CSV, JSON Lines or a columnar file.
+
+Run "python export.py books books.csv" to export the development db,
+see "python export.py --help" for the options.
+
+Rows are read from a server side cursor in chunks and turned into
+namedtuples, never into model instances, and every chunk is written
+before the next one is fetched. Memory stays flat however many rows the
+table has. With --workers the primary key range is split into equal
+parts that are exported by forked processes and joined in id order.
+
+The columnar format holds a row group per chunk, with an array per
+column in native byte order, like catalogue snapshots:
+
+    magic, uint32 schema length, schema as JSON [[name, kind], ...]
+    per row group: uint32 rows, then per column:
+        uint32 null mask length, uint32 data length, mask, data
+    uint32 0 ends the file
+
+The null mask has a byte per row and is left out when no value is null.
+Integers are int64, floats float64, dates int32 days since 1970-01-01
+and text a uint32 byte length per row followed by the UTF-8 bytes.
+"""
+import argparse
+import array
+import collections
+import csv
+import datetime
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import struct
+import time
+
+from models import *
+from pool import server_side_cursors
+
+MAGIC = b'LMSCOL1\n'
+TYPECODES = dict(int='q', float='d', date='i')
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+CHUNK_SIZE = 10000
+
+
+class Export(object):
+    """A query that can be exported.
+
+    model - model whose primary key orders and partitions the rows
+    query - function returning the select query of the columns
+    columns - list of (name, kind) tuples, kind is int, float, date or
+        text
+    row_type - namedtuple the rows are returned as
+    """
+
+    def __init__(self, model, query, columns):
+        self.model = model
+        self.query = query
+        self.columns = columns
+        self.row_type = collections.namedtuple(
+            model.__name__ + 'Row', [name for name, _ in columns])
+
+
+def _books():
+    return (Book.select(Book.id, Book.isbn, Book.title, Author.name,
+                        Publisher.name, Publisher.city, Book.amount_of_pages,
+                        Book.book_print, Book.edition, Book.published_at,
+                        Book.language, Book.book_type, Book.amount,
+                        Book.available, Book.summary)
+            .join(Author)
+            .switch(Book)
+            .join(Publisher))
+
+
+def _lends():
+    return (Lend.select(Lend.id, Lend.book_id, Book.isbn, Lend.customer_id,
+                        Lend.return_date, Lend.returned_at)
+            .join(Book, on=(Lend.book_id == Book.id)))
+
+
+EXPORTS = dict(
+    books=Export(Book, _books, [
+        ('id', 'int'), ('isbn', 'text'), ('title', 'text'),
+        ('author', 'text'), ('publisher', 'text'),
+        ('publisher_city', 'text'), ('amount_of_pages', 'int'),
+        ('book_print', 'int'), ('edition', 'int'), ('published_at', 'date'),
+        ('language', 'text'), ('book_type', 'text'), ('amount', 'int'),
+        ('available', 'int'), ('summary', 'text')]),
+    lends=Export(Lend, _lends, [
+        ('id', 'int'), ('book_id', 'int'), ('isbn', 'text'),
+        ('customer_id', 'int'), ('return_date', 'date'),
+        ('returned_at', 'date')]))
+
+
+def iter_chunks(kind, start=None, stop=None, chunk_size=CHUNK_SIZE):
+    """Yield the rows of an export as lists of namedtuples, in primary
+    key order.
+
+    kind - name of an export in EXPORTS
+    start - first primary key to export, None from the lowest
+    stop - primary key to stop before, None up to the highest
+    """
+    export = EXPORTS[kind]
+    pk = export.model._meta.primary_key
+    query = export.query()
+    if start is not None:
+        query = query.where(pk >= start)
+    if stop is not None:
+        query = query.where(pk < stop)
+    sql, params = query.order_by(pk).sql()
+    # The cursor class is picked when the query runs, so the rest of the
+    # thread keeps buffered cursors while this one is read.
+    with server_side_cursors():
+        cursor = db.execute_sql(sql, params, require_commit=False)
+    make = export.row_type._make
+    try:
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield [make(row) for row in rows]
+    finally:
+        cursor.close()
+
+
+def _json_default(value):
+    # Dates come back as date objects from MySQL, strings from SQLite.
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def _days(value):
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        value = datetime.date(int(value[:4]), int(value[5:7]),
+                              int(value[8:10]))
+    return value.toordinal() - EPOCH
+
+
+class CsvWriter(object):
+    """Writes rows as CSV with a header line, None as an empty field."""
+
+    content_type = 'text/csv; charset=utf-8'
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def _lines(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        return buffer.getvalue().encode('utf-8')
+
+    def header(self):
+        return self._lines([[name for name, _ in self.columns]])
+
+    def chunk(self, rows):
+        return self._lines(rows)
+
+    def footer(self):
+        return b''
+
+
+class JsonLinesWriter(object):
+    """Writes a JSON object per row, dates as YYYY-MM-DD."""
+
+    content_type = 'application/x-ndjson'
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def header(self):
+        return b''
+
+    def chunk(self, rows):
+        return ''.join(json.dumps(row._asdict(), default=_json_default) +
+                       '\n' for row in rows).encode('utf-8')
+
+    def footer(self):
+        return b''
+
+
+class ColumnarWriter(object):
+    """Writes a row group of column arrays per chunk, see the module
+    docstring for the layout.
+    """
+
+    content_type = 'application/octet-stream'
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def header(self):
+        schema = json.dumps(self.columns).encode('utf-8')
+        return MAGIC + struct.pack('=I', len(schema)) + schema
+
+    def chunk(self, rows):
+        parts = [struct.pack('=I', len(rows))]
+        for index, (_, kind) in enumerate(self.columns):
+            values = [row[index] for row in rows]
+            nulls = b''
+            if None in values:
+                nulls = bytes(value is None for value in values)
+            if kind == 'text':
+                encoded = [(value or '').encode('utf-8') for value in values]
+                data = array.array('I', map(len, encoded)).tobytes() + \
+                    b''.join(encoded)
+            else:
+                if kind == 'date':
+                    values = [_days(value) for value in values]
+                elif nulls:
+                    values = [value or 0 for value in values]
+                data = array.array(TYPECODES[kind], values).tobytes()
+            parts.append(struct.pack('=II', len(nulls), len(data)))
+            parts.append(nulls)
+            parts.append(data)
+        return b''.join(parts)
+
+    def footer(self):
+        return struct.pack('=I', 0)
+
+
+WRITERS = dict(csv=CsvWriter, jsonl=JsonLinesWriter,
+               columnar=ColumnarWriter)
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise ValueError("Columnar file is truncated")
+    return data
+
+
+def read_row_groups(fileobj):
+    """Read a columnar export.
+
+    fileobj - file opened in binary mode
+    return - (list of (name, kind) tuples, generator of dicts of column
+        name to its list of values per row group)
+    raises - ValueError when fileobj is not a columnar export
+    """
+    if fileobj.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a columnar export")
+    size, = struct.unpack('=I', _read_exactly(fileobj, 4))
+    columns = [tuple(column) for column in
+               json.loads(_read_exactly(fileobj, size).decode('utf-8'))]
+
+    def groups():
+        while True:
+            rows, = struct.unpack('=I', _read_exactly(fileobj, 4))
+            if not rows:
+                return
+            group = {}
+            for name, kind in columns:
+                null_size, data_size = struct.unpack(
+                    '=II', _read_exactly(fileobj, 8))
+                nulls = _read_exactly(fileobj, null_size)
+                data = _read_exactly(fileobj, data_size)
+                if kind == 'text':
+                    lengths = array.array('I', data[:4 * rows])
+                    values, offset = [], 4 * rows
+                    for length in lengths:
+                        values.append(
+                            data[offset:offset + length].decode('utf-8'))
+                        offset += length
+                else:
+                    values = array.array(TYPECODES[kind], data).tolist()
+                    if kind == 'date':
+                        values = [datetime.date.fromordinal(value + EPOCH)
+                                  for value in values]
+                if nulls:
+                    values = [None if null else value
+                              for null, value in zip(nulls, values)]
+                group[name] = values
+            yield group
+
+    return columns, groups()
+
+
+def stream(kind, fmt, chunk_size=CHUNK_SIZE):
+    """Yield an export as chunks of bytes, e.g. for a response."""
+    writer = WRITERS[fmt](EXPORTS[kind].columns)
+    yield writer.header()
+    for rows in iter_chunks(kind, chunk_size=chunk_size):
+        yield writer.chunk(rows)
+    yield writer.footer()
+
+
+def partitions(kind, parts):
+    """Split the primary keys of an export into ranges of equal width.
+
+    Gaps in the keys make some ranges hold fewer rows than others.
+
+    return - list of (start, stop) tuples, stop is excluded, empty for
+        an empty table
+    """
+    model = EXPORTS[kind].model
+    pk = model._meta.primary_key
+    low, high = model.select(fn.MIN(pk), fn.MAX(pk)).scalar(as_tuple=True)
+    if low is None:
+        return []
+    width = -(-(high - low + 1) // parts)
+    return [(start, min(start + width, high + 1))
+            for start in range(low, high + 1, width)]
+
+
+def _export_range(job):
+    # Writes the rows of one range without header or footer, so the
+    # parts can be joined in order.
+    kind, fmt, start, stop, path, chunk_size = job
+    writer = WRITERS[fmt](EXPORTS[kind].columns)
+    rows = 0
+    with open(path, 'wb') as out:
+        for chunk in iter_chunks(kind, start, stop, chunk_size):
+            out.write(writer.chunk(chunk))
+            rows += len(chunk)
+    return rows
+
+
+def _export_range_worker(job):
+    try:
+        return _export_range(job)
+    finally:
+        if not db.is_closed():
+            db.close()
+
+
+def export(kind, path, fmt='csv', workers=1, chunk_size=CHUNK_SIZE):
+    """Export to a file, replacing the one at path once it is complete.
+
+    With more than one worker the connections of this process are closed
+    first, the forked workers must not share them. Each worker reads
+    its range on its own, so the parts may see different moments of the
+    table. Processes that may not have children, e.g. in a
+    multiprocessing pool, export the ranges one after the other.
+
+    kind - name of an export in EXPORTS
+    fmt - name of a writer in WRITERS
+    workers - processes exporting a range of primary keys each
+    return - amount of rows written
+    """
+    writer = WRITERS[fmt](EXPORTS[kind].columns)
+    temporary = path + '.tmp'
+    if workers <= 1:
+        rows = 0
+        with open(temporary, 'wb') as out:
+            out.write(writer.header())
+            for chunk in iter_chunks(kind, chunk_size=chunk_size):
+                out.write(writer.chunk(chunk))
+                rows += len(chunk)
+            out.write(writer.footer())
+        os.replace(temporary, path)
+        return rows
+
+    jobs = [(kind, fmt, start, stop, '%s.part%d' % (path, number),
+             chunk_size)
+            for number, (start, stop) in
+            enumerate(partitions(kind, workers))]
+    try:
+        if multiprocessing.current_process().daemon:
+            counts = [_export_range(job) for job in jobs]
+        else:
+            if not db.is_closed():
+                db.close()
+            db.close_all()
+            context = multiprocessing.get_context('fork')
+            with context.Pool(min(workers, len(jobs) or 1)) as pool:
+                counts = pool.map(_export_range_worker, jobs)
+        with open(temporary, 'wb') as out:
+            out.write(writer.header())
+            for job in jobs:
+                with open(job[4], 'rb') as part:
+                    shutil.copyfileobj(part, out)
+            out.write(writer.footer())
+        os.replace(temporary, path)
+    finally:
+        for job in jobs:
+            if os.path.exists(job[4]):
+                os.remove(job[4])
+    return sum(counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('kind', choices=sorted(EXPORTS))
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='csv')
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes exporting a range of ids each")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="rows fetched and written at once")
+    args = parser.parse_args(argv)
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+    started = time.time()
+    rows = export(args.kind, args.path, args.format, args.workers,
+                  args.chunk_size)
+    print("Exported %d rows to %s in %.1fs"
+          % (rows, args.path, time.time() - started))
+
+
+if __name__ == '__main__':
+    main()
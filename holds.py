@@ -0,0 +1,83 @@
+"""Expire the ready holds nobody collected.
+
+Run "python holds.py" daily, e.g. from cron, to expire the holds of the
+development db whose pickup window is over and hand their copies to the
+next holders.
+
+Expired holds are read in batches ordered on (ready_until, id) from the
+(status, ready_until, id) index declared on Hold.Meta, so only the ready
+holds are scanned. Every batch is expired in a transaction of its own
+with Hold.expire(), which leaves a hold alone that was collected or
+cancelled meanwhile.
+"""
+import argparse
+import datetime
+import os
+
+from models import *
+
+
+def iter_expired_batches(today=None, batch_size=1000):
+    """Yield lists of (hold id, book id) of the ready holds whose
+    pickup window ended before today.
+
+    Batches follow each other in (ready_until, hold id) order.
+    """
+    today = today or datetime.date.today()
+    expired = (Hold.status == 'ready') & (Hold.ready_until < today)
+    last = None
+    while True:
+        query = (Hold.select(Hold.id, Hold.book_id, Hold.ready_until)
+                 .where(expired))
+        if last is not None:
+            ready_until, hold_id = last
+            query = query.where((Hold.ready_until > ready_until) |
+                                ((Hold.ready_until == ready_until) &
+                                 (Hold.id > hold_id)))
+        rows = list(query.order_by(Hold.ready_until, Hold.id)
+                    .limit(batch_size)
+                    .tuples())
+        if rows:
+            yield [row[:2] for row in rows]
+        if len(rows) < batch_size:
+            return
+        last = (rows[-1][2], rows[-1][0])
+
+
+def sweep(today=None, batch_size=1000):
+    """Expire the uncollected ready holds, their copies go to the next
+    holders.
+
+    return - amount of expired holds
+    """
+    today = today or datetime.date.today()
+    expired = 0
+    for batch in iter_expired_batches(today, batch_size):
+        with db.atomic():
+            for hold_id, _ in batch:
+                if Hold.expire(hold_id, today):
+                    expired += 1
+    return expired
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Expire the ready holds nobody collected.")
+    parser.add_argument('--date', default=None,
+                        help="sweep as of this YYYY-MM-DD date")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+    today = datetime.date.today()
+    if args.date:
+        today = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+    print("%d holds expired" % sweep(today, args.batch_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,413 @@
+"""Bulk import of publishers, authors and books from CSV or JSON Lines.
+
+Run "python importer.py books catalogue.csv" to import a file into the
+development db, see "python importer.py --help" for the options.
+
+Rows are validated with the same rules as the add_* methods and written
+with multi-row INSERTs, committing once per chunk instead of once per
+row. Books refer to their author and publisher by name and may list
+genres, separated by ";" in CSV files or as a list in JSON Lines files.
+Unknown genres are created, unknown authors and publishers are rejected.
+"""
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from models import *
+from cache import model_cache
+
+KINDS = ('publishers', 'authors', 'books')
+FORMATS = ('csv', 'jsonl')
+# SQLite refuses statements with more bound parameters than this.
+SQLITE_MAX_VARIABLES = 999
+SMALLINT_MAX = 32767
+
+
+class RejectedRow(ValueError):
+    """Raised when a row does not pass validation."""
+
+
+class ImportReport(object):
+    """Outcome of an import.
+
+    inserted - amount of rows written
+    rejects - list of (line number, reason) tuples
+    elapsed - seconds the import took so far
+    """
+
+    def __init__(self):
+        self.inserted = 0
+        self.rejects = []
+        self.elapsed = 0.0
+        self._started = time.time()
+
+    def reject(self, line_no, reason):
+        self.rejects.append((line_no, reason))
+
+    def tick(self):
+        self.elapsed = time.time() - self._started
+
+    @property
+    def rows_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.inserted / self.elapsed
+
+    def __str__(self):
+        return ("Imported %d rows, rejected %d rows in %.1fs (%d rows/sec)"
+                % (self.inserted, len(self.rejects), self.elapsed,
+                   self.rows_per_second))
+
+
+class LookupCache(object):
+    """In-memory map from a text column to primary keys.
+
+    Misses are resolved with one query per batch of values. When several
+    rows share the same value the lowest id wins.
+
+    field - the model field to look values up by
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.model = field.model_class
+        self._ids = {}
+
+    def resolve(self, values):
+        """Load the ids of all values that are not cached yet."""
+        pk = self.model._meta.primary_key
+        missing = list(set(v for v in values if v and v not in self._ids))
+        for start in range(0, len(missing), 500):
+            part = missing[start:start + 500]
+            query = (self.model.select(pk, self.field)
+                     .where(self.field << part)
+                     .order_by(pk.desc())
+                     .tuples())
+            for pk_value, value in query:
+                self._ids[value] = pk_value
+            for value in part:
+                self._ids.setdefault(value, None)
+
+    def get(self, value):
+        return self._ids.get(value)
+
+    def add(self, value, pk_value):
+        self._ids[value] = pk_value
+
+
+def read_rows(fileobj, fmt):
+    """Yield (line number, row dict) pairs from a CSV or JSON Lines file.
+
+    Lines that can not be parsed are yielded with None as row.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(fileobj)
+        for row in reader:
+            yield reader.line_num, row
+    elif fmt == 'jsonl':
+        for line_no, line in enumerate(fileobj, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_no, row if isinstance(row, dict) else None
+    else:
+        raise ValueError("Unknown format %r" % fmt)
+
+
+def _text(row, key, required=True):
+    value = row.get(key)
+    if value is None or value == '':
+        if required:
+            raise RejectedRow("%s is required" % key)
+        return ''
+    return str(value)
+
+
+def _small_int(row, key, default=None):
+    value = row.get(key)
+    if value is None or value == '':
+        if default is None:
+            raise RejectedRow("%s is required" % key)
+        return default
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise RejectedRow("%s should be an integer" % key)
+    if not 0 <= number <= SMALLINT_MAX:
+        raise RejectedRow("%s is out of range" % key)
+    return number
+
+
+def _date(row, key):
+    try:
+        return datetime.datetime.strptime(_text(row, key),
+                                          '%Y-%m-%d').date()
+    except ValueError:
+        raise RejectedRow("%s should be a YYYY-MM-DD date" % key)
+
+
+def _genres(row):
+    value = row.get('genres') or []
+    if not isinstance(value, list):
+        value = str(value).split(';')
+    return [str(genre).strip() for genre in value if str(genre).strip()]
+
+
+class Importer(object):
+    """Streams rows of one kind into the database.
+
+    kind - one of KINDS
+    batch_size - rows per multi-row INSERT
+    chunk_size - rows per transaction
+    """
+
+    def __init__(self, kind, batch_size=500, chunk_size=10000):
+        if kind not in KINDS:
+            raise ValueError("Unknown kind %r" % kind)
+        self.kind = kind
+        self.batch_size = batch_size
+        self.chunk_size = max(chunk_size, batch_size)
+        self.authors = LookupCache(Author.name)
+        self.publishers = LookupCache(Publisher.name)
+        self.genres = LookupCache(Genre.genre)
+
+    def run(self, rows, progress=None):
+        """Import (line number, row dict) pairs.
+
+        rows - iterable of (line number, row dict) pairs, see read_rows()
+        progress - optional callable called with the report after each
+            committed chunk
+        return - an ImportReport obj
+        """
+        report = ImportReport()
+        rows = iter(rows)
+        batches_per_chunk = self.chunk_size // self.batch_size
+        database = Book._meta.database
+        done = False
+        while not done:
+            done = True
+            with database.atomic():
+                for _ in range(batches_per_chunk):
+                    batch = list(islice(rows, self.batch_size))
+                    if not batch:
+                        break
+                    done = False
+                    self._write_batch(batch, report)
+            # After the commit, so readers can not cache the old rows.
+            for model in (Publisher, Author, Book, Genre, BookGenre):
+                model_cache.invalidate(model)
+            report.tick()
+            if progress and not done:
+                progress(report)
+        return report
+
+    def _write_batch(self, batch, report):
+        if self.kind == 'publishers':
+            self._write_simple(Publisher, self._clean_publisher,
+                               batch, report)
+        elif self.kind == 'authors':
+            self._write_simple(Author, self._clean_author, batch, report)
+        else:
+            self._write_books(batch, report)
+
+    def _clean_rows(self, clean, batch, report):
+        cleaned = []
+        for line_no, row in batch:
+            try:
+                if row is None:
+                    raise RejectedRow("malformed line")
+                cleaned.append((line_no, clean(row)))
+            except RejectedRow as exc:
+                report.reject(line_no, str(exc))
+        return cleaned
+
+    def _write_simple(self, model, clean, batch, report):
+        cleaned = self._clean_rows(clean, batch, report)
+        report.inserted += self._insert(model, cleaned, report)
+
+    def _clean_publisher(self, row):
+        name, city = _text(row, 'name'), _text(row, 'city')
+        if not Publisher.valid_input(name, city):
+            raise RejectedRow("name or city is too long")
+        return dict(name=name, city=city)
+
+    def _clean_author(self, row):
+        name = _text(row, 'name')
+        if not Author.valid_input(name):
+            raise RejectedRow("name is too long")
+        return dict(name=name,
+                    biography=_text(row, 'biography', required=False),
+                    age=_small_int(row, 'age'))
+
+    def _clean_book(self, row):
+        isbn = _text(row, 'isbn')
+        title = _text(row, 'title')
+        language = _text(row, 'language')
+        book_type = _text(row, 'book_type')
+        amount = _small_int(row, 'amount', default=0)
+        if not Book.valid_input(isbn, title, language, book_type):
+            raise RejectedRow("isbn, title, language or book_type "
+                              "is too long")
+        author_id = self.authors.get(_text(row, 'author'))
+        if author_id is None:
+            raise RejectedRow("unknown author %r" % row['author'])
+        publisher_id = self.publishers.get(_text(row, 'publisher'))
+        if publisher_id is None:
+            raise RejectedRow("unknown publisher %r" % row['publisher'])
+        return dict(isbn=isbn,
+                    title=title,
+                    author_id=author_id,
+                    publisher_id=publisher_id,
+                    amount_of_pages=_small_int(row, 'amount_of_pages'),
+                    book_print=_small_int(row, 'book_print'),
+                    edition=_small_int(row, 'edition'),
+                    summary=_text(row, 'summary', required=False),
+                    published_at=_date(row, 'published_at'),
+                    language=language,
+                    book_type=book_type,
+                    amount=amount,
+                    available=amount)
+
+    def _write_books(self, batch, report):
+        rows = [row for _, row in batch if row]
+        self.authors.resolve(str(row.get('author') or '') for row in rows)
+        self.publishers.resolve(str(row.get('publisher') or '')
+                                for row in rows)
+
+        cleaned = self._clean_rows(self._clean_book, batch, report)
+        isbns = [data['isbn'] for _, data in cleaned]
+        taken = set(isbn for isbn, in Book.select(Book.isbn)
+                    .where(Book.isbn << isbns).tuples()) if isbns else set()
+        unique = []
+        for line_no, data in cleaned:
+            if data['isbn'] in taken:
+                report.reject(line_no, "duplicate isbn %s" % data['isbn'])
+                continue
+            taken.add(data['isbn'])
+            unique.append((line_no, data))
+        report.inserted += self._insert(Book, unique, report)
+
+        genres_by_isbn = {}
+        for _, row in batch:
+            if row and row.get('genres'):
+                genres_by_isbn[_text(row, 'isbn', required=False)] = \
+                    _genres(row)
+        linked = [data['isbn'] for _, data in unique
+                  if genres_by_isbn.get(data['isbn'])]
+        if linked:
+            self._link_genres(linked, genres_by_isbn)
+
+    def _link_genres(self, isbns, genres_by_isbn):
+        names = set(g for isbn in isbns for g in genres_by_isbn[isbn])
+        self.genres.resolve(names)
+        new = [name for name in names if self.genres.get(name) is None]
+        if new:
+            self._insert_many(Genre, [dict(genre=name) for name in new])
+            for pk_value, name in (Genre.select(Genre.id, Genre.genre)
+                                   .where(Genre.genre << new).tuples()):
+                self.genres.add(name, pk_value)
+        book_ids = dict((isbn, pk_value) for pk_value, isbn in
+                        Book.select(Book.id, Book.isbn)
+                        .where(Book.isbn << isbns).tuples())
+        links = [dict(book_id=book_ids[isbn],
+                      genre_id=self.genres.get(name))
+                 for isbn in isbns if isbn in book_ids
+                 for name in set(genres_by_isbn[isbn])]
+        self._insert_many(BookGenre, links)
+
+    def _insert(self, model, cleaned, report):
+        """Insert cleaned rows, rejecting only the rows that fail.
+
+        return - amount of inserted rows
+        """
+        if not cleaned:
+            return 0
+        database = model._meta.database
+        try:
+            with database.atomic():
+                self._insert_many(model, [data for _, data in cleaned])
+            return len(cleaned)
+        except IntegrityError:
+            pass
+        # Fall back to single inserts to find the offending rows.
+        inserted = 0
+        for line_no, data in cleaned:
+            try:
+                with database.atomic():
+                    model.insert(**data).execute()
+                inserted += 1
+            except IntegrityError as exc:
+                report.reject(line_no, str(exc))
+        return inserted
+
+    def _insert_many(self, model, rows):
+        size = self.batch_size
+        database = getattr(model._meta.database, 'obj', model._meta.database)
+        if isinstance(database, SqliteDatabase) and rows:
+            size = min(size, SQLITE_MAX_VARIABLES // len(rows[0]))
+        for start in range(0, len(rows), size):
+            model.insert_many(rows[start:start + size]).execute()
+
+
+def import_rows(kind, rows, batch_size=500, chunk_size=10000,
+                progress=None):
+    """Import (line number, row dict) pairs of the given kind.
+
+    return - an ImportReport obj
+    """
+    importer = Importer(kind, batch_size=batch_size, chunk_size=chunk_size)
+    return importer.run(rows, progress=progress)
+
+
+def import_file(kind, path, fmt=None, **kwargs):
+    """Import a CSV or JSON Lines file of the given kind.
+
+    fmt - 'csv' or 'jsonl', guessed from the file extension when None
+    return - an ImportReport obj
+    """
+    if fmt is None:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    with io.open(path, encoding='utf-8', newline='') as fileobj:
+        return import_rows(kind, read_rows(fileobj, fmt), **kwargs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Bulk import publishers, authors or books.")
+    parser.add_argument('kind', choices=KINDS)
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=FORMATS, default=None)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+
+    def progress(report):
+        print(report, file=sys.stderr)
+
+    report = import_file(args.kind, args.path, args.format,
+                         batch_size=args.batch_size,
+                         chunk_size=args.chunk_size,
+                         progress=progress)
+    for line_no, reason in report.rejects:
+        print("line %d: %s" % (line_no, reason), file=sys.stderr)
+    print(report)
+    return 1 if report.rejects else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,238 @@
+"""Hooks into the queries a database executes.
+
+Hooks are called after every query with the SQL, its parameters and the
+seconds it took. A thread can also collect a QueryProfile of the queries
+it runs, e.g. for a sampled request. Without hooks or a profile
+execute_sql() only checks for them, so the instrumentation costs next
+to nothing when unused.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from pool import PooledMySQLDatabase, PooledSqliteDatabase
+
+slow_query_logger = logging.getLogger('slow_queries')
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+
+class QueryProfile(object):
+    """Queries run by one request or other unit of work.
+
+    queries - amount of queries
+    seconds - total seconds spent waiting on the database
+    rows - amount of rows fetched from the results
+    slowest - (seconds, sql, params) of the slowest query or None
+    """
+
+    __slots__ = ('queries', 'seconds', 'rows', 'slowest')
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.slowest = None
+
+    def record(self, sql, params, seconds):
+        self.queries += 1
+        self.seconds += seconds
+        if self.slowest is None or seconds > self.slowest[0]:
+            self.slowest = (seconds, sql, params)
+
+
+class RowCountingCursor(object):
+    """Cursor wrapper that counts the fetched rows in a profile."""
+
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._profile.rows += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._profile.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._profile.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._profile.rows += 1
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class QueryHooksMixin(object):
+    """Mixin for peewee databases that calls hooks for each query."""
+
+    def __init__(self, *args, **kwargs):
+        self._query_hooks = []
+        self._profiles = threading.local()
+        super(QueryHooksMixin, self).__init__(*args, **kwargs)
+
+    def add_query_hook(self, hook):
+        """Call hook(sql, params, seconds) after every query."""
+        self._query_hooks.append(hook)
+
+    def remove_query_hook(self, hook):
+        self._query_hooks.remove(hook)
+
+    def start_profile(self, profile=None):
+        """Collect a QueryProfile of the queries this thread runs.
+
+        profile - QueryProfile to add to, e.g. of a request whose queries
+            run on several threads, a new one by default
+        """
+        if profile is None:
+            profile = QueryProfile()
+        self._profiles.current = profile
+        return profile
+
+    def stop_profile(self):
+        """Stop collecting, return the profile or None when not started."""
+        profile = getattr(self._profiles, 'current', None)
+        self._profiles.current = None
+        return profile
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        profile = getattr(self._profiles, 'current', None)
+        if not self._query_hooks and profile is None:
+            return super(QueryHooksMixin, self).execute_sql(
+                sql, params, require_commit)
+        started = time.time()
+        cursor = super(QueryHooksMixin, self).execute_sql(
+            sql, params, require_commit)
+        elapsed = time.time() - started
+        for hook in self._query_hooks:
+            hook(sql, params, elapsed)
+        if profile is not None:
+            profile.record(sql, params, elapsed)
+            cursor = RowCountingCursor(cursor, profile)
+        return cursor
+
+
+class InstrumentedMySQLDatabase(QueryHooksMixin, PooledMySQLDatabase):
+    pass
+
+
+class InstrumentedSqliteDatabase(QueryHooksMixin, PooledSqliteDatabase):
+    pass
+
+
+class SlowQueryLog(object):
+    """Query hook that logs every query slower than threshold seconds.
+
+    Register it with db.add_query_hook(SlowQueryLog(0.5)).
+    """
+
+    def __init__(self, threshold, logger=slow_query_logger):
+        self.threshold = threshold
+        self.logger = logger
+
+    def __call__(self, sql, params, seconds):
+        if seconds >= self.threshold:
+            self.logger.warning("Slow query took %.3fs: %s %r", seconds,
+                                sql, params)
+
+
+class Histogram(object):
+    """Counts of observed values per bucket, with their sum."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return (upper bound, count of values up to it) pairs.
+
+        The last pair has None as bound and holds every value.
+        """
+        total, pairs = 0, []
+        for bound, count in zip(list(self.buckets) + [None], self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+class RouteMetrics(object):
+    """Request latency and database time histograms per route.
+
+    Latency is recorded for every request, the database figures only for
+    requests that were profiled.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._db_time = {}
+        self._queries = {}
+        self._rows = {}
+
+    def observe(self, route, seconds, profile=None):
+        with self._lock:
+            if route not in self._latency:
+                self._latency[route] = Histogram(self.buckets)
+            self._latency[route].observe(seconds)
+            if profile is None:
+                return
+            if route not in self._db_time:
+                self._db_time[route] = Histogram(self.buckets)
+            self._db_time[route].observe(profile.seconds)
+            self._queries[route] = (self._queries.get(route, 0) +
+                                    profile.queries)
+            self._rows[route] = self._rows.get(route, 0) + profile.rows
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, histograms, description in [
+                    ('http_request_duration_seconds', self._latency,
+                     'Time to handle a request'),
+                    ('db_request_duration_seconds', self._db_time,
+                     'Time a profiled request spent in the database')]:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s histogram' % name)
+                for route in sorted(histograms):
+                    histogram = histograms[route]
+                    for bound, count in histogram.cumulative():
+                        le = '+Inf' if bound is None else repr(bound)
+                        lines.append('%s_bucket{route="%s",le="%s"} %d'
+                                     % (name, route, le, count))
+                    lines.append('%s_sum{route="%s"} %r'
+                                 % (name, route, histogram.sum))
+                    lines.append('%s_count{route="%s"} %d'
+                                 % (name, route, histogram.count))
+            for name, counters, description in [
+                    ('db_queries_total', self._queries,
+                     'Queries of profiled requests'),
+                    ('db_rows_total', self._rows,
+                     'Rows fetched by profiled requests')]:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s counter' % name)
+                for route in sorted(counters):
+                    lines.append('%s{route="%s"} %d'
+                                 % (name, route, counters[route]))
+        return '\n'.join(lines) + '\n'
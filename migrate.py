@@ -0,0 +1,474 @@
+"""Versioned schema migrations for the library databases.
+
+Migrations live in the migrations directory as numbered modules, e.g.
+migrations/0002_book_available.py, each with an up(migrator) function.
+Applied migrations are recorded in the migrationhistory table, so every
+migration runs once per database and existing data is kept.
+
+The Migrator operations are written to keep tables available: indexes
+and columns are added with online DDL on MySQL, and new NOT NULL columns
+are added nullable first and filled in small batches, each in its own
+transaction, before the constraint is set. Migrations only go forward,
+a mistake is fixed with a new migration.
+
+Run "python migrate.py --help" for the commands.
+"""
+import argparse
+import copy
+import datetime
+import importlib.util
+import os
+import re
+import time
+
+from peewee import *
+from playhouse.migrate import SchemaMigrator
+from models import *
+from cache import model_cache
+from routing import RoutingSqliteDatabase
+from search import create_search_index
+from snapshot import create_change_log
+from rollups import create_lend_log
+from versions import create_version_log
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'migrations')
+MIGRATION_FILE = re.compile(r'^(\d{4})_(\w+)\.py$')
+
+DATABASES = {
+    'development': dict(user='development', password='devpassword',
+                        database='devdatabase'),
+    'unittest': dict(user='unittest', password='test_db',
+                     database='test_db'),
+}
+
+# Indexes made outside the models, e.g. by search.create_search_index().
+IGNORED_INDEXES = ('PRIMARY', 'book_fulltext', 'author_fulltext')
+
+
+class MigrationHistory(BaseModel):
+    """Migrations applied to the database.
+
+    name - file name of the migration without .py, e.g. 0001_initial
+    applied_at - when the migration finished
+    """
+
+    id = PrimaryKeyField()
+    name = CharField(max_length=255, unique=True)
+    applied_at = DateTimeField(default=datetime.datetime.now)
+
+
+class Migrator(object):
+    """Schema operations available to migrations.
+
+    database - peewee database the migration runs against
+    batch_size - rows changed per transaction by backfill()
+    pause - seconds to sleep between backfill batches, gives replicas
+        and other writers room on a busy server
+    """
+
+    def __init__(self, database, batch_size=1000, pause=0):
+        self.database = getattr(database, 'obj', database)
+        self.schema = SchemaMigrator.from_database(self.database)
+        self.batch_size = batch_size
+        self.pause = pause
+
+    @property
+    def is_mysql(self):
+        return isinstance(self.database, MySQLDatabase)
+
+    def _execute(self, node, online=False):
+        sql, params = self.database.compiler().parse_node(node)
+        if online and self.is_mysql:
+            # Let reads and writes continue while MySQL alters the table.
+            sql += ', ALGORITHM=INPLACE, LOCK=NONE'
+        self.database.execute_sql(sql, params)
+
+    def _rebuild(self, operation):
+        if self.is_mysql:
+            operation.run()
+            return
+        # SQLite changes a column by copying the table into a new one.
+        # Legacy mode stops the rename from checking the search, change
+        # log and version triggers of other tables, the triggers of the
+        # copied table are dropped with it and put back afterwards.
+        self.database.execute_sql('PRAGMA legacy_alter_table = ON')
+        try:
+            with self.database.atomic():
+                operation.run()
+        finally:
+            self.database.execute_sql('PRAGMA legacy_alter_table = OFF')
+        create_search_index(self.database)
+        create_change_log(self.database)
+        create_lend_log(self.database)
+        create_version_log(self.database)
+
+    def columns(self, table):
+        return [c.name for c in self.database.get_columns(table)]
+
+    def indexes(self, table):
+        return self.database.get_indexes(table)
+
+    def create_tables(self, models):
+        """Create the tables and indexes that do not exist yet."""
+        self.database.create_tables(models, safe=True)
+
+    def add_column(self, model, name, value=None):
+        """Add the column of a model field, safe to call more than once.
+
+        A run that was interrupted during the backfill picks up where it
+        stopped, since only rows without a value are filled in.
+
+        model - model the field belongs to
+        name - name of the field
+        value - value or expression filled in on existing rows, defaults
+            to the default of the field
+        raises - ValueError when a NOT NULL field gets no value
+        """
+        field = model._meta.fields[name]
+        table = model._meta.db_table
+        live = dict((c.name, c) for c in self.database.get_columns(table))
+        column = live.get(field.db_column)
+        if column is not None and (field.null or not column.null):
+            return
+        if value is None:
+            value = field.default() if callable(field.default) \
+                else field.default
+        if value is None and not field.null:
+            raise ValueError("%s.%s is not null but has no default or value"
+                             % (table, field.db_column))
+        if column is None:
+            self._execute(self.schema.alter_add_column(
+                table, field.db_column, copy.copy(field), generate=True),
+                online=True)
+            if isinstance(field, ForeignKeyField) and self.is_mysql:
+                self.schema.add_foreign_key_constraint(
+                    table, field.db_column, field.rel_model._meta.db_table,
+                    field.to_field.db_column).run()
+        if value is not None:
+            self.backfill(model, {name: value}, field >> None)
+        if not field.null:
+            self._rebuild(self.schema.add_not_null(table, field.db_column))
+
+    def allow_null(self, model, name):
+        """Drop the NOT NULL constraint of a column that became nullable,
+        safe to call more than once.
+        """
+        field = model._meta.fields[name]
+        table = model._meta.db_table
+        live = dict((c.name, c) for c in self.database.get_columns(table))
+        if not live[field.db_column].null:
+            self._rebuild(self.schema.drop_not_null(table, field.db_column))
+
+    def drop_column(self, table, column):
+        """Drop a column when it exists."""
+        if column in self.columns(table):
+            self._rebuild(self.schema.drop_column(table, column))
+
+    def add_index(self, model, fields, unique=False):
+        """Add an index on the fields, safe to call more than once.
+
+        fields - list of field names, in index order
+        """
+        table = model._meta.db_table
+        columns = [model._meta.fields[name].db_column for name in fields]
+        if any(index.columns == columns for index in self.indexes(table)):
+            return
+        name = self.database.compiler().index_name(table, columns)
+        if self.is_mysql:
+            self._execute(Clause(
+                SQL('ALTER TABLE'), Entity(table),
+                SQL('ADD UNIQUE INDEX' if unique else 'ADD INDEX'),
+                Entity(name),
+                EnclosedClause(*[Entity(column) for column in columns])),
+                online=True)
+        else:
+            self.schema.add_index(table, columns, unique).run()
+
+    def drop_index(self, table, name):
+        """Drop an index by name when it exists."""
+        if name in [index.name for index in self.indexes(table)]:
+            self.schema.drop_index(table, name).run()
+
+    def backfill(self, model, values, where=None):
+        """Update rows in primary key batches of batch_size.
+
+        Every batch is its own short transaction, so row locks are never
+        held for more than batch_size rows at a time.
+
+        values - dict of field name to value or expression
+        where - only update rows matching this expression
+        return - amount of updated rows
+        """
+        pk = model._meta.primary_key
+        updated = 0
+        last_pk = None
+        while True:
+            query = model.select(pk).order_by(pk).limit(self.batch_size)
+            if last_pk is not None:
+                query = query.where(pk > last_pk)
+            ids = [row[0] for row in query.tuples()]
+            if not ids:
+                break
+            update = model.update(**values).where(pk >= ids[0],
+                                                  pk <= ids[-1])
+            if where is not None:
+                update = update.where(where)
+            with self.database.atomic():
+                updated += update.execute()
+            last_pk = ids[-1]
+            if self.pause:
+                time.sleep(self.pause)
+        model_cache.invalidate(model)
+        return updated
+
+    def run_sql(self, sql, params=None):
+        return self.database.execute_sql(sql, params)
+
+
+class Change(object):
+    """A difference between a model and the live schema.
+
+    action - name of the Migrator method that resolves it
+    model - model name or, for drops, the table name
+    args - remaining arguments of the Migrator call
+    destructive - drops are written commented out in new migrations
+    """
+
+    def __init__(self, action, model, *args):
+        self.action = action
+        self.model = model
+        self.args = args
+        self.destructive = action.startswith('drop')
+
+    def __repr__(self):
+        if self.action == 'create_tables':
+            args = ['[%s]' % self.model]
+        elif self.destructive:
+            args = [repr(self.model)] + [repr(arg) for arg in self.args]
+        else:
+            args = [self.model] + [repr(arg) for arg in self.args]
+        return 'migrator.%s(%s)' % (self.action, ', '.join(args))
+
+
+def _model_indexes(model):
+    indexes = [([field.db_column], field.unique)
+               for field in model._fields_to_index()]
+    for fields, unique in model._meta.indexes or ():
+        indexes.append(([model._meta.fields[name].db_column
+                         for name in fields], unique))
+    return indexes
+
+
+def diff(database=None, models=None):
+    """Compare the models with the live schema.
+
+    database - defaults to models.db
+    models - defaults to MODELS
+    return - list of Change objects, in the order they should be applied
+    """
+    database = getattr(database or db, 'obj', database or db)
+    models = models or MODELS
+    tables = database.get_tables()
+    changes = []
+    for model in models:
+        table = model._meta.db_table
+        if table not in tables:
+            changes.append(Change('create_tables', model.__name__))
+            continue
+        columns = dict((c.name, c) for c in database.get_columns(table))
+        live = list(columns)
+        expected = [f.db_column for f in model._meta.sorted_fields]
+        for field in model._meta.sorted_fields:
+            if field.db_column not in live:
+                changes.append(Change('add_column', model.__name__,
+                                      field.name))
+            elif field.null and not columns[field.db_column].null:
+                changes.append(Change('allow_null', model.__name__,
+                                      field.name))
+        for column in live:
+            if column not in expected:
+                changes.append(Change('drop_column', table, column))
+
+        indexes = database.get_indexes(table)
+        wanted = _model_indexes(model)
+        by_column = dict((f.db_column, f.name)
+                         for f in model._meta.sorted_fields)
+        for columns, unique in wanted:
+            if not any(index.columns == columns for index in indexes):
+                args = [[by_column[column] for column in columns]]
+                if unique:
+                    args.append(True)
+                changes.append(Change('add_index', model.__name__, *args))
+        for index in indexes:
+            if index.name in IGNORED_INDEXES or \
+                    index.name.startswith('sqlite_autoindex'):
+                continue
+            if not any(index.columns == columns for columns, _ in wanted):
+                changes.append(Change('drop_index', table, index.name))
+    return changes
+
+
+class MigrationRunner(object):
+    """Finds, applies and records migrations.
+
+    database - defaults to models.db
+    path - directory with the migration modules
+    batch_size - rows per transaction for backfills
+    """
+
+    def __init__(self, database=None, path=MIGRATIONS_DIR, batch_size=1000,
+                 pause=0):
+        self.database = getattr(database or db, 'obj', database or db)
+        self.path = path
+        self.batch_size = batch_size
+        self.pause = pause
+
+    def migrations(self):
+        """Return the names of all migrations, oldest first."""
+        names = [os.path.splitext(name)[0]
+                 for name in os.listdir(self.path)
+                 if MIGRATION_FILE.match(name)]
+        return sorted(names)
+
+    def applied(self):
+        """Return the names of the applied migrations."""
+        with Using(self.database, [MigrationHistory],
+                   with_transaction=False):
+            MigrationHistory.create_table(fail_silently=True)
+            return [row.name for row in
+                    MigrationHistory.select().order_by(MigrationHistory.id)]
+
+    def pending(self):
+        applied = set(self.applied())
+        return [name for name in self.migrations() if name not in applied]
+
+    def load(self, name):
+        spec = importlib.util.spec_from_file_location(
+            'migrations.%s' % name, os.path.join(self.path, name + '.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def upgrade(self, target=None, progress=None):
+        """Apply the pending migrations up to and including target.
+
+        target - name of the last migration to apply, defaults to all
+        progress - called with the name of each migration before it runs
+        return - names of the applied migrations
+        raises - ValueError when target is not a known migration
+        """
+        pending = self.pending()
+        if target is not None:
+            if target not in self.migrations():
+                raise ValueError("Unknown migration %s" % target)
+            pending = [name for name in pending if name <= target]
+        migrator = Migrator(self.database, self.batch_size, self.pause)
+        done = []
+        with Using(self.database, MODELS + [MigrationHistory],
+                   with_transaction=False):
+            for name in pending:
+                if progress is not None:
+                    progress(name)
+                self.load(name).up(migrator)
+                MigrationHistory.create(name=name)
+                done.append(name)
+        # Cached rows were read with the old schema.
+        for model in MODELS:
+            model_cache.invalidate(model)
+        return done
+
+    def make(self, name, changes=None):
+        """Write a new migration module and return its path.
+
+        changes - Change objects to put in up(), drops are commented out
+        """
+        if not re.match(r'^\w+$', name):
+            raise ValueError("Migration names may only contain letters, "
+                             "digits and underscores")
+        existing = self.migrations()
+        number = int(existing[-1][:4]) + 1 if existing else 1
+        path = os.path.join(self.path, '%04d_%s.py' % (number, name))
+        lines = []
+        for change in changes or []:
+            prefix = '# ' if change.destructive else ''
+            lines.append('    %s%r' % (prefix, change))
+        if not [line for line in lines if not line.startswith('    #')]:
+            lines.append('    pass')
+        with open(path, 'w') as migration:
+            migration.write(MIGRATION_TEMPLATE % dict(
+                title=name.replace('_', ' ').capitalize(),
+                body='\n'.join(lines)))
+        return path
+
+
+MIGRATION_TEMPLATE = '''"""%(title)s."""
+from models import *
+
+
+def up(migrator):
+%(body)s
+'''
+
+
+def configure(name=None, sqlite=None):
+    """Point models.db at a configured MySQL database or a SQLite file."""
+    if sqlite is not None:
+        db.initialize(RoutingSqliteDatabase(sqlite))
+        return
+    db.init(host=os.getenv('DB_HOST', 'localhost'), charset='utf8',
+            **DATABASES[name])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Apply and create schema migrations.")
+    parser.add_argument('--database', choices=sorted(DATABASES),
+                        default='development')
+    parser.add_argument('--sqlite', default=None,
+                        help="use this SQLite file instead of MySQL")
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('status', help="list applied and pending migrations")
+    upgrade = commands.add_parser('upgrade',
+                                  help="apply pending migrations")
+    upgrade.add_argument('--to', default=None,
+                         help="stop after this migration")
+    upgrade.add_argument('--batch-size', type=int, default=1000)
+    upgrade.add_argument('--pause', type=float, default=0,
+                         help="seconds between backfill batches")
+    commands.add_parser('diff', help="show how the models differ from the "
+                                     "database schema")
+    make = commands.add_parser('make', help="write a migration for the "
+                                            "differences")
+    make.add_argument('name')
+    make.add_argument('--empty', action='store_true',
+                      help="do not fill in the differences")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("a command is required")
+    configure(args.database, args.sqlite)
+
+    runner = MigrationRunner(
+        batch_size=getattr(args, 'batch_size', 1000),
+        pause=getattr(args, 'pause', 0))
+    if args.command == 'status':
+        applied = set(runner.applied())
+        for name in runner.migrations():
+            print("[%s] %s" % ('x' if name in applied else ' ', name))
+    elif args.command == 'upgrade':
+        done = runner.upgrade(
+            args.to, progress=lambda name: print("Applying %s" % name))
+        print("%d migrations applied" % len(done))
+    elif args.command == 'diff':
+        changes = diff()
+        for change in changes:
+            print(change)
+        if not changes:
+            print("The database matches the models")
+    else:
+        print("Created %s" % runner.make(
+            args.name, [] if args.empty else diff()))
+
+
+if __name__ == '__main__':
+    main()
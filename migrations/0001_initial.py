@@ -0,0 +1,97 @@
+"""Create the schema as built by the old drop-and-recreate refresh.
+
+The tables, columns and indexes are listed here as the refresh made
+them, so models added or changed later do not change what this
+migration creates. The later migrations take the schema from there.
+
+Tables that already exist are left alone, so databases made with the
+refresh functions adopt this migration without losing data.
+"""
+from peewee import *
+from models import db
+
+
+class BaselineModel(Model):
+    class Meta:
+        database = db
+
+
+class Publisher(BaselineModel):
+    id = PrimaryKeyField()
+    name = CharField(max_length=256)
+    city = CharField(max_length=256)
+
+
+class Author(BaselineModel):
+    id = PrimaryKeyField()
+    name = CharField(max_length=256)
+    biography = TextField()
+    age = SmallIntegerField()
+
+
+class Book(BaselineModel):
+    id = PrimaryKeyField()
+    isbn = CharField(unique=True)
+    title = CharField(max_length=32)
+    author_id = ForeignKeyField(Author, related_name='written_by')
+    publisher_id = ForeignKeyField(Publisher, related_name='published_by')
+    amount_of_pages = SmallIntegerField()
+    book_print = SmallIntegerField()
+    edition = SmallIntegerField()
+    summary = TextField()
+    published_at = DateField()
+    language = CharField(max_length=64)
+    book_type = CharField(max_length=16)
+    amount = SmallIntegerField(default=0)
+
+
+class Genre(BaselineModel):
+    id = PrimaryKeyField()
+    genre = CharField(unique=True)
+
+
+class BookGenre(BaselineModel):
+    id = PrimaryKeyField()
+    book_id = ForeignKeyField(Book)
+    genre_id = ForeignKeyField(Genre)
+
+
+class Customer(BaselineModel):
+    id = PrimaryKeyField()
+    email = CharField(max_length=254)
+    password = CharField(max_length=128)
+    first_name = CharField(max_length=128)
+    surname = CharField(max_length=128)
+
+
+class Lend(BaselineModel):
+    id = PrimaryKeyField()
+    book_id = ForeignKeyField(Book)
+    customer_id = ForeignKeyField(Customer, related_name='borrowed_by')
+    return_date = DateField()
+    returned_at = DateField()
+
+
+class Review(BaselineModel):
+    id = PrimaryKeyField()
+    customer_id = ForeignKeyField(Customer, related_name='reviewed_by')
+    book_id = ForeignKeyField(Book)
+    text = TextField()
+    published_at = DateField()
+    rating = SmallIntegerField()
+
+
+class Administrator(BaselineModel):
+    id = PrimaryKeyField()
+    email = CharField(max_length=254)
+    password = CharField(max_length=128)
+
+
+BASELINE = [Publisher, Author, Book, Genre, BookGenre, Customer, Lend,
+            Review, Administrator]
+
+
+def up(migrator):
+    for model in BASELINE:
+        model._meta.database = migrator.database
+    migrator.create_tables(BASELINE)
@@ -0,0 +1,6 @@
+"""Add the bookneighbour table holding the output of recommender.py."""
+from models import *
+
+
+def up(migrator):
+    migrator.create_tables([BookNeighbour])
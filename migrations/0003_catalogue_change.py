@@ -0,0 +1,8 @@
+"""Add the cataloguechange table and the triggers that fill it."""
+from models import *
+from snapshot import create_change_log
+
+
+def up(migrator):
+    migrator.create_tables([CatalogueChange])
+    create_change_log(migrator.database)
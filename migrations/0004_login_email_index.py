@@ -0,0 +1,7 @@
+"""Index the emails logins look up."""
+from models import *
+
+
+def up(migrator):
+    migrator.add_index(Customer, ['email'])
+    migrator.add_index(Administrator, ['email'])
@@ -0,0 +1,17 @@
+"""Add the lent_at date of lends and the tables of the lend rollups."""
+from models import *
+from rollups import create_lend_log
+
+
+def up(migrator):
+    # The loan period of existing lends is not known, the date they
+    # were lent at is estimated as three weeks before their return date.
+    if migrator.is_mysql:
+        lent_at = SQL('DATE_SUB(return_date, INTERVAL 21 DAY)')
+    else:
+        lent_at = SQL("date(return_date, '-21 days')")
+    migrator.add_column(Lend, 'lent_at', lent_at)
+    migrator.add_index(Lend, ['lent_at'])
+    migrator.add_index(Lend, ['return_date'])
+    migrator.create_tables([LendChange, LendRollup, Watermark])
+    create_lend_log(migrator.database)
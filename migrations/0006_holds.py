@@ -0,0 +1,6 @@
+"""Add the hold table, the queues for books."""
+from models import *
+
+
+def up(migrator):
+    migrator.create_tables([Hold])
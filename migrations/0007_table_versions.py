@@ -0,0 +1,8 @@
+"""Add the tableversion table and the triggers that count the writes."""
+from models import *
+from versions import create_version_log
+
+
+def up(migrator):
+    migrator.create_tables([TableVersion])
+    create_version_log(migrator.database)
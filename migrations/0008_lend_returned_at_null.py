@@ -0,0 +1,6 @@
+"""Let lends be open, an open lend has no returned_at."""
+from models import *
+
+
+def up(migrator):
+    migrator.allow_null(Lend, 'returned_at')
@@ -0,0 +1,15 @@
+"""Add the copies of a book that are on the shelf, as Book.available."""
+from models import *
+
+
+def up(migrator):
+    # As Book.recount_available(): the copies not lent out or kept for
+    # a ready hold.
+    open_lends = (Lend.select(fn.COUNT(Lend.id))
+                  .where((Lend.book_id == Book.id) &
+                         (Lend.returned_at >> None)))
+    ready_holds = (Hold.select(fn.COUNT(Hold.id))
+                   .where((Hold.book_id == Book.id) &
+                          (Hold.status == 'ready')))
+    migrator.add_column(Book, 'available',
+                        Book.amount - open_lends - ready_holds)
@@ -0,0 +1,7 @@
+"""Add the average rating of a book to its genres, for top lists."""
+from models import *
+
+
+def up(migrator):
+    migrator.add_column(BookGenre, 'average')
+    migrator.add_index(BookGenre, ['genre_id', 'average'])
@@ -0,0 +1,24 @@
+"""Add the bookrating table with the review summaries of every book."""
+from models import *
+
+
+def up(migrator):
+    if BookRating._meta.db_table in migrator.database.get_tables():
+        return
+    migrator.create_tables([BookRating])
+    # As BookRating.rebuild(), in statements on the database of the
+    # migration.
+    stars = [fn.SUM(Review.rating == rating)
+             for rating in BookRating.RATINGS]
+    BookRating.insert_from(
+        [BookRating.book_id, BookRating.count, BookRating.total,
+         BookRating.stars_1, BookRating.stars_2, BookRating.stars_3,
+         BookRating.stars_4, BookRating.stars_5, BookRating.average],
+        Review.select(Review.book_id, fn.COUNT(Review.id),
+                      fn.SUM(Review.rating), *(stars + [
+                          fn.SUM(Review.rating) * 1.0 /
+                          fn.COUNT(Review.id)]))
+        .group_by(Review.book_id)).execute()
+    average = (BookRating.select(BookRating.average)
+               .where(BookRating.book_id == BookGenre.book_id))
+    migrator.backfill(BookGenre, dict(average=fn.COALESCE(average, 0.0)))
@@ -0,0 +1,11 @@
+"""Index the columns listings are sorted on, for keyset pagination."""
+from models import *
+
+
+def up(migrator):
+    migrator.add_index(Publisher, ['name', 'id'])
+    migrator.add_index(Publisher, ['city', 'id'])
+    migrator.add_index(Author, ['name', 'id'])
+    migrator.add_index(Author, ['age', 'id'])
+    migrator.add_index(Book, ['title', 'id'])
+    migrator.add_index(Book, ['published_at', 'id'])
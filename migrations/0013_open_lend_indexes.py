@@ -0,0 +1,7 @@
+"""Index the open lends, for the overdue scan and lends per customer."""
+from models import *
+
+
+def up(migrator):
+    migrator.add_index(Lend, ['returned_at', 'return_date'])
+    migrator.add_index(Lend, ['returned_at', 'customer_id'])
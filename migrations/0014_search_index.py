@@ -0,0 +1,7 @@
+"""Add the full-text index of the catalogue search."""
+from models import *
+from search import create_search_index
+
+
+def up(migrator):
+    create_search_index(migrator.database)
@@ -0,0 +1,6 @@
+"""Keep the time the sessions of an admin were revoked on its row."""
+from models import *
+
+
+def up(migrator):
+    migrator.add_column(Administrator, 'sessions_revoked_at')
@@ -0,0 +1,9 @@
+"""Store the login emails as logins look them up, see normalize_email()."""
+from models import *
+
+
+def up(migrator):
+    for model in [Customer, Administrator]:
+        normalized = fn.LOWER(fn.TRIM(model.email))
+        migrator.backfill(model, dict(email=normalized),
+                          where=model.email != normalized)
@@ -1,59 +1,185 @@
 """Define peewee models for the databases.
 
-Run "python models.py" to update the db's with latest changes
-made to the models.
+Run "python migrate.py upgrade" to apply model changes to the db's,
+see migrate.py for writing a migration after changing a model.
 """
-import os
+import datetime
 from peewee import *
+from peewee import Node
+from pymysql.constants import CLIENT
+from routing import RoutingMySQLDatabase
+from pagination import paginate, iterate_in_chunks, DEFAULT_PAGE_SIZE
+from cache import model_cache
+from compiled import CompiledQuery, slot
 
-db = MySQLDatabase(None)
-
-
-def refresh_unittest_db():
-    """Rebuild unittest db to apply new model changes."""
-    db.init(host=os.getenv('DB_HOST', 'localhost'),
-            user='unittest',
-            password='test_db',
-            database='test_db',
-            charset='utf8')
-    db.connect()
-    print("Deleting unittest tables")
-    db.drop_tables([Lend, Administrator, Review, Customer,
-                    Genre, BookGenre, Book, Publisher, Author],
-                   safe=True, cascade=True)
-    print("Tables deleted")
-    print("Creating new tables")
-    db.create_tables([Publisher, Author, Book, Genre,
-                     BookGenre, Customer, Lend, Review, Administrator],
-                     safe=True)
-    print("Tables created")
-    print("done\n\n")
-
-
-def refresh_development_db():
-    """Rebuild development db to apply new model changes."""
-    db.init(host=os.getenv('DB_HOST', 'localhost'),
-            user='development',
-            password='devpassword',
-            database='devdatabase',
-            charset='utf8')
-    db.connect()
-    print("Deleting development tables")
-    db.drop_tables([Lend, Administrator, Review, Customer, Genre, BookGenre,
-                   Book, Publisher, Author], safe=True, cascade=True)
-    print("Tables deleted")
-    print("Creating new tables")
-    db.create_tables([Publisher, Author, Book, Genre,
-                     BookGenre, Customer, Lend, Review, Administrator],
-                     safe=True)
-    print("Tables created")
-    print("done\n\n")
+# Deferred until db.init() is called. Pool settings can be overridden
+# there as well, e.g. db.init(..., max_connections=50). The proxy lets
+# local runs and benchmarks swap in another database with
+# db.initialize(database) before the app starts.
+# FOUND_ROWS makes MySQL count the rows an UPDATE matched instead of
+# the rows it changed, like SQLite does, so the rowcount tells whether
+# the row exists.
+db = Proxy()
+db.initialize(RoutingMySQLDatabase(None, max_connections=20,
+                                   stale_timeout=300, timeout=10,
+                                   client_flag=CLIENT.FOUND_ROWS))
+
+
+def _by_id(model):
+    primary_key = model._meta.primary_key
+    return primary_key == slot('pk', primary_key)
+
+
+# The fixed queries of BaseModel, compiled once per model, see
+# compiled.py. Changes are slotted in by field name next to 'pk'.
+_select_by_id = CompiledQuery(
+    lambda model: model.select().where(_by_id(model)).limit(1))
+_exists_by_id = CompiledQuery(
+    lambda model: model.select(SQL('1')).where(_by_id(model)).limit(1))
+_exists_any = CompiledQuery(lambda model: model.select(SQL('1')).limit(1))
+_update_by_id = CompiledQuery(
+    lambda model, names: model.update(**dict(
+        (name, slot(name, model._meta.fields[name])) for name in names))
+    .where(_by_id(model)))
+_delete_by_id = CompiledQuery(
+    lambda model: model.delete().where(_by_id(model)))
 
 
 class BaseModel(Model):
+    # Columns select_page() may sort on, each needs an index on
+    # (column, id) to keep deep pages cheap.
+    sortable_fields = ('id',)
+
     class Meta:
         database = db
 
+    def save(self, *args, **kwargs):
+        result = super(BaseModel, self).save(*args, **kwargs)
+        model_cache.invalidate(type(self))
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        result = super(BaseModel, self).delete_instance(*args, **kwargs)
+        model_cache.invalidate(type(self))
+        return result
+
+    @classmethod
+    def update_by_id(cls, pk_value, changes):
+        """Write only the changed columns of a row in one query.
+
+        changes - dict of field name to new value
+        return - True when the row exists, False otherwise
+        """
+        if not changes:
+            return bool(_exists_by_id.rows(cls, dict(pk=pk_value)))
+        if any(isinstance(value, Node) for value in changes.values()):
+            # Expressions such as Book.available - 1 are no values.
+            updated = cls.update(**changes).where(
+                cls._meta.primary_key == pk_value).execute()
+        else:
+            values = dict(changes, pk=pk_value)
+            updated = _update_by_id.rowcount(cls, values,
+                                             (tuple(sorted(changes)),))
+        model_cache.invalidate(cls)
+        return bool(updated)
+
+    @classmethod
+    def delete_by_id(cls, pk_value):
+        """Delete a row in one query, return False when it did not exist."""
+        deleted = _delete_by_id.rowcount(cls, dict(pk=pk_value))
+        if deleted:
+            model_cache.invalidate(cls)
+        return bool(deleted)
+
+    @classmethod
+    def get_by_id(cls, pk_value):
+        """Return the row by primary key, like
+        cls.get(cls.id == pk_value) without building the query.
+
+        raises - DoesNotExist when there is no row with that key
+        """
+        rows = _select_by_id.instances(cls, dict(pk=pk_value))
+        if not rows:
+            raise cls.DoesNotExist("%s %r does not exist"
+                                   % (cls.__name__, pk_value))
+        return rows[0]
+
+    @classmethod
+    def has_rows(cls):
+        """Return True when the table has a row, with a LIMIT 1 query."""
+        return bool(_exists_any.rows(cls, {}))
+
+    @classmethod
+    def bulk_edit(cls, edits):
+        """Apply many updates and deletes in one transaction.
+
+        The model has to define valid_changes(), which turns the fields of
+        an edit into the changes to write.
+
+        edits - iterable of dicts holding the id of a row and either the
+            fields to update or delete=True
+        return - list with for every edit True when its row existed
+        raises - KeyError when an edit has no id, TypeError on an unknown
+            field, nothing is written then
+        """
+        results = []
+        try:
+            with db.atomic():
+                for edit in edits:
+                    fields = dict(edit)
+                    pk_value = fields.pop('id')
+                    if fields.pop('delete', False):
+                        results.append(cls.delete_by_id(pk_value))
+                    else:
+                        results.append(cls.update_by_id(
+                            pk_value, cls.valid_changes(**fields)))
+        finally:
+            # Also when rolled back, the cache may hold rows of it.
+            model_cache.invalidate(cls)
+        return results
+
+    @classmethod
+    def get_cached(cls, pk_value):
+        """Return the row by primary key through the model cache.
+
+        raises - DoesNotExist when there is no row with that key
+        """
+        return model_cache.get(cls, pk_value)
+
+    @classmethod
+    def select_all_cached(cls):
+        """Return a list of all rows through the model cache.
+
+        Only meant for small tables such as genres.
+        """
+        return model_cache.select_all(cls)
+
+    @classmethod
+    def select_page(cls, after=None, before=None,
+                    page_size=DEFAULT_PAGE_SIZE, sort='id'):
+        """Return one page of rows using keyset pagination.
+
+        after - cursor of the page before, returns the rows after it
+        before - cursor of the page after, returns the rows before it
+        page_size - amount of rows on the page
+        sort - name of the column to sort on, must be in sortable_fields
+        return - a pagination.Page obj
+        raises - ValueError on an unknown sort column or invalid cursor
+        """
+        if sort not in cls.sortable_fields:
+            raise ValueError("Can not sort %s on %r" % (cls.__name__, sort))
+        return paginate(cls.select(), cls, cls._meta.fields[sort],
+                         after=after, before=before, page_size=page_size)
+
+    @classmethod
+    def iterate_all(cls, chunk_size=1000):
+        """Lazily yield every row, chunk_size rows per query.
+
+        Unlike iterating select_all() the rows are not cached, so memory
+        stays bounded by chunk_size however big the table is.
+        """
+        return iterate_in_chunks(cls.select(), cls, chunk_size)
+
 
 class Publisher(BaseModel):
     """Publisher model.
@@ -63,10 +189,23 @@ class Publisher(BaseModel):
     city - city where from the publisher operates
     """
 
+    sortable_fields = ('id', 'name', 'city')
+
     id = PrimaryKeyField()
     name = CharField(max_length=256)
     city = CharField(max_length=256)
 
+    class Meta:
+        indexes = (
+            (('name', 'id'), False),
+            (('city', 'id'), False),
+        )
+
+    @staticmethod
+    def valid_input(name, city):
+        """Return True when name and city fit in their columns."""
+        return len(name) <= 265 and len(city) <= 256
+
     @staticmethod
     def add_publisher(name, city):
         """Add a new publisher.
@@ -77,7 +216,7 @@ class Publisher(BaseModel):
             None when parameter lengths are more than
             256 chars long
         """
-        if len(name) <= 265 and len(city) <= 256:
+        if Publisher.valid_input(name, city):
             return Publisher.create(name=name, city=city)
         return None
 
@@ -85,47 +224,50 @@ class Publisher(BaseModel):
     def select_all():
         """Return all publishers.
 
+        Only meant for small tables, use select_page() for listings.
+
         return - a SelectQuery obj or None if no publishers where found
         """
-        publishers = Publisher.select()
-        if publishers:
-            return publishers
+        # has_rows() runs a LIMIT 1 query instead of loading every row
+        if Publisher.has_rows():
+            return Publisher.select()
         return None
 
+    @staticmethod
+    def valid_changes(name=None, city=None):
+        """Return the dict of fields to update, leaving out invalid ones."""
+        changes = {}
+        if name and len(name) <= 265:
+            changes['name'] = name
+        if city and len(city) <= 265:
+            changes['city'] = city
+        return changes
+
     @staticmethod
     def update_selected(publisher_id, name=None, city=None):
         """Update the publisher by id.
 
+        Only the given fields are written, in a single UPDATE.
+
         id - id of the publisher you want to update
         name - name of the publisher
         city - city where from the publisher operates
-        return - a publisher object when succesfull or
+        return - True when succesfull or
             None when the id does not exist
         """
-        try:
-            publisher = Publisher.get(Publisher.id == publisher_id)
-            if name and len(name) <= 265:
-                publisher.name = name
-            if city and len(city) <= 265:
-                publisher.city = city
-            publisher.save()
-            return publisher
-        except Publisher.DoesNotExist:
-            return None
-        # false will never be returned, also not tested (redundant?)
-        return False
+        if Publisher.update_by_id(publisher_id,
+                                  Publisher.valid_changes(name, city)):
+            return True
+        return None
 
     @staticmethod
     def delete_selected(publisher_id):
         """Delete publisher by id.
 
         id - unique id of the publiser
+        return - True when deleted, False when the id does not exist
         """
-        try:
-            Publisher.get(Publisher.id == publisher_id).delete_instance()
-            return True
-        except DoesNotExist:
-            return False
+        return Publisher.delete_by_id(publisher_id)
 
 
 class Author(BaseModel):
@@ -137,12 +279,25 @@ class Author(BaseModel):
     age - age of the author
     """
 
+    sortable_fields = ('id', 'name', 'age')
+
     id = PrimaryKeyField()
     name = CharField(max_length=256)
     biography = TextField()
     # Should be changed to birthdate or born_at
     age = SmallIntegerField()
 
+    class Meta:
+        indexes = (
+            (('name', 'id'), False),
+            (('age', 'id'), False),
+        )
+
+    @staticmethod
+    def valid_input(name):
+        """Return True when name fits in its column."""
+        return len(name) <= 256
+
     @staticmethod
     def add_author(name, biography, age):
         """Add a new author.
@@ -151,7 +306,7 @@ class Author(BaseModel):
         biography - string of text about the author
         age - age of the author
         """
-        if len(name) <= 256:
+        if Author.valid_input(name):
             try:
                 return Author.create(name=name, biography=biography, age=age)
             except ValueError:
@@ -163,50 +318,51 @@ class Author(BaseModel):
     def select_all():
         """Return all authors.
 
+        Only meant for small tables, use select_page() for listings.
+
         return - a SelectQuery obj or None if no authors where found
         """
-        authors = Author.select()
-        if authors:
-            return authors
+        if Author.has_rows():
+            return Author.select()
         return None
 
+    @staticmethod
+    def valid_changes(name=None, biography=None, age=None):
+        """Return the dict of fields to update, leaving out invalid ones."""
+        changes = {}
+        if name and len(name) <= 256:
+            changes['name'] = name
+        if biography:
+            changes['biography'] = biography
+        if isinstance(age, int):
+            changes['age'] = age
+        return changes
+
     @staticmethod
     def update_selected(author_id, name=None, biography=None, age=None):
         """Update author by id.
 
+        Only the given fields are written, in a single UPDATE.
+
         id - id of the author you want to update
         name - name of the author
         biography - string of text about the author
         age - age of the author
-        return - author obj or None if author does not exist
+        return - True or None if author does not exist
         """
-        try:
-            author = Author.get(Author.id == author_id)
-            if name and len(name) <= 256:
-                author.name = name
-            if biography:
-                author.biography = biography
-            if isinstance(age, int):
-                author.age = age
-            author.save()
-            return author
-        except Author.DoesNotExist:
-            return None
-        # false will never be returned
-        # TODO: remove false or make it usefull again
-        return False
+        if Author.update_by_id(author_id,
+                               Author.valid_changes(name, biography, age)):
+            return True
+        return None
 
     @staticmethod
     def delete_selected(author_id):
         """Delete author by id.
 
         id - unique id of the author
+        return - True when deleted, False when the id does not exist
         """
-        try:
-            Author.get(Author.id == author_id).delete_instance()
-            return True
-        except DoesNotExist:
-            return False
+        return Author.delete_by_id(author_id)
 
 class Book(BaseModel):
     """Book model.
@@ -225,6 +381,8 @@ class Book(BaseModel):
     language - in which language the book has been written
     book_type - book type: hardcover, paperback, pdf, e-book etc.
     amount - how many copies the library has
+    available - how many copies are not lend out, maintained by
+        Lend.checkout() and Lend.return_book()
     """
 
     id = PrimaryKeyField()
@@ -241,6 +399,170 @@ class Book(BaseModel):
     language = CharField(max_length=64)
     book_type = CharField(max_length=16)
     amount = SmallIntegerField(default=0)
+    available = SmallIntegerField(default=0)
+
+    sortable_fields = ('id', 'title', 'published_at')
+
+    class Meta:
+        indexes = (
+            (('title', 'id'), False),
+            (('published_at', 'id'), False),
+        )
+
+    def save(self, *args, **kwargs):
+        if self._get_pk_value() is None:
+            # A new book has no lends yet, so every copy is available.
+            self.available = self.amount
+        return super(Book, self).save(*args, **kwargs)
+
+    @staticmethod
+    def valid_input(isbn, title, language, book_type):
+        """Return True when the text fields fit in their columns."""
+        return (0 < len(isbn) <= 255 and len(title) <= 32 and
+                len(language) <= 64 and len(book_type) <= 16)
+
+    @staticmethod
+    def search(query, genre=None, language=None, limit=20):
+        """Full-text search on title, summary and the author.
+
+        query - words to search for, books matching any word are found
+        genre - only return books of this genre
+        language - only return books in this language
+        limit - maximum amount of books returned
+        return - list of book objs with a score attribute, best match first
+        """
+        from search import search_books
+        return search_books(query, genre=genre, language=language,
+                            limit=limit)
+
+    @staticmethod
+    def recommend(book_id, k=10):
+        """Return books alike to the book, most alike first.
+
+        Reads the neighbours precomputed by recommender.py, a single
+        range scan of the (book_id, rank) index however long the lending
+        history is. Books the recommender did not see yet get none.
+
+        book_id - id of the book
+        k - maximum amount of books, at most recommender.TOP_K are stored
+        return - list of book objs with a score attribute
+        """
+        return list(Book.select(Book, BookNeighbour.score)
+                    .join(BookNeighbour,
+                          on=(BookNeighbour.neighbour_id == Book.id))
+                    .where(BookNeighbour.book_id == book_id)
+                    .order_by(BookNeighbour.rank)
+                    .limit(k)
+                    .naive())
+
+    @staticmethod
+    def catalogue_page(after=None, before=None,
+                       page_size=DEFAULT_PAGE_SIZE, sort='id'):
+        """Return a page of books with author, publisher and genres.
+
+        Takes two queries however many books are on the page: one joining
+        the author and publisher and one for the genres of the page.
+        Every book gets a genres attribute with a list of genre names.
+
+        With a catalogue snapshot loaded, see snapshot.py, the page is
+        built from the snapshot instead and only the available copies
+        are read from the database, the books are snapshot.BookRecord
+        objs then.
+
+        Arguments are the same as for select_page().
+        return - a pagination.Page obj
+        raises - ValueError on an unknown sort column or invalid cursor
+        """
+        if sort not in Book.sortable_fields:
+            raise ValueError("Can not sort Book on %r" % sort)
+        from snapshot import catalogue
+        if catalogue.loaded:
+            catalogue.refresh_if_due()
+            page = catalogue.page('book', after=after, before=before,
+                                  page_size=page_size, sort=sort)
+            available = Book.available_for(book.id for book in page)
+            for book in page:
+                book.available = available.get(book.id, 0)
+            return page
+        query = (Book.select(Book, Author, Publisher)
+                 .join(Author)
+                 .switch(Book)
+                 .join(Publisher))
+        page = paginate(query, Book, Book._meta.fields[sort], after=after,
+                        before=before, page_size=page_size)
+        genres = dict((book.id, []) for book in page)
+        if genres:
+            query = (BookGenre.select(BookGenre.book_id, Genre.genre)
+                     .join(Genre)
+                     .where(BookGenre.book_id << list(genres))
+                     .order_by(Genre.genre)
+                     .tuples())
+            for book_id, genre in query:
+                genres[book_id].append(genre)
+        for book in page:
+            book.genres = genres[book.id]
+        return page
+
+    @staticmethod
+    def available_for(book_ids):
+        """Return the available copies of several books in one query.
+
+        book_ids - iterable of book ids
+        return - dict of book id to available copies, unknown ids are
+            left out
+        """
+        book_ids = list(book_ids)
+        if not book_ids:
+            return {}
+        query = (Book.select(Book.id, Book.available)
+                 .where(Book.id << book_ids)
+                 .tuples())
+        return dict(query)
+
+    @staticmethod
+    def update_amount(book_id, amount):
+        """Change the amount of copies, keeping available in step.
+
+        book_id - id of the book
+        amount - new total amount of copies
+        return - True when succesfull or False when the book does not
+            exist or more copies are lend out than amount
+        """
+        lent = Book.amount - Book.available
+        # Two statements, MySQL would otherwise compute available from
+        # the already updated amount.
+        with db.atomic():
+            updated = (Book.update(available=amount - lent)
+                       .where((Book.id == book_id) & (lent <= amount))
+                       .execute())
+            if updated:
+                (Book.update(amount=amount)
+                 .where(Book.id == book_id)
+                 .execute())
+                # New copies go to the queue first.
+                Hold.allocate(book_id)
+        model_cache.invalidate(Book)
+        return updated == 1
+
+    @staticmethod
+    def recount_available(book_id=None):
+        """Recompute available copies from open lends and ready holds.
+
+        Repairs drift after manual edits of the lend table.
+        book_id - only recount this book, all books when None
+        """
+        open_lends = (Lend.select(fn.COUNT(Lend.id))
+                      .where((Lend.book_id == Book.id) &
+                             (Lend.returned_at >> None)))
+        ready_holds = (Hold.select(fn.COUNT(Hold.id))
+                       .where((Hold.book_id == Book.id) &
+                              (Hold.status == 'ready')))
+        query = Book.update(available=Book.amount - open_lends - ready_holds)
+        if book_id is not None:
+            query = query.where(Book.id == book_id)
+        with db.atomic():
+            query.execute()
+        model_cache.invalidate(Book)
 
 
 class Genre(BaseModel):
@@ -262,11 +584,27 @@ class BookGenre(BaseModel):
     id - primary key
     book_id - primary key of the book
     genre_id - primary key of the genre
+    average - copy of the average rating of the book, so the best rated
+        books of a genre can be read from the (genre_id, average) index
     """
 
     id = PrimaryKeyField()
     book_id = ForeignKeyField(Book)
     genre_id = ForeignKeyField(Genre)
+    average = FloatField(default=0.0)
+
+    class Meta:
+        indexes = (
+            (('genre_id', 'average'), False),
+        )
+
+    def save(self, *args, **kwargs):
+        if self._get_pk_value() is None:
+            book_id = self._data.get('book_id')
+            self.average = (BookRating.select(BookRating.average)
+                            .where(BookRating.book_id == book_id)
+                            .scalar()) or 0.0
+        return super(BookGenre, self).save(*args, **kwargs)
 
 
 class Customer(BaseModel):
@@ -280,7 +618,7 @@ class Customer(BaseModel):
     """
 
     id = PrimaryKeyField()
-    email = CharField(max_length=254)
+    email = CharField(max_length=254, index=True)
     password = CharField(max_length=128)
     first_name = CharField(max_length=128)
     surname = CharField(max_length=128)
@@ -292,15 +630,303 @@ class Lend(BaseModel):
     id - primary key
     book_id - id of the lend book
     customer_id - id of the customer
+    lent_at - date when the book was lent out
     return_date - date when book should be returned
-    returned_at - date when the book was returned
+    returned_at - date when the book was returned, None while lend out
     """
 
     id = PrimaryKeyField()
     book_id = ForeignKeyField(Book)
     customer_id = ForeignKeyField(Customer, related_name='borrowed_by')
-    return_date = DateField(formats="%Y-%m-%d")
-    returned_at = DateField(formats="%Y-%m-%d")
+    lent_at = DateField(formats="%Y-%m-%d", default=datetime.date.today,
+                        index=True)
+    return_date = DateField(formats="%Y-%m-%d", index=True)
+    returned_at = DateField(formats="%Y-%m-%d", null=True)
+
+    class Meta:
+        # Open lends have no returned_at, so both indexes start with it
+        # and only touch the open lends instead of the whole history.
+        indexes = (
+            # overdue lends: returned_at IS NULL AND return_date < today
+            (('returned_at', 'return_date'), False),
+            # open lends per customer, ordered on (customer_id, id)
+            (('returned_at', 'customer_id'), False),
+        )
+
+    @staticmethod
+    def checkout(book_id, customer_id, return_date):
+        """Lend a copy of a book to a customer.
+
+        The available counter is decremented with a single conditional
+        UPDATE, which locks the book row until the lend is committed, so
+        concurrent checkouts can not lend out more copies than there are.
+
+        book_id - id of the book
+        customer_id - id of the customer
+        return_date - date when the book should be returned
+        return - a lend obj or None when no copy is available
+        """
+        with db.atomic():
+            taken = (Book.update(available=Book.available - 1)
+                     .where((Book.id == book_id) & (Book.available > 0))
+                     .execute())
+            if not taken:
+                return None
+            lend = Lend.create(book_id=book_id, customer_id=customer_id,
+                               return_date=return_date)
+        model_cache.invalidate(Book)
+        model_cache.invalidate(Lend)
+        return lend
+
+    @staticmethod
+    def return_book(lend_id, returned_at=None):
+        """Mark a lend as returned and put the copy back.
+
+        lend_id - id of the lend
+        returned_at - date of return, defaults to today
+        return - True when succesfull or False when the lend does not
+            exist or was already returned
+        """
+        returned_at = returned_at or datetime.date.today()
+        # Write before reading, SQLite can not turn a transaction that
+        # read into one that writes while another one writes.
+        with db.atomic():
+            returned = (Lend.update(returned_at=returned_at)
+                        .where((Lend.id == lend_id) &
+                               (Lend.returned_at >> None))
+                        .execute())
+            if not returned:
+                return False
+            book_id = (Lend.select(Lend.book_id)
+                       .where(Lend.id == lend_id)
+                       .scalar())
+            # The copy goes to the first holder in the queue, if any.
+            Hold.hand_over(book_id, returned_at)
+        model_cache.invalidate(Book)
+        model_cache.invalidate(Lend)
+        return True
+
+
+class Hold(BaseModel):
+    """Place of a customer in the queue for a book.
+
+    A hold waits until a copy is returned, the first waiting hold of the
+    book then gets that copy and is ready to collect until ready_until.
+    A ready hold counts as a lent copy in Book.available.
+
+    id - primary key, the queue of a book is in id order
+    book_id - id of the book
+    customer_id - id of the customer
+    placed_at - date when the hold was placed
+    status - waiting, ready, collected, cancelled or expired
+    ready_until - last day a ready hold can be collected, None before
+    """
+
+    PICKUP_DAYS = 7
+    ACTIVE = ('waiting', 'ready')
+
+    id = PrimaryKeyField()
+    book_id = ForeignKeyField(Book)
+    customer_id = ForeignKeyField(Customer, related_name='holds')
+    placed_at = DateField(formats=["%Y-%m-%d"], default=datetime.date.today)
+    status = CharField(max_length=16, default='waiting')
+    ready_until = DateField(formats=["%Y-%m-%d"], null=True)
+
+    class Meta:
+        indexes = (
+            # head of the queue: book_id = ? AND status = 'waiting'
+            # ORDER BY id
+            (('book_id', 'status', 'id'), False),
+            # expired holds: status = 'ready' AND ready_until < today
+            (('status', 'ready_until', 'id'), False),
+        )
+
+    @staticmethod
+    def place(book_id, customer_id, today=None):
+        """Queue a customer for a book.
+
+        When a copy is available and nobody waits before the customer,
+        the hold is ready right away.
+
+        book_id - id of the book
+        customer_id - id of the customer
+        today - date of placing, defaults to today
+        return - a hold obj or None when the customer already has a
+            waiting or ready hold for the book
+        """
+        today = today or datetime.date.today()
+        with db.atomic():
+            # The holds of a customer are placed one at a time: the no-op
+            # UPDATE locks the row of the customer until the commit, so
+            # a concurrent place() waits before its check instead of
+            # missing this hold. Writing first also suits SQLite, see
+            # Lend.return_book().
+            (Customer.update(id=Customer.id)
+             .where(Customer.id == customer_id)
+             .execute())
+            if Hold.select().where(
+                    (Hold.customer_id == customer_id) &
+                    (Hold.book_id == book_id) &
+                    (Hold.status << Hold.ACTIVE)).exists():
+                return None
+            hold = Hold.create(book_id=book_id, customer_id=customer_id,
+                               placed_at=today)
+            Hold.allocate(book_id, today)
+        model_cache.invalidate(Hold)
+        return Hold.get_by_id(hold.id)
+
+    @staticmethod
+    def allocate(book_id, today=None):
+        """Give the available copies of a book to its waiting holds,
+        first come first served.
+
+        A copy is taken with the same conditional UPDATE as a checkout and
+        a hold only turns ready from waiting, both lock their row, so
+        concurrent returns never hand one copy or one hold out twice.
+        Runs in the transaction of the caller when there is one.
+
+        book_id - id of the book
+        today - date the pickup window starts, defaults to today
+        return - list of ids of the holds that became ready
+        """
+        today = today or datetime.date.today()
+        ready_until = today + datetime.timedelta(days=Hold.PICKUP_DAYS)
+        allocated = []
+        with db.atomic():
+            while True:
+                head = (Hold.select(Hold.id)
+                        .where((Hold.book_id == book_id) &
+                               (Hold.status == 'waiting'))
+                        .order_by(Hold.id)
+                        .limit(1)
+                        # MySQL would otherwise read the head from the
+                        # snapshot of the transaction.
+                        .for_update(db.for_update)
+                        .scalar())
+                if head is None:
+                    break
+                taken = (Book.update(available=Book.available - 1)
+                         .where((Book.id == book_id) & (Book.available > 0))
+                         .execute())
+                if not taken:
+                    break
+                ready = (Hold.update(status='ready', ready_until=ready_until)
+                         .where((Hold.id == head) &
+                                (Hold.status == 'waiting'))
+                         .execute())
+                if not ready:
+                    # The hold was closed meanwhile, the copy goes back
+                    # and on to the next one in the queue.
+                    (Book.update(available=Book.available + 1)
+                     .where(Book.id == book_id)
+                     .execute())
+                    continue
+                allocated.append(head)
+        if allocated:
+            model_cache.invalidate(Book)
+            model_cache.invalidate(Hold)
+        return allocated
+
+    @staticmethod
+    def hand_over(book_id, today=None):
+        """Put a copy of a book back and give it to the next holder.
+
+        Must run inside the transaction that frees the copy.
+        return - id of the hold that got the copy, None when it went
+            back on the shelf
+        """
+        (Book.update(available=Book.available + 1)
+         .where(Book.id == book_id)
+         .execute())
+        allocated = Hold.allocate(book_id, today)
+        model_cache.invalidate(Book)
+        return allocated[0] if allocated else None
+
+    @staticmethod
+    def collect(hold_id, return_date):
+        """Lend the copy of a ready hold to its customer.
+
+        hold_id - id of the hold
+        return_date - date when the book should be returned
+        return - a lend obj or None when the hold is not ready
+        """
+        with db.atomic():
+            collected = (Hold.update(status='collected')
+                         .where((Hold.id == hold_id) &
+                                (Hold.status == 'ready'))
+                         .execute())
+            if not collected:
+                return None
+            row = (Hold.select(Hold.book_id, Hold.customer_id)
+                   .where(Hold.id == hold_id)
+                   .tuples()
+                   .first())
+            # The copy was taken from available when the hold got ready.
+            lend = Lend.create(book_id=row[0], customer_id=row[1],
+                               return_date=return_date)
+        model_cache.invalidate(Hold)
+        model_cache.invalidate(Lend)
+        return lend
+
+    @staticmethod
+    def cancel(hold_id, today=None):
+        """Take a hold out of the queue, the copy of a ready hold goes
+        to the next holder.
+
+        return - True when succesfull or False when the hold does not
+            exist or is no longer waiting or ready
+        """
+        return Hold._close(hold_id, 'cancelled', Hold.status << Hold.ACTIVE,
+                           today)
+
+    @staticmethod
+    def _close(hold_id, status, condition, today):
+        # A ready hold is closed apart from a waiting one, so the UPDATE
+        # tells whether a copy has to be handed over.
+        with db.atomic():
+            for previous in ('ready', 'waiting'):
+                closed = (Hold.update(status=status)
+                          .where((Hold.id == hold_id) &
+                                 (Hold.status == previous) & condition)
+                          .execute())
+                if closed:
+                    break
+            else:
+                return False
+            if previous == 'ready':
+                book_id = (Hold.select(Hold.book_id)
+                           .where(Hold.id == hold_id)
+                           .scalar())
+                Hold.hand_over(book_id, today)
+        model_cache.invalidate(Hold)
+        return True
+
+    @staticmethod
+    def expire(hold_id, today=None):
+        """Expire a ready hold whose pickup window is over, the copy
+        goes to the next holder.
+
+        return - True when succesfull or False when the hold is not ready
+            or can still be collected
+        """
+        today = today or datetime.date.today()
+        return Hold._close(hold_id, 'expired', (Hold.status == 'ready') &
+                           (Hold.ready_until < today), today)
+
+    @staticmethod
+    def position(hold_id):
+        """Return the place of a waiting hold in its queue, 1 for the
+        first, or None when the hold is not waiting.
+        """
+        row = (Hold.select(Hold.book_id, Hold.status)
+               .where(Hold.id == hold_id)
+               .tuples()
+               .first())
+        if row is None or row[1] != 'waiting':
+            return None
+        return Hold.select().where((Hold.book_id == row[0]) &
+                                   (Hold.status == 'waiting') &
+                                   (Hold.id <= hold_id)).count()
 
 
 class Review(BaseModel):
@@ -322,6 +948,313 @@ class Review(BaseModel):
     published_at = DateField(formats="%Y-%m-%d")
     rating = SmallIntegerField()
 
+    @staticmethod
+    def add_review(customer_id, book_id, text, rating):
+        """Add a review and update the rating summary of the book.
+
+        customer_id - id of the customer that reviews the book
+        book_id - id of the book
+        text - review of the book
+        rating - rating from 1 to 5
+        return - a review obj or None when the rating is out of range
+        """
+        if rating not in BookRating.RATINGS:
+            return None
+        with db.atomic():
+            review = Review.create(customer_id=customer_id, book_id=book_id,
+                                   text=text, rating=rating,
+                                   published_at=datetime.date.today())
+            BookRating.apply(book_id, rating, 1)
+        BookRating.invalidate()
+        return review
+
+    @staticmethod
+    def update_selected(review_id, text=None, rating=None):
+        """Update review by id, keeping the rating summary in step.
+
+        review_id - id of the review you want to update
+        text - review of the book
+        rating - rating from 1 to 5, ignored when out of range
+        return - review obj or None if the review does not exist
+        """
+        with db.atomic():
+            try:
+                review = Review.get_by_id(review_id)
+            except Review.DoesNotExist:
+                return None
+            book_id = review._data['book_id']
+            if text:
+                review.text = text
+            if rating in BookRating.RATINGS and rating != review.rating:
+                BookRating.apply(book_id, review.rating, -1)
+                BookRating.apply(book_id, rating, 1)
+                review.rating = rating
+            review.save()
+        BookRating.invalidate()
+        return review
+
+    @staticmethod
+    def delete_selected(review_id):
+        """Delete review by id and take it out of the rating summary.
+
+        review_id - id of the review
+        """
+        with db.atomic():
+            try:
+                review = Review.get_by_id(review_id)
+            except Review.DoesNotExist:
+                return False
+            review.delete_instance()
+            BookRating.apply(review._data['book_id'], review.rating, -1)
+        BookRating.invalidate()
+        return True
+
+
+class BookRating(BaseModel):
+    """Rating summary of a book, maintained by the Review methods.
+
+    book_id - the book the summary belongs to
+    count - amount of reviews
+    total - sum of all ratings
+    stars_1 .. stars_5 - amount of reviews per rating
+    average - total / count, 0 without reviews
+    """
+
+    RATINGS = (1, 2, 3, 4, 5)
+
+    book_id = ForeignKeyField(Book, primary_key=True)
+    count = IntegerField(default=0)
+    total = IntegerField(default=0)
+    stars_1 = IntegerField(default=0)
+    stars_2 = IntegerField(default=0)
+    stars_3 = IntegerField(default=0)
+    stars_4 = IntegerField(default=0)
+    stars_5 = IntegerField(default=0)
+    average = FloatField(default=0.0, index=True)
+
+    @staticmethod
+    def apply(book_id, rating, delta):
+        """Add (delta 1) or remove (delta -1) a rating of a book.
+
+        Must run inside the transaction that writes the review.
+        """
+        star = 'stars_%d' % rating
+        updated = (BookRating.update(**{
+            'count': BookRating.count + delta,
+            'total': BookRating.total + delta * rating,
+            star: getattr(BookRating, star) + delta})
+            .where(BookRating.book_id == book_id)
+            .execute())
+        if not updated:
+            try:
+                with db.atomic():
+                    BookRating.insert(**{
+                        'book_id': book_id, 'count': delta,
+                        'total': delta * rating, star: delta}).execute()
+            except IntegrityError:
+                # Another transaction created the summary first.
+                return BookRating.apply(book_id, rating, delta)
+        BookRating._update_average(book_id)
+
+    @staticmethod
+    def _update_average(book_id):
+        count, total = (BookRating.select(BookRating.count,
+                                          BookRating.total)
+                        .where(BookRating.book_id == book_id)
+                        .tuples()
+                        .get())
+        average = float(total) / count if count else 0.0
+        (BookRating.update(average=average)
+         .where(BookRating.book_id == book_id)
+         .execute())
+        (BookGenre.update(average=average)
+         .where(BookGenre.book_id == book_id)
+         .execute())
+
+    @staticmethod
+    def invalidate():
+        model_cache.invalidate(BookRating)
+        model_cache.invalidate(BookGenre)
+
+    @staticmethod
+    def top_rated(genre=None, limit=10, min_count=1):
+        """Return the best rated books, optionally within a genre.
+
+        Served from the average index of bookrating, or of bookgenre when
+        a genre is given, instead of aggregating the reviews.
+
+        genre - name of the genre
+        limit - maximum amount of books
+        min_count - skip books with fewer reviews than this
+        return - list of book objs with average and count attributes
+        """
+        if genre is None:
+            query = (Book.select(Book, BookRating.average, BookRating.count)
+                     .join(BookRating)
+                     .order_by(BookRating.average.desc()))
+        else:
+            query = (Book.select(Book, BookGenre.average, BookRating.count)
+                     .join(BookGenre)
+                     .join(Genre)
+                     .switch(Book)
+                     .join(BookRating)
+                     .where(Genre.genre == genre)
+                     .order_by(BookGenre.average.desc()))
+        return list(query.where(BookRating.count >= min_count)
+                    .limit(limit)
+                    .naive())
+
+    @staticmethod
+    def rebuild(batch_size=1000):
+        """Recompute every summary from the reviews to repair drift.
+
+        Reads the reviews grouped per book and rating in book order, so
+        only one batch of summaries is held in memory.
+        """
+        grouped = (Review.select(Review.book_id, Review.rating,
+                                 fn.COUNT(Review.id))
+                   .group_by(Review.book_id, Review.rating)
+                   .order_by(Review.book_id)
+                   .tuples())
+        with db.atomic():
+            BookRating.delete().execute()
+            BookGenre.update(average=0.0).execute()
+            summaries = {}
+            for book_id, rating, amount in grouped:
+                if book_id not in summaries and \
+                        len(summaries) >= batch_size:
+                    BookRating._write_summaries(summaries)
+                    summaries = {}
+                summary = summaries.setdefault(book_id, dict(
+                    book_id=book_id, count=0, total=0, stars_1=0,
+                    stars_2=0, stars_3=0, stars_4=0, stars_5=0))
+                summary['count'] += amount
+                summary['total'] += amount * rating
+                if rating in BookRating.RATINGS:
+                    summary['stars_%d' % rating] += amount
+            BookRating._write_summaries(summaries)
+        BookRating.invalidate()
+
+    @staticmethod
+    def _write_summaries(summaries):
+        if not summaries:
+            return
+        for summary in summaries.values():
+            summary['average'] = float(summary['total']) / summary['count']
+        BookRating.insert_many(list(summaries.values())).execute()
+        for book_id, summary in summaries.items():
+            (BookGenre.update(average=summary['average'])
+             .where(BookGenre.book_id == book_id)
+             .execute())
+
+
+class BookNeighbour(BaseModel):
+    """Precomputed recommendation of a book, written by recommender.py.
+
+    book_id - the book the recommendation is for
+    neighbour_id - the recommended book
+    rank - position among the recommendations of book_id, from 0
+    score - similarity of both books, higher is more alike
+    """
+
+    book_id = ForeignKeyField(Book, related_name='neighbours')
+    neighbour_id = ForeignKeyField(Book, related_name='neighbour_of')
+    rank = SmallIntegerField()
+    score = FloatField()
+
+    class Meta:
+        indexes = (
+            (('book_id', 'rank'), True),
+        )
+
+
+class CatalogueChange(BaseModel):
+    """Change log of the catalogue tables, written by the triggers of
+    snapshot.create_change_log().
+
+    id - position in the log, increasing
+    table_name - book, author, publisher or genre
+    row_id - primary key of the changed row, changes to the genres of a
+        book are logged as a change of the book
+    """
+
+    id = PrimaryKeyField()
+    table_name = CharField(max_length=16)
+    row_id = IntegerField()
+
+
+class LendChange(BaseModel):
+    """Change log of the lend table, written by the triggers of
+    rollups.create_lend_log().
+
+    An insert or delete logs the dates of the row, an update logs the
+    dates before and after it, so the rollups know which days to redo.
+
+    id - position in the log, increasing
+    lent_at - lent_at of the changed lend
+    return_date - return_date of the changed lend
+    returned_at - returned_at of the changed lend
+    """
+
+    id = PrimaryKeyField()
+    lent_at = DateField(formats=["%Y-%m-%d"], null=True)
+    return_date = DateField(formats=["%Y-%m-%d"], null=True)
+    returned_at = DateField(formats=["%Y-%m-%d"], null=True)
+
+
+class LendRollup(BaseModel):
+    """Lending statistics per day or month, maintained by rollups.py.
+
+    period - 'day' or 'month'
+    day - the day, or the first day of the month
+    dimension - 'all', 'book', 'genre' or 'customer'
+    key_id - id of the book, genre or customer, 0 for all
+    loans - lends made
+    returns - lends returned
+    overdues - lends that became overdue, on the day after their return
+        date
+    borrowers - distinct customers with a loan, for all and genre only
+    """
+
+    period = CharField(max_length=8)
+    day = DateField(formats=["%Y-%m-%d"])
+    dimension = CharField(max_length=16)
+    key_id = IntegerField()
+    loans = IntegerField(default=0)
+    returns = IntegerField(default=0)
+    overdues = IntegerField(default=0)
+    borrowers = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('period', 'dimension', 'day', 'key_id'), True),
+        )
+
+
+class Watermark(BaseModel):
+    """Position up to which a derived table has read its source.
+
+    name - what the position is of, e.g. lendchange
+    value - the position, e.g. the id of the last log entry read
+    """
+
+    name = CharField(max_length=64, primary_key=True)
+    value = IntegerField()
+
+
+class TableVersion(BaseModel):
+    """Count of the writes to a table, kept by the triggers of
+    versions.create_version_log().
+
+    name - name of the table
+    version - increases with every row written
+    changed_at - UTC time of the last write, in whole seconds
+    """
+
+    name = CharField(max_length=64, primary_key=True)
+    version = BigIntegerField()
+    changed_at = DateTimeField()
+
 
 class Administrator(BaseModel):
     """Administrator model.
@@ -329,13 +1262,38 @@ class Administrator(BaseModel):
     id - primary key
     email - email of the admin, max length is 254 chars (RFC 3696)
     password - hashed password with bcrypt
+    sessions_revoked_at - seconds since the epoch, session tokens issued
+        until then are rejected
     """
 
     id = PrimaryKeyField()
-    email = CharField(max_length=254)
+    email = CharField(max_length=254, index=True)
     password = CharField(max_length=128)
+    sessions_revoked_at = FloatField(default=0.0)
+
+
+# All models in the order their tables can be created.
+MODELS = [Publisher, Author, Book, Genre, BookGenre, Customer, Lend,
+          Hold, Review, BookRating, BookNeighbour, CatalogueChange, LendChange,
+          LendRollup, Watermark, TableVersion, Administrator]
+
 
+# Models the admin can edit in bulk, by the key of their edits.
+BULK_EDIT_MODELS = dict(publishers=Publisher, authors=Author)
 
-if __name__ == '__main__':
-    refresh_unittest_db()
-    refresh_development_db()
+
+def apply_bulk_edits(edits):
+    """Apply the edits of several models in one transaction.
+
+    edits - dict of a key of BULK_EDIT_MODELS to the edits of that model,
+        see BaseModel.bulk_edit()
+    return - dict with the results of bulk_edit() per key
+    raises - KeyError on an unknown key or an edit without id, TypeError
+        on an unknown field, nothing is written then
+    """
+    unknown = set(edits) - set(BULK_EDIT_MODELS)
+    if unknown:
+        raise KeyError(', '.join(sorted(unknown)))
+    with db.atomic():
+        return dict((key, BULK_EDIT_MODELS[key].bulk_edit(model_edits))
+                    for key, model_edits in edits.items())
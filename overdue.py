@@ -0,0 +1,128 @@
+"""Find overdue lends and build a notice per customer.
+
+Run "python overdue.py" to print the notices for the development db.
+
+Overdue lends are read in batches ordered on (customer, lend id) using
+the indexes declared on Lend.Meta, so only the open lends are scanned
+and never more than one batch is held in memory.
+"""
+import argparse
+import datetime
+import os
+
+from models import *
+
+
+class Notice(object):
+    """Overdue notice for one customer.
+
+    customer_id - id of the customer
+    email - email of the customer
+    name - first name and surname of the customer
+    lends - list of (lend id, book title, return date) tuples
+    """
+
+    __slots__ = ('customer_id', 'email', 'name', 'lends')
+
+    def __init__(self, customer_id, email, name, lends=None):
+        self.customer_id = customer_id
+        self.email = email
+        self.name = name
+        self.lends = lends or []
+
+    def format(self, today):
+        lines = ["Dear %s," % self.name, "",
+                 "The following books should have been returned:"]
+        for _, title, return_date in self.lends:
+            lines.append("- %s, %d days overdue"
+                         % (title, (today - return_date).days))
+        return "\n".join(lines)
+
+
+def iter_overdue_batches(today=None, batch_size=1000):
+    """Yield lists of overdue (lend id, customer id, title, return date).
+
+    Batches follow each other in (customer id, lend id) order.
+    """
+    today = today or datetime.date.today()
+    overdue = (Lend.returned_at >> None) & (Lend.return_date < today)
+    last = None
+    while True:
+        query = (Lend.select(Lend.id, Lend.customer_id, Book.title,
+                             Lend.return_date)
+                 .join(Book, on=(Lend.book_id == Book.id))
+                 .where(overdue))
+        if last is not None:
+            customer_id, lend_id = last
+            query = query.where((Lend.customer_id > customer_id) |
+                                ((Lend.customer_id == customer_id) &
+                                 (Lend.id > lend_id)))
+        rows = list(query.order_by(Lend.customer_id, Lend.id)
+                    .limit(batch_size)
+                    .tuples())
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            return
+        last = (rows[-1][1], rows[-1][0])
+
+
+def _customers(ids):
+    query = (Customer.select(Customer.id, Customer.email,
+                             Customer.first_name, Customer.surname)
+             .where(Customer.id << list(ids))
+             .tuples())
+    return dict((row[0], row[1:]) for row in query)
+
+
+def scan_overdue(today=None, batch_size=1000):
+    """Yield a Notice for every customer with overdue lends."""
+    notice = None
+    for batch in iter_overdue_batches(today, batch_size):
+        customers = _customers(set(row[1] for row in batch))
+        for lend_id, customer_id, title, return_date in batch:
+            if notice is None or notice.customer_id != customer_id:
+                if notice is not None:
+                    yield notice
+                email, first_name, surname = customers[customer_id]
+                notice = Notice(customer_id, email,
+                                "%s %s" % (first_name, surname))
+            notice.lends.append((lend_id, title, _as_date(return_date)))
+    if notice is not None:
+        yield notice
+
+
+def _as_date(value):
+    # SQLite hands dates back as text.
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Print overdue notices per customer.")
+    parser.add_argument('--date', default=None,
+                        help="scan as of this YYYY-MM-DD date")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+    today = datetime.date.today()
+    if args.date:
+        today = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+    notices = 0
+    for notice in scan_overdue(today, args.batch_size):
+        print("To: %s" % notice.email)
+        print(notice.format(today))
+        print()
+        notices += 1
+    print("%d overdue notices" % notices)
+
+
+if __name__ == '__main__':
+    main()
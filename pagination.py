@@ -0,0 +1,182 @@
+"""Keyset (cursor) pagination and chunked iteration for peewee queries.
+
+Pages are selected with a WHERE on the last seen (sort value, id) pair
+instead of an OFFSET, so fetching page 1000 costs the same as page 1 as
+long as the sort column is indexed together with the primary key.
+"""
+import base64
+import datetime
+import json
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+class Page(object):
+    """A single page of results.
+
+    items - list of model objects on this page
+    next_cursor - cursor for the following page or None on the last page
+    prev_cursor - cursor for the previous page or None on the first page
+    sort - name of the column the page is sorted on
+    """
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None,
+                 sort='id'):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.sort = sort
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    __nonzero__ = __bool__
+
+
+# JSON has no dates, they travel as {"date": "2000-01-31"} and
+# {"datetime": "2000-01-31T12:00:00.000000"}. MySQL hands DateFields back
+# as dates, SQLite as the text they were stored as.
+_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.strftime(_DATETIME_FORMAT)}
+    if isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if not isinstance(value, dict):
+        return value
+    if list(value) == ['datetime']:
+        return datetime.datetime.strptime(value['datetime'],
+                                          _DATETIME_FORMAT)
+    if list(value) == ['date']:
+        return datetime.datetime.strptime(value['date'], '%Y-%m-%d').date()
+    raise ValueError("Invalid sort value %r" % value)
+
+
+def encode_cursor(sort_value, pk):
+    """Return an url safe cursor for the (sort value, primary key) pair."""
+    raw = json.dumps([_encode_value(sort_value), pk], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a cursor made by encode_cursor.
+
+    return - a (sort value, primary key) tuple
+    raises - ValueError when the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        sort_value, pk = json.loads(raw.decode('utf-8'))
+        sort_value = _decode_value(sort_value)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor %r" % cursor)
+    if not isinstance(pk, int):
+        raise ValueError("Invalid cursor %r" % cursor)
+    return sort_value, pk
+
+
+def paginate(query, model, sort_field, after=None, before=None,
+             page_size=DEFAULT_PAGE_SIZE):
+    """Return a Page of the query sorted on sort_field and primary key.
+
+    query - the base SelectQuery, must not be ordered or limited yet
+    model - model the primary key belongs to
+    sort_field - field to sort on, the primary key is the tie breaker
+    after - cursor, return the rows following it
+    before - cursor, return the rows preceding it
+    page_size - amount of rows per page, capped at MAX_PAGE_SIZE
+    raises - ValueError on a malformed cursor
+    """
+    page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+    pk = model._meta.primary_key
+    on_pk = sort_field is pk
+
+    def key(obj):
+        value = getattr(obj, sort_field.name)
+        return encode_cursor(value, obj._get_pk_value())
+
+    backwards = before is not None
+    cursor = before if backwards else after
+    if cursor is not None:
+        value, last_pk = decode_cursor(cursor)
+        if on_pk:
+            query = query.where(pk < last_pk if backwards
+                                else pk > last_pk)
+        elif backwards:
+            query = query.where((sort_field < value) |
+                                ((sort_field == value) & (pk < last_pk)))
+        else:
+            query = query.where((sort_field > value) |
+                                ((sort_field == value) & (pk > last_pk)))
+
+    if backwards:
+        order = [pk.desc()] if on_pk else [sort_field.desc(), pk.desc()]
+    else:
+        order = [pk.asc()] if on_pk else [sort_field.asc(), pk.asc()]
+
+    # One extra row tells whether there is another page in this direction.
+    rows = list(query.order_by(*order).limit(page_size + 1))
+    return make_page(rows, page_size, key, sort_field.name, backwards,
+                     cursor is not None)
+
+
+def make_page(rows, page_size, key, sort, backwards=False, has_cursor=False):
+    """Turn the rows read for a page into a Page with its cursors.
+
+    rows - up to page_size + 1 rows in the order they were read, i.e.
+        descending when reading backwards
+    key - function returning the cursor of a row
+    sort - name of the column the rows are sorted on
+    backwards - the rows precede a before cursor
+    has_cursor - the rows were read from a cursor, not from the start
+    """
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if backwards:
+        rows.reverse()
+
+    if not rows:
+        return Page([], sort=sort)
+
+    if backwards:
+        next_cursor = key(rows[-1])
+        prev_cursor = key(rows[0]) if has_more else None
+    else:
+        next_cursor = key(rows[-1]) if has_more else None
+        prev_cursor = key(rows[0]) if has_cursor else None
+    return Page(rows, next_cursor, prev_cursor, sort=sort)
+
+
+def iterate_in_chunks(query, model, chunk_size=1000):
+    """Yield every row of the query, fetching chunk_size rows at a time.
+
+    Rows are read in primary key order with a keyset WHERE per chunk, so
+    at most one chunk of model objects is held in memory.
+
+    query - the base SelectQuery, must not be ordered or limited yet
+    model - model the primary key belongs to
+    chunk_size - amount of rows fetched per round trip
+    """
+    pk = model._meta.primary_key
+    last_pk = None
+    while True:
+        chunk = query if last_pk is None else query.where(pk > last_pk)
+        rows = list(chunk.order_by(pk.asc()).limit(chunk_size))
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+        last_pk = rows[-1]._get_pk_value()
@@ -0,0 +1,204 @@
+"""Connection pooling for the peewee databases.
+
+Connections are handed out per thread and returned to the pool on close()
+instead of being torn down, so a request only pays the connect/auth
+handshake when the pool has no idle connection left. The pool itself is
+the one of playhouse.pool, this module adds waiting for a free
+connection with a timeout, counters and a rollback of what a request
+left open.
+
+Within server_side_cursors() MySQL queries stream their rows from the
+server instead of buffering the whole result in the client, for reads
+too large to hold in memory.
+"""
+import contextlib
+import logging
+import threading
+
+from peewee import OperationalError
+from playhouse import pool as playhouse_pool
+from pymysql.cursors import SSCursor
+
+logger = logging.getLogger('pool')
+_server_side = threading.local()
+
+
+@contextlib.contextmanager
+def server_side_cursors():
+    """Give the MySQL queries this thread runs in the with block
+    unbuffered cursors, on the primary and on replicas alike.
+
+    Rows are fetched from the server as the cursor is read, so the
+    cursor has to be read to the end or closed before the connection
+    runs another query. SQLite cursors always step through their rows.
+    """
+    active = getattr(_server_side, 'active', False)
+    _server_side.active = True
+    try:
+        yield
+    finally:
+        _server_side.active = active
+
+
+class PoolTimeout(OperationalError):
+    """Raised when no connection could be checked out in time."""
+
+
+class PooledDatabase(playhouse_pool.PooledDatabase):
+    """The playhouse pool with a bounded wait for a free connection.
+
+    max_connections - maximum amount of connections open at the same time
+    stale_timeout - seconds after which an idle connection gets recycled,
+        None keeps connections forever
+    timeout - seconds connect() waits for a free connection before raising
+        PoolTimeout, None waits forever and 0 fails immediately
+    """
+
+    def __init__(self, database, max_connections=20, stale_timeout=None,
+                 timeout=None, **kwargs):
+        # The playhouse pool keeps its heap and dicts unlocked.
+        self._pool_lock = threading.RLock()
+        self._stats = dict(hits=0, misses=0, stale=0, timeouts=0)
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_connections)
+        super(PooledDatabase, self).__init__(
+            database, max_connections=max_connections,
+            stale_timeout=stale_timeout, **kwargs)
+
+    def init(self, database, max_connections=None, stale_timeout=None,
+             timeout=None, **connect_kwargs):
+        """Configure the database, optionally resizing the pool.
+
+        The slots of checked out connections go back to the semaphore
+        they came from, so the pool is only resized while none are.
+
+        raises - ValueError when resizing with connections checked out
+        """
+        if max_connections is not None and \
+                max_connections != self.max_connections:
+            with self._pool_lock:
+                if self._in_use:
+                    raise ValueError(
+                        "Can not resize the pool while %d connections are "
+                        "checked out" % len(self._in_use))
+                self.max_connections = max_connections
+                self._slots = threading.BoundedSemaphore(max_connections)
+            self.close_all()
+        super(PooledDatabase, self).init(database, **connect_kwargs)
+        if stale_timeout is not None:
+            self.stale_timeout = stale_timeout
+        if timeout is not None:
+            self.timeout = timeout
+
+    def connect(self):
+        """Check out a connection for the current thread.
+
+        Waits up to `timeout` seconds for a free slot. Calling connect()
+        when the thread already holds a connection is a no-op.
+        """
+        if not self.is_closed():
+            return
+        if not self._acquire_slot():
+            self._count('timeouts')
+            raise PoolTimeout('No connection available within %s seconds'
+                              % self.timeout)
+        try:
+            super(PooledDatabase, self).connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _acquire_slot(self):
+        if self.timeout is None:
+            return self._slots.acquire()
+        if self.timeout <= 0:
+            return self._slots.acquire(False)
+        return self._slots.acquire(True, self.timeout)
+
+    def _count(self, name):
+        with self._pool_lock:
+            self._stats[name] += 1
+
+    def _connect(self, *args, **kwargs):
+        with self._pool_lock:
+            idle = set(id(conn) for _, conn in self._connections)
+            try:
+                conn = super(PooledDatabase, self)._connect(*args, **kwargs)
+            except ValueError:
+                # Connections of execution contexts take no slot.
+                self._stats['timeouts'] += 1
+                raise PoolTimeout('Exceeded maximum connections')
+            self._stats['hits' if id(conn) in idle else 'misses'] += 1
+        return conn
+
+    def _is_stale(self, timestamp):
+        stale = super(PooledDatabase, self)._is_stale(timestamp)
+        if stale:
+            self._count('stale')
+        return stale
+
+    def _close(self, conn, close_conn=False):
+        if conn is None:
+            return
+        with self._pool_lock:
+            checked_out = not close_conn and self.conn_key(conn) in \
+                self._in_use
+            if checked_out:
+                # Discard any transaction a failed request left open.
+                try:
+                    conn.rollback()
+                except Exception:
+                    self._in_use.pop(self.conn_key(conn))
+                    self._close_raw(conn)
+                else:
+                    super(PooledDatabase, self)._close(conn)
+            else:
+                super(PooledDatabase, self)._close(conn, close_conn)
+        if checked_out:
+            try:
+                self._slots.release()
+            except ValueError:
+                # The connection came from an execution context.
+                pass
+
+    def _close_raw(self, conn):
+        try:
+            super(playhouse_pool.PooledDatabase, self)._close(conn)
+        except Exception:
+            logger.debug('Error closing connection %s.', id(conn))
+
+    def close_all(self):
+        """Close all idle connections held by the pool."""
+        # The playhouse pool would keep them in its heap until a checkout
+        # skips them, counted as idle.
+        with self._pool_lock:
+            idle, self._connections = self._connections, []
+        for _, conn in idle:
+            self._close_raw(conn)
+
+    def pool_stats(self):
+        """Return the pool counters.
+
+        return - dict with hits, misses, stale, timeouts, idle and in_use
+        """
+        with self._pool_lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._connections)
+            stats['in_use'] = len(self._in_use)
+        return stats
+
+
+class PooledMySQLDatabase(PooledDatabase,
+                          playhouse_pool.PooledMySQLDatabase):
+    def get_cursor(self):
+        if getattr(_server_side, 'active', False):
+            return self.get_conn().cursor(SSCursor)
+        return super(PooledMySQLDatabase, self).get_cursor()
+
+
+class PooledSqliteDatabase(PooledDatabase,
+                           playhouse_pool.PooledSqliteDatabase):
+    def __init__(self, database, **kwargs):
+        # Pooled connections move between threads.
+        kwargs.setdefault('check_same_thread', False)
+        super(PooledSqliteDatabase, self).__init__(database, **kwargs)
@@ -0,0 +1,27 @@
+"""Rebuild the rating summaries of all books from the reviews.
+
+Run "python ratings.py" when the summaries drifted from the review
+table, e.g. after reviews were changed by hand in the database.
+"""
+import argparse
+import os
+
+from models import *
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+    print("Rebuilding rating summaries")
+    BookRating.rebuild(args.batch_size)
+    print("done")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+"""Precompute alike books from the lending and review history.
+
+Run "python recommender.py build" after installing
+requirements-recommend.txt to store the TOP_K most alike books of every
+book in the bookneighbour table, and "python recommender.py refresh",
+e.g. from cron, to fold in the lends made since. Book.recommend() reads
+the stored neighbours, so the app itself does not need NumPy.
+
+Two books are alike when the same customers lent and liked them: the
+score is the cosine of their columns in the sparse customer by book
+matrix of lends and centered ratings, blended with the cosine of their
+genres. Books with few lends are topped up with the most lent books of
+their genres.
+
+A refresh only reads the lends after the last one it saw and recomputes
+the books lent by the customers of those lends. Edited reviews, and the
+small change in score towards books co-lent by other customers, are
+picked up by the next build.
+"""
+import argparse
+import os
+
+import numpy
+import scipy.sparse
+
+from models import *
+from cache import model_cache
+
+TOP_K = 20
+# Weight of a lend and of a 5 star rating in the customer by book matrix,
+# a 1 star rating counts as -RATING_WEIGHT.
+LEND_WEIGHT = 1.0
+RATING_WEIGHT = 0.5
+# Share of the genre cosine in the score of a neighbour.
+GENRE_WEIGHT = 0.2
+# Neighbours kept per book by lends before the genres are blended in.
+CANDIDATES = 10 * TOP_K
+STATE_PATH = os.getenv('RECOMMENDER_STATE', 'recommender.npz')
+
+
+def _read(query, columns, chunk_size=100000):
+    # Raw cursor reads, building a model or tuple per row of millions of
+    # lends would take longer than the computation itself.
+    cursor = db.execute_sql(*query.sql())
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunks.append(numpy.array(rows, dtype=numpy.int64))
+    if not chunks:
+        return numpy.zeros((0, columns), dtype=numpy.int64)
+    return numpy.concatenate(chunks)
+
+
+def _matrix(rows, cols, values, shape):
+    return scipy.sparse.coo_matrix((values, (rows, cols)),
+                                   shape=shape).tocsr()
+
+
+def _resized(matrix, shape):
+    matrix = matrix.tocoo()
+    return _matrix(matrix.row, matrix.col, matrix.data, shape)
+
+
+def _normalize_rows(matrix):
+    norms = numpy.sqrt(numpy.asarray(
+        matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return scipy.sparse.diags(1 / norms) @ matrix
+
+
+def _top(cols, scores, k):
+    """Return the k best scoring cols and their scores, best first."""
+    if len(scores) > k:
+        best = numpy.argpartition(-scores, k)[:k]
+        cols, scores = cols[best], scores[best]
+    # Ties are broken on the book id so builds are reproducible.
+    order = numpy.lexsort((cols, -scores))
+    return cols[order], scores[order]
+
+
+def _candidates(similar, batch, n):
+    """Return rows, cols and scores of the n best positive scores per
+    row of a csr matrix, leaving out each book itself.
+    """
+    rows, cols, scores = [], [], []
+    for row, book_id in enumerate(batch):
+        span = slice(similar.indptr[row], similar.indptr[row + 1])
+        row_cols, row_scores = similar.indices[span], similar.data[span]
+        keep = (row_cols != book_id) & (row_scores > 0)
+        row_cols, row_scores = row_cols[keep], row_scores[keep]
+        if len(row_scores) > n:
+            best = numpy.argpartition(-row_scores, n)[:n]
+            row_cols, row_scores = row_cols[best], row_scores[best]
+        rows.append(numpy.full(len(row_cols), row))
+        cols.append(row_cols)
+        scores.append(row_scores)
+    return (numpy.concatenate(rows).astype(numpy.int64),
+            numpy.concatenate(cols).astype(numpy.int64),
+            numpy.concatenate(scores))
+
+
+def _top_per_row(rows, cols, scores, k):
+    """Keep the k best scoring entries of every row.
+
+    return - rows, cols and scores sorted on row and then best first
+    """
+    # Ties are broken on the book id so builds are reproducible.
+    order = numpy.lexsort((cols, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    rank = numpy.arange(len(rows)) - numpy.searchsorted(rows, rows)
+    keep = rank < k
+    return rows[keep], cols[keep], scores[keep]
+
+
+def read_lends(after=0):
+    """Return (id, customer id, book id) rows of the lends after an id."""
+    return _read(Lend.select(Lend.id, Lend.customer_id, Lend.book_id)
+                 .where(Lend.id > after)
+                 .order_by(Lend.id), 3)
+
+
+def read_ratings():
+    """Return (customer id, book id, rating) rows of all reviews."""
+    return _read(Review.select(Review.customer_id, Review.book_id,
+                               Review.rating), 3)
+
+
+def read_genres():
+    """Return (book id, genre id) rows of all books."""
+    return _read(BookGenre.select(BookGenre.book_id, BookGenre.genre_id), 2)
+
+
+def read_books():
+    """Return the ids of all books."""
+    return _read(Book.select(Book.id).order_by(Book.id), 1).ravel()
+
+
+class Recommender(object):
+    """Sparse history of the library and the state of the last build.
+
+    Customer and book ids are used as row and column numbers directly.
+
+    lends - customer by book csr matrix, 1 where the customer lent the book
+    ratings - customer by book csr matrix of the ratings, centered on 3
+        stars and scaled to -1 .. 1
+    genres - book by genre csr matrix, 1 where the book has the genre
+    last_lend_id - id of the last lend in lends
+    """
+
+    def __init__(self, lends, ratings, genres, last_lend_id):
+        self.lends = lends
+        self.ratings = ratings
+        self.genres = genres
+        self.last_lend_id = last_lend_id
+
+    @classmethod
+    def from_database(cls):
+        """Read the whole history, in a handful of queries."""
+        lends, ratings, genres = read_lends(), read_ratings(), read_genres()
+        books = read_books()
+        customers = max([1] + [int(rows[:, column].max()) + 1
+                               for rows, column in [(lends, 1), (ratings, 0)]
+                               if len(rows)])
+        shape = (customers, int(books.max()) + 1 if len(books) else 1)
+        recommender = cls(_matrix([], [], [], shape),
+                          _matrix(ratings[:, 0], ratings[:, 1],
+                                  (ratings[:, 2] - 3) / 2.0, shape),
+                          None, 0)
+        recommender.add_lends(lends)
+        recommender.set_genres(genres)
+        return recommender
+
+    @classmethod
+    def load(cls, path):
+        """Return the recommender saved at path."""
+        with numpy.load(path) as state:
+            shape = tuple(state['shape'])
+            lends = scipy.sparse.csr_matrix(
+                (numpy.ones(len(state['lends_indices'])),
+                 state['lends_indices'], state['lends_indptr']), shape)
+            ratings = scipy.sparse.csr_matrix(
+                (state['ratings_data'], state['ratings_indices'],
+                 state['ratings_indptr']), shape)
+            return cls(lends, ratings, None, int(state['last_lend_id']))
+
+    def save(self, path):
+        """Write the history to path, genres are read again on load."""
+        # Written next to path and renamed, a crash never leaves half a
+        # state behind.
+        partial = path + '.partial.npz'
+        numpy.savez(partial, shape=numpy.array(self.lends.shape),
+                    lends_indices=self.lends.indices,
+                    lends_indptr=self.lends.indptr,
+                    ratings_data=self.ratings.data,
+                    ratings_indices=self.ratings.indices,
+                    ratings_indptr=self.ratings.indptr,
+                    last_lend_id=numpy.array(self.last_lend_id))
+        os.replace(partial, path)
+
+    def _grow(self, customers, books):
+        shape = (max(customers, self.lends.shape[0]),
+                 max(books, self.lends.shape[1]))
+        if shape != self.lends.shape:
+            self.lends = _resized(self.lends, shape)
+            self.ratings = _resized(self.ratings, shape)
+
+    def add_lends(self, rows):
+        """Add (id, customer id, book id) rows of new lends.
+
+        return - array of the ids of the books whose neighbours changed,
+            the books lent by the customers of the new lends
+        """
+        if not len(rows):
+            return numpy.zeros(0, dtype=numpy.int64)
+        self._grow(int(rows[:, 1].max()) + 1, int(rows[:, 2].max()) + 1)
+        new = _matrix(rows[:, 1], rows[:, 2], numpy.ones(len(rows)),
+                      self.lends.shape)
+        self.lends = self.lends.maximum(new).tocsr()
+        self.lends.data[:] = 1
+        self.last_lend_id = max(self.last_lend_id, int(rows[:, 0].max()))
+        customers = numpy.unique(rows[:, 1])
+        return numpy.unique(self.lends[customers].indices)
+
+    def set_genres(self, rows):
+        """Replace the genres with (book id, genre id) rows."""
+        genres = int(rows[:, 1].max()) + 1 if len(rows) else 1
+        self.genres = _matrix(rows[:, 0], rows[:, 1], numpy.ones(len(rows)),
+                              (self.lends.shape[1], genres))
+
+    def _popular(self, k):
+        # Most lent books per genre, to top up books with few lends.
+        counts = numpy.asarray(self.lends.sum(axis=0)).ravel()
+        by_genre = self.genres.tocsc()
+        popular = []
+        for genre in range(by_genre.shape[1]):
+            books = by_genre.indices[
+                by_genre.indptr[genre]:by_genre.indptr[genre + 1]]
+            popular.append(_top(books, counts[books], k)[0])
+        return popular
+
+    def neighbours(self, book_ids, k=TOP_K, batch_size=1000):
+        """Yield (book id, [(neighbour id, score), ...]) best first.
+
+        The similarities of batch_size books are computed at a time with
+        a sparse matrix product, so memory stays bounded however many
+        books there are.
+        """
+        history = (LEND_WEIGHT * self.lends +
+                   RATING_WEIGHT * self.ratings).tocsr()
+        books = _normalize_rows(history.T.tocsr())
+        history = books.T.tocsr()
+        genres = _normalize_rows(self.genres).tocsr()
+        popular = self._popular(k)
+        book_ids = numpy.asarray(book_ids, dtype=numpy.int64)
+        for start in range(0, len(book_ids), batch_size):
+            batch = book_ids[start:start + batch_size]
+            rows, cols, scores = _candidates(books[batch] @ history, batch,
+                                             CANDIDATES)
+            rows, cols, scores = self._top_up(batch, rows, cols, scores,
+                                              popular, k)
+            if len(rows):
+                overlap = numpy.asarray(genres[batch[rows]].multiply(
+                    genres[cols]).sum(axis=1)).ravel()
+                scores = ((1 - GENRE_WEIGHT) * scores +
+                          GENRE_WEIGHT * overlap)
+            keep = scores > 0
+            rows, cols, scores = _top_per_row(
+                rows[keep], cols[keep], scores[keep], k)
+            bounds = numpy.searchsorted(rows, numpy.arange(len(batch) + 1))
+            for row, book_id in enumerate(batch):
+                span = slice(bounds[row], bounds[row + 1])
+                yield int(book_id), list(zip(cols[span].tolist(),
+                                             scores[span].tolist()))
+
+    def _top_up(self, batch, rows, cols, scores, popular, k):
+        # Books with fewer than k neighbours by lends get the popular
+        # books of their genres as candidates, scored on genres alone.
+        bounds = numpy.searchsorted(rows, numpy.arange(len(batch) + 1))
+        indptr, indices = self.genres.indptr, self.genres.indices
+        extra_rows, extra_cols = [rows], [cols]
+        for row in numpy.flatnonzero(numpy.diff(bounds) < k):
+            book_id = batch[row]
+            book_genres = indices[indptr[book_id]:indptr[book_id + 1]]
+            if not len(book_genres):
+                continue
+            extra = numpy.setdiff1d(
+                numpy.concatenate([popular[genre] for genre in book_genres]),
+                numpy.append(cols[bounds[row]:bounds[row + 1]], book_id))
+            extra_rows.append(numpy.full(len(extra), row))
+            extra_cols.append(extra)
+        rows = numpy.concatenate(extra_rows)
+        cols = numpy.concatenate(extra_cols)
+        scores = numpy.concatenate(
+            [scores, numpy.zeros(len(rows) - len(scores))])
+        return rows, cols, scores
+
+
+def store(neighbours, batch_size=1000, chunk_size=500):
+    """Replace the stored neighbours of books, batch_size books per
+    transaction.
+
+    neighbours - iterable of (book id, [(neighbour id, score), ...])
+    return - amount of books written
+    """
+    # executemany() on a prepared INSERT, compiling an insert_many()
+    # query for every chunk takes longer than computing the neighbours.
+    fields = [BookNeighbour.book_id, BookNeighbour.neighbour_id,
+              BookNeighbour.rank, BookNeighbour.score]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        BookNeighbour._meta.db_table,
+        ', '.join(field.db_column for field in fields),
+        ', '.join([db.interpolation] * len(fields)))
+    written = 0
+    batch = []
+
+    def flush():
+        book_ids = [int(book_id) for book_id, _ in batch]
+        rows = [(book_id, neighbour_id, rank, score)
+                for book_id, ranked in batch
+                for rank, (neighbour_id, score) in enumerate(ranked)]
+        with db.atomic():
+            # Chunked to stay below the bound parameter limit of SQLite.
+            for start in range(0, len(book_ids), chunk_size):
+                (BookNeighbour.delete()
+                 .where(BookNeighbour.book_id <<
+                        book_ids[start:start + chunk_size])
+                 .execute())
+            db.get_cursor().executemany(sql, rows)
+
+    try:
+        for item in neighbours:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush()
+                written += len(batch)
+                batch = []
+        if batch:
+            flush()
+            written += len(batch)
+    finally:
+        model_cache.invalidate(BookNeighbour)
+    return written
+
+
+def build(path=STATE_PATH, k=TOP_K, batch_size=1000):
+    """Compute the neighbours of every book and save the state to path.
+
+    return - amount of books written
+    """
+    recommender = Recommender.from_database()
+    written = store(recommender.neighbours(read_books(), k, batch_size),
+                    batch_size)
+    recommender.save(path)
+    return written
+
+
+def refresh(path=STATE_PATH, k=TOP_K, batch_size=1000):
+    """Fold the lends made since the last build or refresh into the
+    neighbours. Runs a full build when there is no state at path yet.
+
+    return - amount of books written
+    """
+    if not os.path.exists(path):
+        return build(path, k, batch_size)
+    recommender = Recommender.load(path)
+    old_books = recommender.lends.shape[1]
+    changed = recommender.add_lends(read_lends(recommender.last_lend_id))
+    books = read_books()
+    # New books get their genre based neighbours right away.
+    changed = numpy.union1d(changed, books[books >= old_books])
+    recommender._grow(0, int(books.max()) + 1 if len(books) else 1)
+    recommender.set_genres(read_genres())
+    written = store(recommender.neighbours(changed, k, batch_size),
+                    batch_size)
+    # Saved last, an interrupted refresh is simply done again.
+    recommender.save(path)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['build', 'refresh'])
+    parser.add_argument('--state', default=STATE_PATH,
+                        help="file holding the history between runs")
+    parser.add_argument('--top', type=int, default=TOP_K,
+                        help="neighbours stored per book")
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+    run = build if args.command == 'build' else refresh
+    print("%d books written" % run(args.state, args.top, args.batch_size))
+
+
+if __name__ == '__main__':
+    main()
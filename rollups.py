@@ -0,0 +1,515 @@
+"""Daily and monthly lending statistics kept in the lendrollup table.
+
+Run "python rollups.py build" once to compute the rollups from the whole
+lend table, and "python rollups.py refresh", e.g. from cron, to fold in
+the lends changed since. Reports and the lending dashboard only read the
+rollups, never the lends.
+
+Triggers log the dates of every lend that is added, changed or deleted
+in the lendchange table. A refresh reads the log after its watermark and
+recomputes the days those dates fall on, from the lends of that day
+only, and then the months of those days from their days. Recomputing a
+day is idempotent, so log entries read twice do no harm. The days since
+the last refresh are redone as well, because lends become overdue by
+the date passing rather than by a change.
+
+A log entry can become visible after entries with a higher id, when its
+transaction commits last. The watermark stops before such a gap and the
+entries after it are read again by the next refresh. A gap still open
+then belongs to a transaction that rolled back and is skipped.
+"""
+import argparse
+import collections
+import datetime
+import os
+
+from models import *
+from cache import model_cache
+
+DIMENSIONS = ('all', 'book', 'genre', 'customer')
+MEASURES = ('loans', 'returns', 'overdues', 'borrowers')
+# Dimensions whose rows count distinct borrowers.
+BORROWER_DIMENSIONS = ('all', 'genre')
+# Rollup rows per INSERT, 9 columns stay below the bound parameter
+# limit of SQLite.
+INSERT_BATCH = 100
+COLUMNS = ('period', 'day', 'dimension', 'key_id') + MEASURES
+
+
+class Row(object):
+    """Statistics of one day or month of a dimension.
+
+    day - the day, or the first day of the month
+    key_id - id of the book, genre or customer, 0 for all
+    """
+
+    __slots__ = ('day', 'key_id', 'loans', 'returns', 'overdues',
+                 'borrowers')
+
+    def __init__(self, day, key_id, loans=0, returns=0, overdues=0,
+                 borrowers=0):
+        self.day = day
+        self.key_id = key_id
+        self.loans = loans
+        self.returns = returns
+        self.overdues = overdues
+        self.borrowers = borrowers
+
+
+def _as_date(value):
+    # SQLite hands dates back as text in raw and aggregate queries.
+    if value is None or isinstance(value, datetime.date):
+        return value
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def month_of(day):
+    """Return the first day of the month of day."""
+    return day.replace(day=1)
+
+
+def _next_month(first):
+    return (first + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _next_day(day):
+    return day + datetime.timedelta(days=1)
+
+
+_SQLITE_TRIGGERS = [
+    ('ai', """CREATE TRIGGER IF NOT EXISTS {name} AFTER INSERT ON {table}
+    BEGIN
+        INSERT INTO {log} ({columns}) VALUES ({new});
+    END"""),
+    ('au', """CREATE TRIGGER IF NOT EXISTS {name} AFTER UPDATE ON {table}
+    WHEN {sqlite_changed}
+    BEGIN
+        INSERT INTO {log} ({columns}) VALUES ({old});
+        INSERT INTO {log} ({columns}) VALUES ({new});
+    END"""),
+    ('ad', """CREATE TRIGGER IF NOT EXISTS {name} AFTER DELETE ON {table}
+    BEGIN
+        INSERT INTO {log} ({columns}) VALUES ({old});
+    END"""),
+]
+
+_MYSQL_TRIGGERS = [
+    ('ai', """CREATE TRIGGER `{name}` AFTER INSERT ON `{table}`
+    FOR EACH ROW
+        INSERT INTO `{log}` ({columns}) VALUES ({new})"""),
+    ('au', """CREATE TRIGGER `{name}` AFTER UPDATE ON `{table}`
+    FOR EACH ROW
+    BEGIN
+        IF NOT ({mysql_unchanged}) THEN
+            INSERT INTO `{log}` ({columns}) VALUES ({old});
+            INSERT INTO `{log}` ({columns}) VALUES ({new});
+        END IF;
+    END"""),
+    ('ad', """CREATE TRIGGER `{name}` AFTER DELETE ON `{table}`
+    FOR EACH ROW
+        INSERT INTO `{log}` ({columns}) VALUES ({old})"""),
+]
+
+
+def create_lend_log(database=None):
+    """Create the triggers filling the lend change log, safe to call more
+    than once. Does nothing while the lendchange table is missing.
+
+    database - defaults to the database of the Lend model
+    """
+    database = database or Lend._meta.database
+    database = getattr(database, 'obj', database)
+    log = LendChange._meta.db_table
+    if log not in database.get_tables():
+        return
+    mysql = isinstance(database, MySQLDatabase)
+    existing = set()
+    if mysql:
+        existing = set(row[0] for row in database.execute_sql(
+            'SELECT trigger_name FROM information_schema.triggers '
+            'WHERE trigger_schema = DATABASE()'))
+    logged = ['lent_at', 'return_date', 'returned_at']
+    # Moving a lend to another book or customer changes their rollups.
+    watched = logged + [Lend.book_id.db_column, Lend.customer_id.db_column]
+    new, old = ('NEW.', 'OLD.') if mysql else ('new.', 'old.')
+    values = dict(
+        table=Lend._meta.db_table, log=log, columns=', '.join(logged),
+        new=', '.join(new + column for column in logged),
+        old=', '.join(old + column for column in logged),
+        sqlite_changed=' OR '.join('old.%s IS NOT new.%s' % (c, c)
+                                   for c in watched),
+        mysql_unchanged=' AND '.join('NEW.`%s` <=> OLD.`%s`' % (c, c)
+                                     for c in watched))
+    for suffix, statement in _MYSQL_TRIGGERS if mysql else _SQLITE_TRIGGERS:
+        values['name'] = 'lend_rollup_%s' % suffix
+        if values['name'] not in existing:
+            database.execute_sql(statement.format(**values))
+
+
+def _watermarks():
+    return dict(Watermark.select(Watermark.name, Watermark.value).where(
+        Watermark.name << ['lendchange', 'lendchange_seen', 'lendrollup_day']
+    ).tuples())
+
+
+def _set_watermark(name, value):
+    if not Watermark.update(value=value).where(
+            Watermark.name == name).execute():
+        Watermark.create(name=name, value=value)
+
+
+def latest_change():
+    """Return the id of the newest lend change log entry, 0 when empty."""
+    return LendChange.select(fn.MAX(LendChange.id)).scalar() or 0
+
+
+def prune_changes(up_to):
+    """Delete the lend change log entries up to and including up_to.
+
+    The newest entry is always kept, so the ids of new entries never
+    go back to ones a refresh already read past.
+
+    return - amount of deleted entries
+    """
+    up_to = min(up_to, latest_change() - 1)
+    return LendChange.delete().where(LendChange.id <= up_to).execute()
+
+
+def _advance(position, seen, ids):
+    # Stop before the first gap that was not there at the last refresh,
+    # ids up to seen were visible then.
+    for change_id in ids:
+        if change_id != position + 1 and change_id > seen:
+            break
+        position = change_id
+    return position
+
+
+def _lends(field, condition):
+    # (date of field, book id, customer id, genre id, lend id) with a
+    # row per genre of the book. Raw rows, as the lends of whole months
+    # are read by a build.
+    query = (Lend.select(field, Lend.book_id, Lend.customer_id,
+                         BookGenre.genre_id, Lend.id)
+             .join(BookGenre, JOIN.LEFT_OUTER,
+                   on=(Lend.book_id == BookGenre.book_id))
+             .where(condition))
+    sql, params = query.sql()
+    return db.execute_sql(sql, params, require_commit=False).fetchall()
+
+
+def _insert(rows):
+    # Raw multi-row INSERTs, insert_many() spends more time building the
+    # statements than the database spends running them.
+    placeholders = '(%s)' % ', '.join([db.interpolation] * len(COLUMNS))
+    for start in range(0, len(rows), INSERT_BATCH):
+        chunk = rows[start:start + INSERT_BATCH]
+        db.execute_sql('INSERT INTO %s (%s) VALUES %s' % (
+            LendRollup._meta.db_table, ', '.join(COLUMNS),
+            ', '.join([placeholders] * len(chunk))),
+            [value for row in chunk for value in row])
+
+
+def rebuild_days(start, end, today):
+    """Recompute the day rows from start to end, both included, from the
+    lends of those days.
+
+    Lends that became overdue on a day are only counted when the day is
+    not after today.
+
+    return - amount of rows written
+    """
+    one_day = datetime.timedelta(days=1)
+    # (measure index, shift from the date to the day counted on, lends)
+    measures = [
+        (0, 0, _lends(Lend.lent_at, Lend.lent_at.between(start, end))),
+        (1, 0, _lends(Lend.returned_at,
+                      Lend.returned_at.between(start, end)))]
+    if start <= today:
+        measures.append((2, 1, _lends(Lend.return_date, (
+            Lend.return_date.between(start - one_day,
+                                     min(end, today) - one_day) &
+            ((Lend.returned_at >> None) |
+             (Lend.returned_at > Lend.return_date))))))
+    days = {}
+    counts = collections.defaultdict(lambda: [0, 0, 0, set()])
+    for measure, shift, lends in measures:
+        counted = set()
+        for value, book_id, customer_id, genre_id, lend_id in lends:
+            day = days.get((value, shift))
+            if day is None:
+                day = days[value, shift] = _as_date(value) + shift * one_day
+            keys = [] if genre_id is None else [(day, 'genre', genre_id)]
+            if lend_id not in counted:
+                counted.add(lend_id)
+                keys.extend([(day, 'all', 0), (day, 'book', book_id),
+                             (day, 'customer', customer_id)])
+            for key in keys:
+                entry = counts[key]
+                entry[measure] += 1
+                if measure == 0:
+                    entry[3].add(customer_id)
+    rows = [('day', day, dimension, key_id, loans, returns, overdues,
+             len(borrowers) if dimension in BORROWER_DIMENSIONS else 0)
+            for (day, dimension, key_id), (loans, returns, overdues,
+                                           borrowers) in counts.items()]
+    LendRollup.delete().where((LendRollup.period == 'day') &
+                              (LendRollup.dimension << DIMENSIONS) &
+                              LendRollup.day.between(start, end)).execute()
+    _insert(rows)
+    return len(rows)
+
+
+def rebuild_month(first):
+    """Recompute the month rows of the month starting at first from its
+    day rows, and its distinct borrowers from its lends.
+
+    return - amount of rows written
+    """
+    last = _next_month(first) - datetime.timedelta(days=1)
+    sums = (LendRollup.select(LendRollup.dimension, LendRollup.key_id,
+                              fn.SUM(LendRollup.loans),
+                              fn.SUM(LendRollup.returns),
+                              fn.SUM(LendRollup.overdues))
+            .where((LendRollup.period == 'day') &
+                   (LendRollup.dimension << DIMENSIONS) &
+                   LendRollup.day.between(first, last))
+            .group_by(LendRollup.dimension, LendRollup.key_id)
+            .sql())
+    rows = dict(((dimension, key_id),
+                 ['month', first, dimension, key_id, int(loans),
+                  int(returns), int(overdues), 0])
+                for dimension, key_id, loans, returns, overdues in
+                db.execute_sql(*sums, require_commit=False).fetchall())
+    # Borrowers of the days do not add up to those of the month.
+    in_month = Lend.lent_at.between(first, last)
+    borrowers = fn.COUNT(fn.DISTINCT(Lend.customer_id))
+    if ('all', 0) in rows:
+        rows['all', 0][-1] = \
+            Lend.select(borrowers).where(in_month).scalar()
+    query = (Lend.select(BookGenre.genre_id, borrowers)
+             .join(BookGenre, on=(Lend.book_id == BookGenre.book_id))
+             .where(in_month)
+             .group_by(BookGenre.genre_id)
+             .tuples())
+    for genre_id, count in query:
+        if ('genre', genre_id) in rows:
+            rows['genre', genre_id][-1] = count
+    LendRollup.delete().where((LendRollup.period == 'month') &
+                              (LendRollup.dimension << DIMENSIONS) &
+                              (LendRollup.day == first)).execute()
+    _insert(list(rows.values()))
+    return len(rows)
+
+
+def _runs(days):
+    # Consecutive days within a month as (first, last) tuples.
+    runs = []
+    for day in sorted(days):
+        if runs and runs[-1][1] + datetime.timedelta(days=1) == day and \
+                month_of(runs[-1][0]) == month_of(day):
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return runs
+
+
+def _rebuild(days, today):
+    for start, end in _runs(days):
+        rebuild_days(start, end, today)
+    for first in sorted(set(month_of(day) for day in days)):
+        rebuild_month(first)
+
+
+def build(today=None):
+    """Compute all rollups from the lend table.
+
+    The position in the change log is read first, so lends changed
+    during the build are redone by the next refresh. Each month is
+    committed on its own.
+
+    return - amount of days computed
+    """
+    today = today or datetime.date.today()
+    position = latest_change()
+    first = last = None
+    for field, shift in ((Lend.lent_at, 0), (Lend.returned_at, 0),
+                         (Lend.return_date, 1)):
+        low, high = Lend.select(fn.MIN(field), fn.MAX(field)).scalar(
+            as_tuple=True)
+        if low is not None:
+            low = _as_date(low) + datetime.timedelta(days=shift)
+            high = _as_date(high) + datetime.timedelta(days=shift)
+            first = low if first is None else min(first, low)
+            last = high if last is None else max(last, high)
+    # The lendrollup_built watermark moves with every commit, so the
+    # version of the lending dashboard does, see versions.py.
+    with db.atomic():
+        LendRollup.delete().execute()
+        _set_watermark('lendrollup_built', 0)
+    days = 0
+    month = first and month_of(first)
+    while first is not None and month <= last:
+        end = _next_month(month) - datetime.timedelta(days=1)
+        with db.atomic():
+            rebuild_days(month, end, today)
+            rebuild_month(month)
+            _set_watermark('lendrollup_built', month.toordinal())
+        days += (end - month).days + 1
+        month = _next_month(month)
+    with db.atomic():
+        _set_watermark('lendchange', position)
+        _set_watermark('lendchange_seen', position)
+        _set_watermark('lendrollup_day', today.toordinal())
+        prune_changes(position)
+    model_cache.invalidate(LendRollup)
+    return days
+
+
+def refresh(today=None):
+    """Fold the lends changed since the last build or refresh into the
+    rollups. Runs a build when there was none yet.
+
+    return - amount of days recomputed
+    """
+    today = today or datetime.date.today()
+    marks = _watermarks()
+    if 'lendrollup_day' not in marks:
+        return build(today)
+    with db.atomic():
+        position = marks['lendchange']
+        changes = list(LendChange.select(LendChange.id, LendChange.lent_at,
+                                         LendChange.return_date,
+                                         LendChange.returned_at)
+                       .where(LendChange.id > position)
+                       .order_by(LendChange.id)
+                       .tuples())
+        days = set()
+        for _, lent_at, return_date, returned_at in changes:
+            days.update((_as_date(lent_at), _as_date(returned_at)))
+            if return_date is not None:
+                days.add(_as_date(return_date) + datetime.timedelta(days=1))
+        days.discard(None)
+        # Lends fell due on the days since the last refresh.
+        last = datetime.date.fromordinal(marks['lendrollup_day'])
+        days.update(last + datetime.timedelta(days=offset)
+                    for offset in range(1, (today - last).days + 1))
+        _rebuild(days, today)
+        ids = [row[0] for row in changes]
+        position = _advance(position, marks['lendchange_seen'], ids)
+        _set_watermark('lendchange', position)
+        _set_watermark('lendchange_seen',
+                       max([marks['lendchange_seen']] + ids))
+        _set_watermark('lendrollup_day', max(today, last).toordinal())
+        prune_changes(position)
+    model_cache.invalidate(LendRollup)
+    return len(days)
+
+
+def _rollups(period, dimension, start, end):
+    return LendRollup.select().where(
+        (LendRollup.period == period) & (LendRollup.dimension == dimension) &
+        LendRollup.day.between(start, end))
+
+
+def series(start, end, dimension='all', key_id=0, period='day'):
+    """Return a Row per day or month from start to end, both included,
+    for one key of a dimension. Days and months without lends are Rows
+    of zeros.
+
+    period - 'day' or 'month', start and end are rounded down to their
+        month for months
+    """
+    if period == 'month':
+        start, end = month_of(start), month_of(end)
+        step = _next_month
+    else:
+        step = _next_day
+    stored = dict((_as_date(rollup.day), rollup) for rollup in
+                  _rollups(period, dimension, start, end)
+                  .where(LendRollup.key_id == key_id))
+    rows = []
+    day = start
+    while day <= end:
+        rollup = stored.get(day)
+        rows.append(Row(day, key_id) if rollup is None else
+                    Row(day, key_id, rollup.loans, rollup.returns,
+                        rollup.overdues, rollup.borrowers))
+        day = step(day)
+    return rows
+
+
+def top(dimension, start, end, measure='loans', limit=10):
+    """Return the keys of a dimension with the highest total of a measure
+    from start to end, both included.
+
+    Whole months are read from the month rows and only the days before
+    and after them from the day rows.
+
+    measure - loans, returns or overdues, borrowers do not add up
+    return - list of (key id, total) tuples, highest first
+    """
+    if measure not in MEASURES[:3]:
+        raise ValueError("Can not add up %s" % measure)
+    one_day = datetime.timedelta(days=1)
+    # The whole months run from first up to before after.
+    first = start if start.day == 1 else _next_month(month_of(start))
+    after = month_of(_next_day(end))
+    if first < after:
+        parts = [('month', first, after - one_day)]
+        if start < first:
+            parts.append(('day', start, first - one_day))
+        if after <= end:
+            parts.append(('day', after, end))
+    else:
+        parts = [('day', start, end)]
+    column = getattr(LendRollup, measure)
+    totals = collections.Counter()
+    for period, part_start, part_end in parts:
+        query = (_rollups(period, dimension, part_start, part_end)
+                 .select(LendRollup.key_id, fn.SUM(column))
+                 .group_by(LendRollup.key_id))
+        if len(parts) == 1:
+            query = query.order_by(fn.SUM(column).desc(),
+                                   LendRollup.key_id).limit(limit)
+        for key_id, total in db.execute_sql(
+                *query.sql(), require_commit=False).fetchall():
+            totals[key_id] += int(total)
+    return [(key_id, total) for key_id, total in totals.most_common(limit)
+            if total]
+
+
+def breakdown(dimension, day, period='month'):
+    """Return a Row per key of a dimension for one day or month.
+
+    day - the day, or a day of the month
+    return - list of Rows, most loans first
+    """
+    if period == 'month':
+        day = month_of(day)
+    return [Row(day, rollup.key_id, rollup.loans, rollup.returns,
+                rollup.overdues, rollup.borrowers)
+            for rollup in _rollups(period, dimension, day, day)
+            .order_by(LendRollup.loans.desc(), LendRollup.key_id)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['build', 'refresh'])
+    parser.add_argument('--date', default=None,
+                        help="run as of this YYYY-MM-DD date")
+    args = parser.parse_args(argv)
+    today = None
+    if args.date:
+        today = datetime.datetime.strptime(args.date, '%Y-%m-%d').date()
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+    days = (build if args.command == 'build' else refresh)(today)
+    print("Recomputed %d days" % days)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""Send reads to replica databases and everything else to the primary.
+
+A plain SELECT goes to a replica when it runs outside a transaction and
+the session did not write yet, so a session always reads its own
+writes. A session lasts from the first query of a thread until close(),
+i.e. one request in app.py, and sticks to one replica so its reads are
+consistent with each other. A request whose queries run on several
+threads, as in async_app.py, keeps a RoutingSession and runs each of
+them in db.session().
+
+Replicas that fail a query are taken out of rotation and the query is
+retried on the primary. They are probed again with check() after
+retry_interval seconds, which also checks the replication lag on MySQL.
+
+Replicas can be any database of the same kind as the primary, e.g.
+db.add_replica(host='replica1') or, for local runs, copies of a SQLite
+file with db.add_replica(database='replica.db').
+"""
+import contextlib
+import itertools
+import logging
+import threading
+import time
+
+from peewee import MySQLDatabase, OperationalError, InterfaceError
+from pool import PooledMySQLDatabase, PooledSqliteDatabase, PoolTimeout
+from instrumentation import QueryHooksMixin
+
+logger = logging.getLogger('routing')
+
+
+class Replica(object):
+    """A replica database and its health.
+
+    database - the peewee database of the replica
+    healthy - False while out of rotation
+    failed_at - time of the last failure, None when it never failed
+    """
+
+    __slots__ = ('database', 'healthy', 'failed_at')
+
+    def __init__(self, database):
+        self.database = database
+        self.healthy = True
+        self.failed_at = None
+
+    def close(self):
+        if not self.database.is_closed():
+            self.database.close()
+
+
+class RoutingSession(object):
+    """Where the reads of a session go.
+
+    replica - the Replica the session reads from, None until it read
+    primary - True when the session is forced to the primary
+    wrote - True when the session wrote to the primary
+    """
+
+    __slots__ = ('replica', 'primary', 'wrote')
+
+    def __init__(self, primary=False):
+        self.replica = None
+        self.primary = primary
+        self.wrote = False
+
+    def reading_from(self):
+        """Return the replica the reads go to, None for the primary."""
+        if self.primary or self.wrote:
+            return None
+        return self.replica
+
+
+# Statements that neither read nor write rows.
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT',
+                          'RELEASE')
+
+
+def _statement(sql):
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+def is_read(sql):
+    """Return True for SQL that may run on a replica."""
+    return _statement(sql) == 'SELECT' and \
+        not sql.rstrip().upper().endswith('FOR UPDATE')
+
+
+class ReplicaRoutingMixin(object):
+    """Mixin that routes the reads of a peewee database to replicas.
+
+    Without replicas every query runs on the database itself, as before.
+
+    retry_interval - seconds a failed replica stays out of rotation
+        before it is probed again
+    max_lag - seconds a MySQL replica may lag behind, None does not check
+    """
+
+    replica_class = None
+
+    def __init__(self, *args, **kwargs):
+        self.retry_interval = kwargs.pop('retry_interval', 30)
+        self.max_lag = kwargs.pop('max_lag', None)
+        self._replicas = []
+        self._replica_lock = threading.Lock()
+        self._next_replica = itertools.count()
+        self._local = threading.local()
+        super(ReplicaRoutingMixin, self).__init__(*args, **kwargs)
+
+    @property
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = RoutingSession()
+        return session
+
+    @contextlib.contextmanager
+    def session(self, session):
+        """Run the queries of this thread in the with block in session.
+
+        The connections of the block go back to the pool at its end,
+        session keeps its replica and whether it wrote for the next
+        block, which may run on another thread.
+
+        session - RoutingSession, e.g. one per request
+        """
+        previous = getattr(self._local, 'session', None)
+        self._local.session = session
+        try:
+            yield session
+        finally:
+            try:
+                if session.replica is not None:
+                    session.replica.close()
+            finally:
+                self._local.session = previous
+                if not self.is_closed():
+                    super(ReplicaRoutingMixin, self).close()
+
+    def add_replica(self, replica=None, **overrides):
+        """Add a replica and return its database.
+
+        replica - peewee database of the replica, when None one is made
+            with the settings of this database and overrides, e.g.
+            add_replica(host='replica1') or add_replica(database='x.db')
+        """
+        if replica is None:
+            name = overrides.pop('database', self.database)
+            kwargs = dict(self.connect_kwargs)
+            kwargs.update(overrides)
+            replica = self.replica_class(
+                name, max_connections=self.max_connections,
+                stale_timeout=self.stale_timeout, timeout=self.timeout,
+                **kwargs)
+        with self._replica_lock:
+            self._replicas.append(Replica(replica))
+        return replica
+
+    @property
+    def replicas(self):
+        return list(self._replicas)
+
+    def force_primary(self):
+        """Run the rest of this session on the primary, e.g. for a route
+        that must never read stale rows.
+        """
+        self._session.primary = True
+
+    @contextlib.contextmanager
+    def primary(self):
+        """Run the queries in the with block on the primary."""
+        session = self._session
+        forced, session.primary = session.primary, True
+        try:
+            yield
+        finally:
+            session.primary = forced
+
+    def has_written(self):
+        """Return True when this session ran a query on the primary that
+        was not a read.
+        """
+        return self._session.wrote
+
+    def reading_from(self):
+        """Return the replica the reads of this session go to, None for
+        the primary.
+        """
+        return self._session.reading_from()
+
+    def check(self, replica):
+        """Probe a replica and update its health, return True when
+        healthy.
+        """
+        database = replica.database
+        try:
+            database.execute_sql('SELECT 1', require_commit=False)
+            if self.max_lag is not None and \
+                    isinstance(database, MySQLDatabase):
+                cursor = database.execute_sql('SHOW SLAVE STATUS',
+                                              require_commit=False)
+                row = cursor.fetchone()
+                columns = [column[0] for column in cursor.description or []]
+                lag = dict(zip(columns, row or ())).get(
+                    'Seconds_Behind_Master')
+                # No lag at all means replication is not running.
+                if lag is None or lag > self.max_lag:
+                    raise OperationalError('Replica lags %s seconds' % lag)
+        except (OperationalError, InterfaceError) as error:
+            self._mark_failed(replica, error)
+            return False
+        finally:
+            if self._session.replica is not replica:
+                replica.close()
+        replica.healthy = True
+        return True
+
+    def check_replicas(self):
+        """Probe every replica, return the amount that is healthy."""
+        return sum(self.check(replica) for replica in self.replicas)
+
+    def _mark_failed(self, replica, error):
+        if replica.healthy:
+            logger.warning("Replica %s taken out of rotation: %s",
+                           replica.database.database, error)
+        replica.healthy = False
+        replica.failed_at = time.time()
+
+    def _pick_replica(self):
+        replica = self._session.replica
+        if replica is not None and replica.healthy:
+            return replica
+        now = time.time()
+        for candidate in self.replicas:
+            if not candidate.healthy and \
+                    now - candidate.failed_at >= self.retry_interval:
+                self.check(candidate)
+        healthy = [r for r in self.replicas if r.healthy]
+        if not healthy:
+            return None
+        replica = healthy[next(self._next_replica) % len(healthy)]
+        self._session.replica = replica
+        return replica
+
+    def execute_sql(self, sql, params=None, require_commit=True):
+        session = self._session
+        read = is_read(sql)
+        if not read and _statement(sql) not in TRANSACTION_STATEMENTS:
+            session.wrote = True
+        elif read and self._replicas and not self.transaction_depth() and \
+                not session.primary and not session.wrote:
+            replica = self._pick_replica()
+            if replica is not None:
+                try:
+                    return replica.database.execute_sql(sql, params, False)
+                except PoolTimeout:
+                    # Busy rather than broken, keep it in rotation.
+                    session.replica = None
+                except (OperationalError, InterfaceError) as error:
+                    # Fail over, the primary has the same rows.
+                    self._mark_failed(replica, error)
+                    session.replica = None
+                    replica.close()
+        return super(ReplicaRoutingMixin, self).execute_sql(
+            sql, params, require_commit)
+
+    def close_all(self):
+        """Close the idle connections of this database and its replicas,
+        e.g. before forking workers that must not share them.
+        """
+        super(ReplicaRoutingMixin, self).close_all()
+        for replica in self.replicas:
+            replica.database.close_all()
+
+    def close(self):
+        """End the session: close the replica connection of this thread
+        and the connection to the primary.
+        """
+        session = self._session
+        replica = session.replica
+        session.replica = None
+        session.primary = False
+        session.wrote = False
+        try:
+            if replica is not None:
+                replica.close()
+        finally:
+            if not self.is_closed():
+                super(ReplicaRoutingMixin, self).close()
+
+
+class RoutingMySQLDatabase(QueryHooksMixin, ReplicaRoutingMixin,
+                           PooledMySQLDatabase):
+    replica_class = PooledMySQLDatabase
+
+
+class RoutingSqliteDatabase(QueryHooksMixin, ReplicaRoutingMixin,
+                            PooledSqliteDatabase):
+    replica_class = PooledSqliteDatabase
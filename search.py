@@ -0,0 +1,167 @@
+"""Full-text catalogue search over book titles/summaries and authors.
+
+MySQL uses FULLTEXT indexes on book(title, summary) and
+author(name, biography), which InnoDB keeps up to date on every write.
+SQLite, used for local runs, gets an FTS5 table that triggers keep in
+sync with the book and author tables.
+"""
+import re
+
+from peewee import SqliteDatabase
+from models import Book, Author, BookGenre
+
+BOOK_INDEX = 'book_fulltext'
+AUTHOR_INDEX = 'author_fulltext'
+FTS_TABLE = 'book_search'
+
+_SQLITE_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS book_search USING fts5(
+        title, summary, author_name, author_biography)""",
+    """CREATE TRIGGER IF NOT EXISTS book_search_ai AFTER INSERT ON book
+    BEGIN
+        INSERT INTO book_search (rowid, title, summary, author_name,
+                                 author_biography)
+        SELECT new.id, new.title, new.summary, a.name, a.biography
+        FROM author a WHERE a.id = new.{book_author};
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_search_au
+    AFTER UPDATE OF title, summary, {book_author} ON book
+    BEGIN
+        DELETE FROM book_search WHERE rowid = old.id;
+        INSERT INTO book_search (rowid, title, summary, author_name,
+                                 author_biography)
+        SELECT new.id, new.title, new.summary, a.name, a.biography
+        FROM author a WHERE a.id = new.{book_author};
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS book_search_ad AFTER DELETE ON book
+    BEGIN
+        DELETE FROM book_search WHERE rowid = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS author_search_au
+    AFTER UPDATE OF name, biography ON author
+    BEGIN
+        UPDATE book_search
+        SET author_name = new.name, author_biography = new.biography
+        WHERE rowid IN (SELECT id FROM book WHERE {book_author} = new.id);
+    END""",
+]
+
+# Title matches weigh the most, then the author name.
+_SQLITE_SEARCH = """
+    SELECT b.*, book_search.author_name AS author_name,
+           -bm25(book_search, 10.0, 1.0, 5.0, 1.0) AS score
+    FROM book_search
+    JOIN book b ON b.id = book_search.rowid
+    WHERE book_search MATCH ? {filters}
+    ORDER BY score DESC
+    LIMIT ?"""
+
+# Each MATCH runs in its own branch so both FULLTEXT indexes get used.
+_MYSQL_SEARCH = """
+    SELECT b.*, a.name AS author_name, hits.score AS score
+    FROM (
+        SELECT id, SUM(score) AS score FROM (
+            SELECT id, MATCH (title, summary) AGAINST (%s) AS score
+            FROM book
+            WHERE MATCH (title, summary) AGAINST (%s)
+            UNION ALL
+            SELECT b2.id, MATCH (a.name, a.biography) AGAINST (%s)
+            FROM author a JOIN book b2 ON b2.{book_author} = a.id
+            WHERE MATCH (a.name, a.biography) AGAINST (%s)
+        ) matches GROUP BY id
+    ) hits
+    JOIN book b ON b.id = hits.id
+    JOIN author a ON a.id = b.{book_author}
+    WHERE 1 = 1 {filters}
+    ORDER BY score DESC
+    LIMIT %s"""
+
+_GENRE_FILTER = """
+    AND b.id IN (SELECT bg.{bookgenre_book} FROM bookgenre bg
+                 JOIN genre g ON g.id = bg.{bookgenre_genre}
+                 WHERE g.genre = {param})"""
+
+
+def _is_sqlite(database):
+    # models.db is a Proxy, look at the database it points to.
+    database = getattr(database, 'obj', database)
+    return isinstance(database, SqliteDatabase)
+
+
+def _columns():
+    # Foreign key column names as peewee creates them.
+    return dict(book_author=Book.author_id.db_column,
+                bookgenre_book=BookGenre.book_id.db_column,
+                bookgenre_genre=BookGenre.genre_id.db_column)
+
+
+def create_search_index(database=None):
+    """Create the full-text index, safe to call more than once.
+
+    database - defaults to the database of the Book model
+    """
+    database = database or Book._meta.database
+    if _is_sqlite(database):
+        exists = FTS_TABLE in database.get_tables()
+        for statement in _SQLITE_SCHEMA:
+            database.execute_sql(statement.format(**_columns()))
+        if not exists:
+            rebuild_search_index(database)
+        return
+    for model, name, columns in [(Book, BOOK_INDEX, 'title, summary'),
+                                 (Author, AUTHOR_INDEX, 'name, biography')]:
+        table = model._meta.db_table
+        if name not in [i.name for i in database.get_indexes(table)]:
+            database.execute_sql('ALTER TABLE `%s` ADD FULLTEXT INDEX '
+                                 '`%s` (%s)' % (table, name, columns))
+
+
+def rebuild_search_index(database=None):
+    """Refill the SQLite FTS table from scratch, MySQL needs no rebuild."""
+    database = database or Book._meta.database
+    if not _is_sqlite(database):
+        return
+    with database.atomic():
+        database.execute_sql('DELETE FROM book_search')
+        database.execute_sql(
+            'INSERT INTO book_search (rowid, title, summary, author_name, '
+            'author_biography) SELECT b.id, b.title, b.summary, a.name, '
+            'a.biography FROM book b JOIN author a '
+            'ON a.id = b.{book_author}'.format(**_columns()))
+
+
+def fts_query(text):
+    """Turn user input into a FTS5 query matching any of the words."""
+    words = re.findall(r'\w+', text, re.UNICODE)
+    return ' OR '.join('"%s"' % word for word in words)
+
+
+def search_books(text, genre=None, language=None, limit=20):
+    """Return books matching text, best match first.
+
+    Every returned book has a score attribute, higher is better, and an
+    author_name attribute so listing results needs no extra queries.
+    """
+    database = Book._meta.database
+    param = database.interpolation
+    if _is_sqlite(database):
+        text = fts_query(text)
+        if not text:
+            return []
+        template, params = _SQLITE_SEARCH, [text]
+    else:
+        if not text.strip():
+            return []
+        template, params = _MYSQL_SEARCH, [text] * 4
+
+    columns = _columns()
+    filters = ''
+    if genre is not None:
+        filters += _GENRE_FILTER.format(param=param, **columns)
+        params.append(genre)
+    if language is not None:
+        filters += ' AND b.language = %s' % param
+        params.append(language)
+    params.append(limit)
+    sql = template.format(filters=filters, **columns)
+    return list(Book.raw(sql, *params))
@@ -0,0 +1,846 @@
+"""Compact, memory-mapped snapshot of the catalogue tables.
+
+Books, authors, publishers and genres are read far more often than they
+change. "python snapshot.py build" writes them to a file of columns:
+arrays of integers, where every distinct string is stored once in a
+string table the columns point into. Workers map the file read-only
+with catalogue.load(path), so the operating system keeps one copy in
+its page cache however many processes, forked or not, read it. Records
+are built on lookup as small __slots__ objects.
+
+Long texts such as summaries and biographies are left out, and so are
+the available copies of a book, which change on every lend.
+
+Triggers made by create_change_log() log every change to the catalogue
+tables in the cataloguechange table. Catalogue.refresh() reads the log
+from where the snapshot was built and reloads only the changed rows,
+which are kept next to the mapped file. "python snapshot.py refresh"
+writes a new file from the old one and the log without reading the
+whole tables again; workers switch to it on their next refresh.
+
+Rows are sorted by code point, the order SQLite uses. MySQL sorts by
+its collation, so on MySQL snapshot pages may order e.g. upper and lower
+case titles differently from the live ones.
+"""
+import argparse
+import array
+import bisect
+import heapq
+import itertools
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+from peewee import MySQLDatabase, fn
+from models import *
+from cache import model_cache
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from pagination import decode_cursor, encode_cursor, make_page
+
+SNAPSHOT_PATH = os.getenv('CATALOGUE_SNAPSHOT', 'catalogue.snapshot')
+
+MAGIC = b'LMSSNAP1'
+_PREAMBLE = struct.Struct('<8sI')
+_ALIGN = 8
+
+# Stored as an index into the string table.
+STRING = 'S'
+
+# Columns of the tables after their id, with the array typecode they are
+# stored as. Book rows end with the tuple of their genre ids.
+SCHEMA = [
+    ('publisher', Publisher, [('name', STRING), ('city', STRING)]),
+    ('author', Author, [('name', STRING), ('age', 'i')]),
+    ('genre', Genre, [('genre', STRING)]),
+    ('book', Book, [('isbn', STRING), ('title', STRING), ('author_id', 'i'),
+                    ('publisher_id', 'i'), ('amount_of_pages', 'h'),
+                    ('book_print', 'h'), ('edition', 'h'),
+                    ('published_at', STRING), ('language', STRING),
+                    ('book_type', STRING), ('amount', 'h')]),
+]
+TABLES = dict((table, (model, columns)) for table, model, columns in SCHEMA)
+
+# Models whose writes a Catalogue picks up on its next refresh_if_due().
+CATALOGUE_MODELS = [Book, Author, Publisher, Genre, BookGenre]
+
+# Seconds a gap in the ids of the change log is waited on. On MySQL
+# transactions may commit their entries out of order, a rolled back one
+# leaves a gap forever.
+GAP_TIMEOUT = 60
+
+
+class Record(object):
+    """A catalogue row of the snapshot, built fresh on every lookup."""
+
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for index, name in enumerate(self.__slots__):
+            setattr(self, name, values[index] if index < len(values)
+                    else None)
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.id)
+
+
+class PublisherRecord(Record):
+    __slots__ = ('id', 'name', 'city')
+
+
+class AuthorRecord(Record):
+    __slots__ = ('id', 'name', 'age')
+
+
+class GenreRecord(Record):
+    __slots__ = ('id', 'genre')
+
+
+class BookRecord(Record):
+    """A book of the snapshot.
+
+    author_id and publisher_id hold the records, as the foreign keys of
+    Book do, genres is the sorted list of genre names and available is
+    None until filled in from the database.
+    """
+
+    __slots__ = ('id', 'isbn', 'title', 'author_id', 'publisher_id',
+                 'amount_of_pages', 'book_print', 'edition', 'published_at',
+                 'language', 'book_type', 'amount', 'genres', 'available')
+
+
+RECORDS = dict(publisher=PublisherRecord, author=AuthorRecord,
+               genre=GenreRecord, book=BookRecord)
+
+
+def _align(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _columns(table):
+    model, columns = TABLES[table]
+    return [model._meta.primary_key.db_column] + \
+        [model._meta.fields[name].db_column for name, _ in columns]
+
+
+def _fetch(sql, params=(), chunk_size=10000):
+    # Raw cursor reads, a model per row would make building the snapshot
+    # of a million books take minutes.
+    cursor = db.execute_sql(sql, params, require_commit=False)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def _select(table, columns, key, order, ids=None, chunk_size=500):
+    sql = 'SELECT %s FROM %s' % (', '.join(columns), table)
+    if ids is None:
+        return _fetch('%s ORDER BY %s' % (sql, order))
+    ids = sorted(ids)
+    # Chunked to stay below the bound parameter limit of SQLite.
+    return itertools.chain.from_iterable(
+        _fetch('%s WHERE %s IN (%s) ORDER BY %s' % (
+            sql, key, ', '.join([db.interpolation] * len(chunk)), order),
+            chunk)
+        for chunk in (ids[start:start + chunk_size]
+                      for start in range(0, len(ids), chunk_size)))
+
+
+def _with_genres(books, genres):
+    # Merge join of two streams ordered by book id.
+    genres = iter(genres)
+    pending = next(genres, None)
+    for book in books:
+        genre_ids = []
+        while pending is not None and pending[0] <= book[0]:
+            if pending[0] == book[0]:
+                genre_ids.append(pending[1])
+            pending = next(genres, None)
+        yield book + (tuple(genre_ids),)
+
+
+def read_rows(table, ids=None):
+    """Yield the rows of a catalogue table as tuples, in id order.
+
+    table - name of a table in SCHEMA
+    ids - only read the rows with these ids, all rows when None
+    """
+    columns = _columns(table)
+    strings = [index + 1 for index, (_, kind)
+               in enumerate(TABLES[table][1]) if kind == STRING]
+
+    def convert(row):
+        # Dates come back as date objects from MySQL, strings from SQLite.
+        row = list(row)
+        for index in strings:
+            if not isinstance(row[index], str):
+                row[index] = str(row[index])
+        return tuple(row)
+
+    rows = (convert(row) for row in
+            _select(table, columns, columns[0], columns[0], ids))
+    if table != 'book':
+        return rows
+    book, genre = BookGenre.book_id.db_column, BookGenre.genre_id.db_column
+    return _with_genres(rows, _select(
+        BookGenre._meta.db_table, [book, genre], book,
+        '%s, %s' % (book, genre), ids))
+
+
+def write(path, tables, change_id):
+    """Write a snapshot file, replacing the one at path atomically.
+
+    Workers that mapped the old file keep reading it until they switch.
+
+    tables - dict of table name to its rows as made by read_rows()
+    change_id - id of the last change log entry the rows include
+    return - size of the file in bytes
+    """
+    texts, strings = [], {}
+
+    def intern(value):
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(texts)
+            texts.append(value)
+        return index
+
+    sections = []
+    for table, model, columns in SCHEMA:
+        kinds = ['i'] + [kind for _, kind in columns]
+        arrays = [array.array('I' if kind == STRING else kind)
+                  for kind in kinds]
+        genre_offsets, genre_ids = array.array('I', [0]), array.array('i')
+        for row in tables.get(table, ()):
+            for index, kind in enumerate(kinds):
+                arrays[index].append(intern(row[index]) if kind == STRING
+                                     else row[index])
+            if table == 'book':
+                genre_ids.extend(row[-1])
+                genre_offsets.append(len(genre_ids))
+        sections.append(('%s.id' % table, arrays[0]))
+        for (name, _), values in zip(columns, arrays[1:]):
+            sections.append(('%s.%s' % (table, name), values))
+        if table == 'book':
+            sections.append(('book.genres.offsets', genre_offsets))
+            sections.append(('book.genres.ids', genre_ids))
+
+        # Row positions in the order of every sortable column, so pages
+        # on it are a binary search and a slice.
+        names = [name for name, _ in columns]
+        for sort in model.sortable_fields:
+            if sort == 'id':
+                continue
+            index = names.index(sort) + 1
+            values = arrays[index]
+            if kinds[index] == STRING:
+                values = [texts[value] for value in values]
+            ids = arrays[0]
+            order = sorted(range(len(ids)),
+                           key=lambda position: (values[position],
+                                                 ids[position]))
+            sections.append(('%s.order.%s' % (table, sort),
+                             array.array('I', order)))
+
+    data = bytearray()
+    offsets = array.array('Q', [0])
+    for text in texts:
+        data.extend(text.encode('utf-8'))
+        offsets.append(len(data))
+    sections.append(('strings.offsets', offsets))
+    sections.append(('strings.data', array.array('B', bytes(data))))
+
+    layout, offset = {}, 0
+    for name, values in sections:
+        offset = _align(offset)
+        layout[name] = [offset, values.typecode, len(values)]
+        offset += values.itemsize * len(values)
+    header = json.dumps(dict(byteorder=sys.byteorder, change_id=change_id,
+                             created_at=time.time(), sections=layout),
+                        sort_keys=True).encode('utf-8')
+    start = _align(_PREAMBLE.size + len(header))
+
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    with open(temporary, 'wb') as snapshot_file:
+        snapshot_file.write(_PREAMBLE.pack(MAGIC, len(header)))
+        snapshot_file.write(header)
+        for name, values in sections:
+            snapshot_file.seek(start + layout[name][0])
+            values.tofile(snapshot_file)
+        size = snapshot_file.tell()
+    os.replace(temporary, path)
+    return size
+
+
+class Snapshot(object):
+    """Read-only view of a snapshot file mapped into memory.
+
+    Rows are addressed by their position, which is also their place in
+    id order.
+
+    path - file written by write()
+    raises - ValueError when the file is not a snapshot or was written
+        on a machine of another byte order
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self.stat = os.fstat(snapshot_file.fileno())
+            self._map = mmap.mmap(snapshot_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, length = _PREAMBLE.unpack_from(self._map)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError("%s is not a catalogue snapshot" % path)
+        header = json.loads(self._map[_PREAMBLE.size:
+                                      _PREAMBLE.size + length]
+                            .decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            self._map.close()
+            raise ValueError("%s was written on a %s endian machine"
+                             % (path, header['byteorder']))
+        self.change_id = header['change_id']
+        self.created_at = header['created_at']
+
+        start = _align(_PREAMBLE.size + length)
+        view = memoryview(self._map)
+        self._views = [view]
+        self._sections = {}
+        for name, (offset, typecode, amount) in header['sections'].items():
+            size = array.array(typecode).itemsize * amount
+            section = view[start + offset:start + offset + size] \
+                .cast(typecode)
+            self._views.append(section)
+            self._sections[name] = section
+        self._offsets = self._sections['strings.offsets']
+        self._text = self._sections['strings.data']
+        self._tables = {}
+        for table, _, columns in SCHEMA:
+            self._tables[table] = [self._sections['%s.id' % table]] + [
+                self._sections['%s.%s' % (table, name)]
+                for name, _ in columns]
+        self._strings = dict(
+            (table, [False] + [kind == STRING for _, kind in columns])
+            for table, _, columns in SCHEMA)
+
+    def close(self):
+        """Unmap the file, records already built stay usable."""
+        for view in reversed(self._views):
+            view.release()
+        self._map.close()
+
+    def string(self, index):
+        """Return the string at index of the string table."""
+        return str(self._text[self._offsets[index]:self._offsets[index + 1]],
+                   'utf-8')
+
+    def count(self, table):
+        return len(self._tables[table][0])
+
+    def ids(self, table):
+        return self._tables[table][0]
+
+    def position(self, table, row_id):
+        """Return the position of a row by id, None when not there."""
+        ids = self._tables[table][0]
+        position = bisect.bisect_left(ids, row_id)
+        if position < len(ids) and ids[position] == row_id:
+            return position
+        return None
+
+    def value(self, table, column, position):
+        """Return a single value.
+
+        column - index in the row tuple, 0 is the id
+        """
+        value = self._tables[table][column][position]
+        if self._strings[table][column]:
+            return self.string(value)
+        return value
+
+    def row(self, table, position):
+        """Return the row at position as a tuple, like read_rows() does."""
+        row = tuple(self.value(table, column, position)
+                    for column in range(len(self._tables[table])))
+        if table == 'book':
+            offsets = self._sections['book.genres.offsets']
+            row += (tuple(self._sections['book.genres.ids'][
+                offsets[position]:offsets[position + 1]]),)
+        return row
+
+    def rows(self, table):
+        """Yield every row of a table in id order."""
+        for position in range(self.count(table)):
+            yield self.row(table, position)
+
+    def order(self, table, sort):
+        """Return the positions of the rows sorted on a column and id,
+        None for the id itself.
+
+        raises - ValueError when the column has no order in the file
+        """
+        if sort == 'id':
+            return None
+        try:
+            return self._sections['%s.order.%s' % (table, sort)]
+        except KeyError:
+            raise ValueError("Can not sort %s on %r" % (table, sort))
+
+    def search(self, table, column, order, bound, after):
+        """Binary search in the order of a column.
+
+        column - index of the column in the row tuple
+        order - result of order()
+        bound - (value, id) tuple
+        after - find the first row above bound, else the first row at or
+            above it
+        return - index in order
+        """
+        ids = self._tables[table][0]
+        low, high = 0, len(ids)
+        while low < high:
+            middle = (low + high) // 2
+            position = middle if order is None else order[middle]
+            key = (self.value(table, column, position), ids[position])
+            if key < bound or (after and key == bound):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class Catalogue(object):
+    """Lookups on the loaded snapshot and the changes logged since.
+
+    Nothing is answered before load() is called, callers check loaded
+    and fall back to the database.
+
+    refresh_interval - seconds between reads of the change log by
+        refresh_if_due()
+    """
+
+    def __init__(self, refresh_interval=5):
+        self.refresh_interval = refresh_interval
+        self.path = None
+        self.change_id = None
+        # The snapshot and the rows changed since, per table a dict of
+        # id to row or None when deleted. Swapped as one tuple so readers
+        # never see the changes of one snapshot with another.
+        self._state = None
+        self._lock = threading.Lock()
+        self._refreshed_at = 0
+        self._versions = None
+        self._gap_since = None
+
+    @property
+    def loaded(self):
+        return self._state is not None
+
+    @property
+    def snapshot(self):
+        return self._state[0] if self._state is not None else None
+
+    def load(self, path):
+        """Map the snapshot file at path, replacing the loaded one.
+
+        raises - ValueError when it is not a snapshot, see Snapshot
+        """
+        snapshot = Snapshot(path)
+        with self._lock:
+            self._open(path, snapshot)
+
+    def _open(self, path, snapshot):
+        # Readers may still hold the old snapshot, it is unmapped once
+        # they let go of it.
+        self.path = path
+        self.change_id = snapshot.change_id
+        self._gap_since = None
+        self._state = (snapshot, dict((table, {}) for table in TABLES))
+
+    def unload(self):
+        with self._lock:
+            self._state = None
+            self.path = self.change_id = None
+
+    def refresh(self):
+        """Apply the changes logged since the last refresh.
+
+        Switches to the file at the loaded path first when a new
+        snapshot replaced it.
+
+        return - amount of change log entries read
+        """
+        with self._lock:
+            if self._state is None:
+                return 0
+            self._refreshed_at = time.time()
+            self._versions = model_cache.versions(CATALOGUE_MODELS)[0]
+            snapshot, changes = self._state
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                stat = None
+            if stat is not None and \
+                    (stat.st_ino, stat.st_mtime) != \
+                    (snapshot.stat.st_ino, snapshot.stat.st_mtime):
+                self._open(self.path, Snapshot(self.path))
+                snapshot, changes = self._state
+
+            entries = list(CatalogueChange
+                           .select(CatalogueChange.id,
+                                   CatalogueChange.table_name,
+                                   CatalogueChange.row_id)
+                           .where(CatalogueChange.id > self.change_id)
+                           .order_by(CatalogueChange.id)
+                           .tuples())
+            if not entries:
+                return 0
+            changed = dict((table, set()) for table in TABLES)
+            for _, table, row_id in entries:
+                if table in changed:
+                    changed[table].add(row_id)
+            changes = dict((table, dict(rows))
+                           for table, rows in changes.items())
+            for table, row_ids in changed.items():
+                if not row_ids:
+                    continue
+                found = dict((row[0], row)
+                             for row in read_rows(table, row_ids))
+                for row_id in row_ids:
+                    changes[table][row_id] = found.get(row_id)
+            self._state = (snapshot, changes)
+            self._advance([entry[0] for entry in entries])
+            return len(entries)
+
+    def _advance(self, ids):
+        # Stay before the first gap until it is filled in or timed out,
+        # the entries after it are read again, which is harmless.
+        position = self.change_id
+        for change_id in ids:
+            if change_id != position + 1:
+                break
+            position = change_id
+        if position == ids[-1] or (
+                self._gap_since is not None and
+                time.time() - self._gap_since >= GAP_TIMEOUT):
+            self.change_id, self._gap_since = ids[-1], None
+            return
+        if self._gap_since is None:
+            self._gap_since = time.time()
+        self.change_id = position
+
+    def refresh_if_due(self):
+        """Refresh when refresh_interval passed or this process wrote to
+        the catalogue tables since the last refresh.
+
+        return - amount of change log entries read
+        """
+        if self._state is None:
+            return 0
+        if time.time() - self._refreshed_at < self.refresh_interval and \
+                model_cache.versions(CATALOGUE_MODELS)[0] == self._versions:
+            return 0
+        return self.refresh()
+
+    def _row(self, state, table, row_id):
+        snapshot, changes = state
+        if row_id in changes[table]:
+            return changes[table][row_id]
+        position = snapshot.position(table, row_id)
+        return None if position is None else snapshot.row(table, position)
+
+    def _record(self, state, table, row):
+        if row is None:
+            return None
+        if table != 'book':
+            return RECORDS[table](*row)
+        genres = [self._record(state, 'genre',
+                               self._row(state, 'genre', genre_id))
+                  for genre_id in row[-1]]
+        return BookRecord(*(
+            row[:3] +
+            (self._get(state, 'author', row[3]),
+             self._get(state, 'publisher', row[4])) +
+            row[5:-1] +
+            (sorted(genre.genre for genre in genres if genre is not None),)))
+
+    def _get(self, state, table, row_id):
+        return self._record(state, table, self._row(state, table, row_id))
+
+    def get(self, table, row_id):
+        """Return the record of a row by id, None when there is none.
+
+        table - book, author, publisher or genre
+        """
+        return self._get(self._state, table, row_id)
+
+    def book(self, book_id):
+        return self.get('book', book_id)
+
+    def author(self, author_id):
+        return self.get('author', author_id)
+
+    def publisher(self, publisher_id):
+        return self.get('publisher', publisher_id)
+
+    def genre(self, genre_id):
+        return self.get('genre', genre_id)
+
+    def rows(self, table):
+        """Yield the current rows of a table in id order, the snapshot
+        merged with the changes.
+        """
+        snapshot, changes = self._state
+        changed = changes[table]
+        kept = (row for row in snapshot.rows(table)
+                if row[0] not in changed)
+        updated = sorted(row for row in changed.values() if row is not None)
+        return heapq.merge(kept, updated)
+
+    def page(self, table, after=None, before=None,
+             page_size=DEFAULT_PAGE_SIZE, sort='id'):
+        """Return a page of records, as select_page() does for models.
+
+        The cursors are the same as the ones of select_page(), so paging
+        can continue on the database when the snapshot is unloaded.
+
+        return - a pagination.Page of records
+        raises - ValueError on an unknown sort column or invalid cursor
+        """
+        state = self._state
+        snapshot, changes = state
+        model, columns = TABLES[table]
+        if sort not in model.sortable_fields:
+            raise ValueError("Can not sort %s on %r" % (table, sort))
+        order = snapshot.order(table, sort)
+        column = 0 if sort == 'id' else \
+            [name for name, _ in columns].index(sort) + 1
+        page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+        backwards = before is not None
+        cursor = before if backwards else after
+        changed = changes[table]
+
+        def key(row):
+            return (row[column], row[0])
+
+        bound = None
+        if cursor is None:
+            start = snapshot.count(table) if backwards else 0
+        else:
+            sort_value, pk = decode_cursor(cursor)
+            if isinstance(sort_value, datetime.date):
+                # From a live MySQL page, dates are stored as text here.
+                sort_value = str(sort_value)
+            bound = (sort_value, pk)
+            try:
+                start = snapshot.search(table, column, order, bound,
+                                        not backwards)
+            except TypeError:
+                # A cursor of a page sorted on another column.
+                raise ValueError("Invalid cursor %r" % cursor)
+
+        # Read one row more than the page, skipping changed rows, then
+        # merge in the changed rows that belong after the cursor.
+        ids = snapshot.ids(table)
+        rows = []
+        index = start - 1 if backwards else start
+        while 0 <= index < len(ids) and len(rows) <= page_size:
+            position = index if order is None else order[index]
+            if ids[position] not in changed:
+                rows.append(snapshot.row(table, position))
+            index += -1 if backwards else 1
+        try:
+            rows.extend(row for row in changed.values() if row is not None
+                        and (bound is None or
+                             (key(row) < bound if backwards
+                              else key(row) > bound)))
+        except TypeError:
+            raise ValueError("Invalid cursor %r" % cursor)
+        rows.sort(key=key, reverse=backwards)
+        records = [self._record(state, table, row)
+                   for row in rows[:page_size + 1]]
+        return make_page(
+            records, page_size,
+            lambda record: encode_cursor(getattr(record, sort), record.id),
+            sort, backwards, cursor is not None)
+
+
+catalogue = Catalogue()
+
+
+def _trigger_tables():
+    # (table, logged table, logged column, watched columns), a change to
+    # the genres of a book is logged as a change of the book.
+    for table, model, columns in SCHEMA:
+        yield table, table, model._meta.primary_key.db_column, \
+            _columns(table)
+    book, genre = BookGenre.book_id.db_column, BookGenre.genre_id.db_column
+    yield BookGenre._meta.db_table, 'book', book, [book, genre]
+
+
+_SQLITE_TRIGGERS = [
+    ('ai', """CREATE TRIGGER IF NOT EXISTS {name} AFTER INSERT ON {table}
+    BEGIN
+        INSERT INTO {log} (table_name, row_id)
+        VALUES ('{logged}', new.{key});
+    END"""),
+    ('au', """CREATE TRIGGER IF NOT EXISTS {name} AFTER UPDATE ON {table}
+    WHEN {sqlite_changed}
+    BEGIN
+        INSERT INTO {log} (table_name, row_id)
+        VALUES ('{logged}', new.{key});
+        INSERT INTO {log} (table_name, row_id)
+        SELECT '{logged}', old.{key} WHERE old.{key} IS NOT new.{key};
+    END"""),
+    ('ad', """CREATE TRIGGER IF NOT EXISTS {name} AFTER DELETE ON {table}
+    BEGIN
+        INSERT INTO {log} (table_name, row_id)
+        VALUES ('{logged}', old.{key});
+    END"""),
+]
+
+_MYSQL_TRIGGERS = [
+    ('ai', """CREATE TRIGGER `{name}` AFTER INSERT ON `{table}`
+    FOR EACH ROW
+        INSERT INTO `{log}` (table_name, row_id)
+        VALUES ('{logged}', NEW.`{key}`)"""),
+    ('au', """CREATE TRIGGER `{name}` AFTER UPDATE ON `{table}`
+    FOR EACH ROW
+    BEGIN
+        IF NOT ({mysql_unchanged}) THEN
+            INSERT INTO `{log}` (table_name, row_id)
+            VALUES ('{logged}', NEW.`{key}`);
+            IF NOT (NEW.`{key}` <=> OLD.`{key}`) THEN
+                INSERT INTO `{log}` (table_name, row_id)
+                VALUES ('{logged}', OLD.`{key}`);
+            END IF;
+        END IF;
+    END"""),
+    ('ad', """CREATE TRIGGER `{name}` AFTER DELETE ON `{table}`
+    FOR EACH ROW
+        INSERT INTO `{log}` (table_name, row_id)
+        VALUES ('{logged}', OLD.`{key}`)"""),
+]
+
+
+def create_change_log(database=None):
+    """Create the triggers filling the change log, safe to call more
+    than once. Does nothing while the cataloguechange table is missing.
+
+    Only updates of the columns in the snapshot are logged, e.g. not the
+    available copies of a book or the average rating of a genre.
+
+    database - defaults to the database of the Book model
+    """
+    database = database or Book._meta.database
+    database = getattr(database, 'obj', database)
+    log = CatalogueChange._meta.db_table
+    if log not in database.get_tables():
+        return
+    mysql = isinstance(database, MySQLDatabase)
+    existing = set()
+    if mysql:
+        existing = set(row[0] for row in database.execute_sql(
+            'SELECT trigger_name FROM information_schema.triggers '
+            'WHERE trigger_schema = DATABASE()'))
+    for table, logged, key, watched in _trigger_tables():
+        values = dict(
+            table=table, logged=logged, key=key, log=log,
+            sqlite_changed=' OR '.join('old.%s IS NOT new.%s' % (c, c)
+                                       for c in watched),
+            mysql_unchanged=' AND '.join('NEW.`%s` <=> OLD.`%s`' % (c, c)
+                                         for c in watched))
+        for suffix, statement in (_MYSQL_TRIGGERS if mysql
+                                  else _SQLITE_TRIGGERS):
+            values['name'] = '%s_change_%s' % (table, suffix)
+            if values['name'] not in existing:
+                database.execute_sql(statement.format(**values))
+
+
+def latest_change():
+    """Return the id of the newest change log entry, 0 when empty."""
+    return CatalogueChange.select(fn.MAX(CatalogueChange.id)).scalar() or 0
+
+
+def prune_changes(up_to):
+    """Delete the change log entries up to and including up_to.
+
+    The newest entry is always kept, so the ids of new entries never
+    go back to ones a worker already read past.
+
+    return - amount of deleted entries
+    """
+    up_to = min(up_to, latest_change() - 1)
+    return CatalogueChange.delete().where(
+        CatalogueChange.id <= up_to).execute()
+
+
+def _previous_change_id(path):
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError):
+        return None
+    change_id = snapshot.change_id
+    snapshot.close()
+    return change_id
+
+
+def build(path=SNAPSHOT_PATH):
+    """Write a snapshot of the catalogue tables to path.
+
+    The position in the change log is read before the tables, so rows
+    changed during the build are reloaded by the first refresh. Entries
+    only workers on the file being replaced could need are pruned.
+
+    return - (size of the file in bytes, change log position)
+    """
+    previous = _previous_change_id(path)
+    change_id = latest_change()
+    size = write(path, dict((table, read_rows(table)) for table in TABLES),
+                 change_id)
+    if previous is not None:
+        prune_changes(previous)
+    return size, change_id
+
+
+def rewrite(path=SNAPSHOT_PATH):
+    """Write a new snapshot from the one at path and the change log,
+    reading only the changed rows instead of the whole tables.
+
+    return - (size of the file in bytes, change log position)
+    """
+    current = Catalogue()
+    current.load(path)
+    previous = current.change_id
+    current.refresh()
+    size = write(path, dict((table, current.rows(table))
+                            for table in TABLES), current.change_id)
+    prune_changes(previous)
+    return size, current.change_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['build', 'refresh'])
+    parser.add_argument('--path', default=SNAPSHOT_PATH,
+                        help="snapshot file the workers load")
+    args = parser.parse_args(argv)
+    db.init(host=os.getenv('DB_HOST', 'localhost'),
+            user='development',
+            password='devpassword',
+            database='devdatabase',
+            charset='utf8')
+    run = build if args.command == 'build' else rewrite
+    size, change_id = run(args.path)
+    print("%d bytes written, up to change %d" % (size, change_id))
+
+
+if __name__ == '__main__':
+    main()
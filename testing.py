@@ -0,0 +1,147 @@
+"""Test database lifecycle for unittests.py.
+
+The schema is built once per run by applying the migrations to a SQLite
+template file. Every test process works on its own copy of the template
+and every test runs in a transaction that is rolled back afterwards, so
+tables are never emptied or rebuilt between tests.
+
+Set TEST_DATABASE=mysql to run against the unittest MySQL database
+instead, its schema is brought up to date with the migrations first.
+"""
+import importlib
+import io
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from models import *
+from cache import model_cache
+from routing import RoutingSqliteDatabase
+from migrate import MigrationRunner, configure
+
+# A test database is thrown away after the run, durability is not needed.
+SQLITE_PRAGMAS = [('synchronous', 'off'), ('journal_mode', 'memory')]
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Test case that undoes its writes by rolling back a transaction.
+
+    Code under test that opens its own atomic() block gets a savepoint
+    inside the test transaction. Test cases that need committed rows,
+    e.g. to share them with other threads, set rollback to False and
+    list the models to empty afterwards in cleanup_models.
+    """
+
+    rollback = True
+    cleanup_models = []
+
+    def setUp(self):
+        db.connect()
+        if self.rollback:
+            self._transaction = db.transaction()
+            self._transaction.__enter__()
+
+    def tearDown(self):
+        if self.rollback:
+            self._transaction.rollback(False)
+            self._transaction.__exit__(None, None, None)
+        else:
+            for model in self.cleanup_models:
+                model.delete().execute()
+        # The cache may still hold rows that were rolled back.
+        for model in MODELS:
+            model_cache.invalidate(model)
+        db.close()
+
+
+def use_mysql():
+    return os.getenv('TEST_DATABASE', 'sqlite') == 'mysql'
+
+
+def build_template(directory=None):
+    """Apply the migrations to a new SQLite file and return its path."""
+    directory = directory or tempfile.mkdtemp(prefix='lms-test-')
+    path = os.path.join(directory, 'template.db')
+    database = SqliteDatabase(path)
+    MigrationRunner(database).upgrade()
+    if not database.is_closed():
+        database.close()
+    return path
+
+
+def use_test_database(template=None):
+    """Point models.db at a fresh database for the tests.
+
+    template - SQLite file to copy, a new one is built when not given
+    return - path of the copy, None when running against MySQL
+    """
+    if use_mysql():
+        configure('unittest')
+        MigrationRunner().upgrade()
+        return None
+    template = template or build_template()
+    fd, path = tempfile.mkstemp(suffix='.db',
+                                dir=os.path.dirname(template))
+    os.close(fd)
+    shutil.copyfile(template, path)
+    db.initialize(RoutingSqliteDatabase(path, pragmas=SQLITE_PRAGMAS))
+    return path
+
+
+def _run_test_case(args):
+    module_name, name = args
+    module = importlib.import_module(module_name)
+    suite = unittest.defaultTestLoader.loadTestsFromName(name, module)
+    stream = io.StringIO()
+    result = unittest.TextTestRunner(stream, verbosity=0).run(suite)
+    return (result.testsRun, len(result.failures), len(result.errors),
+            len(result.skipped), stream.getvalue())
+
+
+def find_test_cases(module):
+    loader = unittest.defaultTestLoader
+    return sorted(name for name, obj in vars(module).items()
+                  if isinstance(obj, type) and
+                  issubclass(obj, unittest.TestCase) and
+                  loader.getTestCaseNames(obj))
+
+
+def run_parallel(module_name, workers, names=None):
+    """Run the test cases of a module spread over worker processes.
+
+    Every worker gets its own copy of the template database, the test
+    cases are handed out one at a time to whichever worker is free.
+
+    names - test case names to run, defaults to all in the module
+    return - exit status, 0 when every test passed
+    """
+    if use_mysql():
+        raise ValueError("Parallel workers need TEST_DATABASE=sqlite, "
+                         "they would share the MySQL database")
+    module = importlib.import_module(module_name)
+    names = names or find_test_cases(module)
+    started = time.time()
+    pool = multiprocessing.Pool(workers, use_test_database,
+                                (build_template(),))
+    totals = [0, 0, 0, 0]
+    try:
+        for result in pool.imap_unordered(
+                _run_test_case, [(module_name, name) for name in names]):
+            counts, output = result[:4], result[4]
+            totals = [total + count for total, count in zip(totals, counts)]
+            if counts[1] or counts[2]:
+                print(output)
+    finally:
+        pool.close()
+        pool.join()
+    tests, failures, errors, skipped = totals
+    print("Ran %d tests in %.3fs with %d workers"
+          % (tests, time.time() - started, workers))
+    if failures or errors:
+        print("FAILED (failures=%d, errors=%d)" % (failures, errors))
+        return 1
+    print("OK" + (" (skipped=%d)" % skipped if skipped else ""))
+    return 0
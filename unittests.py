@@ -1,17 +1,49 @@
 import unittest
+import argparse
+import asyncio
+import csv
+import datetime
+import io
+import json
+import logging
 import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
 from models import *
+from pool import PooledSqliteDatabase, PoolTimeout
+from importer import import_rows, read_rows
+from cache import LRUCache, model_cache
+from overdue import scan_overdue
+from holds import sweep
+from migrate import MigrationRunner, Migrator, diff, MIGRATIONS_DIR, \
+    MIGRATION_FILE
+from testing import DatabaseTestCase, use_test_database, run_parallel
+from testing import build_template
+from routing import RoutingSession, RoutingSqliteDatabase
+from instrumentation import QueryProfile, RouteMetrics, SlowQueryLog
+from pagination import encode_cursor, decode_cursor
+import snapshot
+import auth
+import export
+import rollups
+try:
+    import recommender
+except ImportError:
+    # numpy and scipy come with requirements-recommend.txt
+    recommender = None
+try:
+    import async_app
+    from aiohttp.test_utils import TestClient, TestServer
+except ImportError:
+    # aiohttp comes with requirements-async.txt
+    async_app = None
 
 
-class TestPublisherModel(unittest.TestCase):
-
-    def setUp(self):
-        db.connect()
-
-    def tearDown(self):
-        q = Publisher.delete()
-        q.execute()
-        db.close()
+class TestPublisherModel(DatabaseTestCase):
 
     # add_publisher()
     def test_add_publisher_returns_publisher(self):
@@ -55,6 +87,63 @@ class TestPublisherModel(unittest.TestCase):
         publishers = Publisher.select_all()
         self.assertTrue(publishers is None)
 
+    # iterate_all()
+    def test_iterate_all_crosses_chunks(self):
+        for i in range(5):
+            Publisher.create(name="publisher %d" % i, city="city")
+        names = [p.name for p in Publisher.iterate_all(chunk_size=2)]
+        self.assertEqual(names, ["publisher %d" % i for i in range(5)])
+
+    def test_iterate_all_no_entries(self):
+        self.assertEqual(list(Publisher.iterate_all()), [])
+
+    # select_page()
+    def test_select_page_first_page(self):
+        for i in range(5):
+            Publisher.create(name="publisher %d" % i, city="city")
+        page = Publisher.select_page(page_size=2)
+        self.assertEqual([p.name for p in page],
+                         ["publisher 0", "publisher 1"])
+        self.assertTrue(page.next_cursor)
+        self.assertTrue(page.prev_cursor is None)
+
+    def test_select_page_walk_forward_and_back(self):
+        for i in range(5):
+            Publisher.create(name="publisher %d" % i, city="city")
+        first = Publisher.select_page(page_size=2)
+        second = Publisher.select_page(after=first.next_cursor,
+                                       page_size=2)
+        last = Publisher.select_page(after=second.next_cursor,
+                                     page_size=2)
+        self.assertEqual([p.name for p in last], ["publisher 4"])
+        self.assertTrue(last.next_cursor is None)
+        back = Publisher.select_page(before=second.prev_cursor,
+                                     page_size=2)
+        self.assertEqual([p.id for p in back], [p.id for p in first])
+        self.assertTrue(back.prev_cursor is None)
+
+    def test_select_page_sort_on_name(self):
+        for name in ["c", "a", "b", "a"]:
+            Publisher.create(name=name, city="city")
+        first = Publisher.select_page(page_size=3, sort='name')
+        second = Publisher.select_page(after=first.next_cursor,
+                                       page_size=3, sort='name')
+        self.assertEqual([p.name for p in first], ["a", "a", "b"])
+        self.assertEqual([p.name for p in second], ["c"])
+
+    def test_select_page_invalid_sort(self):
+        self.assertRaises(ValueError, Publisher.select_page,
+                          sort='password')
+
+    def test_select_page_invalid_cursor(self):
+        self.assertRaises(ValueError, Publisher.select_page,
+                          after='not a cursor')
+
+    def test_select_page_no_entries(self):
+        page = Publisher.select_page()
+        self.assertFalse(page)
+        self.assertTrue(page.next_cursor is None)
+
     # update_selected()
     def test_update_publisher(self):
         publisher = Publisher.create(name="test", city="city")
@@ -97,15 +186,7 @@ class TestPublisherModel(unittest.TestCase):
     def test_delete_non_existing_publisher(self):
         self.assertFalse(Publisher.delete_selected(666))
 
-class TestAuthorModel(unittest.TestCase):
-
-    def setUp(self):
-        db.connect()
-
-    def tearDown(self):
-        q = Author.delete()
-        q.execute()
-        db.close
+class TestAuthorModel(DatabaseTestCase):
 
     # add_author()
     def test_add_author_returns_author(self):
@@ -150,6 +231,15 @@ class TestAuthorModel(unittest.TestCase):
         authors = Author.select_all()
         self.assertTrue(authors is None)
 
+    # select_page()
+    def test_select_page_sort_on_age(self):
+        for age in [60, 40, 50]:
+            Author.create(name="Plato", biography="lorem ipsum", age=age)
+        page = Author.select_page(page_size=2, sort='age')
+        self.assertEqual([a.age for a in page], [40, 50])
+        page = Author.select_page(after=page.next_cursor, sort='age')
+        self.assertEqual([a.age for a in page], [60])
+
     # update_selected()
     def test_update_author(self):
         name = "Friedrich Nietzsche"
@@ -242,10 +332,1855 @@ class TestAuthorModel(unittest.TestCase):
     def test_delete_non_existing_author(self):
         self.assertFalse(Author.delete_selected(1))
 
+class TestBulkEdit(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestBulkEdit, self).setUp()
+        self.publishers = [Publisher.create(name="Publisher %d" % i,
+                                            city="London")
+                           for i in range(3)]
+        self.author = Author.create(name="Plato", biography="", age=67)
+
+    def tearDown(self):
+        db.stop_profile()
+        super(TestBulkEdit, self).tearDown()
+
+    def test_update_and_delete_take_one_query(self):
+        publisher_id = self.publishers[0].id
+        db.start_profile()
+        self.assertTrue(Publisher.update_selected(publisher_id,
+                                                  city="Leiden"))
+        self.assertTrue(Publisher.delete_selected(publisher_id))
+        self.assertFalse(Publisher.delete_selected(publisher_id))
+        self.assertEqual(db.stop_profile().queries, 3)
+
+    def test_update_writes_only_changed_columns(self):
+        db.start_profile()
+        Author.update_selected(self.author.id, age=70)
+        seconds, sql, params = db.stop_profile().slowest
+        self.assertNotIn('name', sql)
+        self.assertEqual(Author.get(Author.id == self.author.id).age, 70)
+
+    def test_bulk_edit(self):
+        first, second, third = [p.id for p in self.publishers]
+        results = apply_bulk_edits(dict(
+            publishers=[dict(id=first, city="Leiden"),
+                        dict(id=second, delete=True),
+                        dict(id=666, name="missing")],
+            authors=[dict(id=self.author.id, name="Platon")]))
+        self.assertEqual(results, dict(publishers=[True, True, False],
+                                       authors=[True]))
+        self.assertEqual(Publisher.get(Publisher.id == first).city,
+                         "Leiden")
+        self.assertEqual(Publisher.select().count(), 2)
+        self.assertEqual(Author.get(Author.id == self.author.id).name,
+                         "Platon")
+
+    def test_invalid_bulk_edit_writes_nothing(self):
+        first = self.publishers[0].id
+        self.assertRaises(TypeError, apply_bulk_edits, dict(
+            publishers=[dict(id=first, delete=True),
+                        dict(id=first, colour="red")]))
+        self.assertRaises(KeyError, apply_bulk_edits, dict(
+            publishers=[dict(id=first, delete=True)], books=[]))
+        self.assertEqual(Publisher.select().count(), 3)
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        self.pool = PooledSqliteDatabase(self.path, max_connections=2,
+                                         timeout=0)
+
+    def tearDown(self):
+        if not self.pool.is_closed():
+            self.pool.close()
+        self.pool.close_all()
+        os.remove(self.path)
+
+    def test_connection_is_reused(self):
+        self.pool.connect()
+        first = self.pool.get_conn()
+        self.pool.close()
+        self.pool.connect()
+        self.assertIs(self.pool.get_conn(), first)
+        stats = self.pool.pool_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_pool_exhausted_raises_timeout(self):
+        def hold():
+            self.pool.connect()
+        for _ in range(2):
+            thread = threading.Thread(target=hold)
+            thread.start()
+            thread.join()
+        self.assertRaises(PoolTimeout, self.pool.connect)
+        self.assertEqual(self.pool.pool_stats()['timeouts'], 1)
+
+    def test_waits_for_released_connection(self):
+        self.pool.init(self.path, max_connections=1, timeout=5)
+        self.pool.connect()
+        checked_out = []
+
+        def wait_for_connection():
+            self.pool.connect()
+            checked_out.append(self.pool.get_conn())
+            self.pool.close()
+
+        thread = threading.Thread(target=wait_for_connection)
+        thread.start()
+        time.sleep(0.1)
+        self.pool.close()
+        thread.join()
+        self.assertEqual(len(checked_out), 1)
+        self.assertEqual(self.pool.pool_stats()['hits'], 1)
+
+    def test_stale_connection_recycled(self):
+        self.pool.init(self.path, stale_timeout=0.01)
+        self.pool.connect()
+        self.pool.close()
+        time.sleep(0.02)
+        self.pool.connect()
+        stats = self.pool.pool_stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['stale'], 1)
+
+    def test_connect_twice_is_noop(self):
+        self.pool.connect()
+        self.pool.connect()
+        self.assertEqual(self.pool.pool_stats()['in_use'], 1)
+
+    def test_no_resize_while_checked_out(self):
+        self.pool.connect()
+        self.assertRaises(ValueError, self.pool.init, self.path,
+                          max_connections=1)
+        self.pool.close()
+        self.pool.init(self.path, max_connections=1)
+        thread = threading.Thread(target=self.pool.connect)
+        thread.start()
+        thread.join()
+        self.assertRaises(PoolTimeout, self.pool.connect)
+
+    def test_failing_view_returns_its_connection(self):
+        from app import app
+
+        def failing_view():
+            Publisher.select().count()
+            raise RuntimeError("failed")
+
+        view = app.view_functions['view_publishers']
+        config = dict(app.config)
+        app.view_functions['view_publishers'] = failing_view
+        # As in production, not re-raised and no context kept for a
+        # debugger.
+        app.config.update(PROPAGATE_EXCEPTIONS=False,
+                          PRESERVE_CONTEXT_ON_EXCEPTION=False)
+        try:
+            with self.assertLogs(app.logger.name, 'ERROR'):
+                response = app.test_client().get('/admin/publisher')
+        finally:
+            app.view_functions['view_publishers'] = view
+            app.config.update(config)
+        self.assertEqual(response.status_code, 500)
+        self.assertTrue(db.is_closed())
+        self.assertEqual(db.obj.pool_stats()['in_use'], 0)
+
+class TestImporter(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestImporter, self).setUp()
+        self.author = Author.create(name="Plato", biography="", age=80)
+        self.publisher = Publisher.create(name="Penguin", city="London")
+
+    def book_row(self, isbn, **kwargs):
+        row = dict(isbn=isbn, title="Republic", author="Plato",
+                   publisher="Penguin", amount_of_pages="300",
+                   book_print="1", edition="2", summary="lorem ipsum",
+                   published_at="2001-02-03", language="English",
+                   book_type="paperback", amount="3")
+        row.update(kwargs)
+        return row
+
+    def test_import_publishers(self):
+        report = import_rows('publishers', [
+            (2, dict(name="Books from Holland", city="Amsterdam")),
+            (3, dict(name="a" * 266, city="Amsterdam")),
+        ])
+        self.assertEqual(report.inserted, 1)
+        self.assertEqual([line for line, _ in report.rejects], [3])
+        self.assertTrue(Publisher.get(
+            Publisher.name == "Books from Holland"))
+
+    def test_import_authors_age_must_be_int(self):
+        report = import_rows('authors', [
+            (1, dict(name="Mark Luther", biography="", age="number")),
+        ])
+        self.assertEqual(report.inserted, 0)
+        self.assertEqual(len(report.rejects), 1)
+
+    def test_import_books_resolves_references(self):
+        report = import_rows('books', [
+            (1, self.book_row("1", genres="philosophy;classic")),
+            (2, self.book_row("2", genres="philosophy")),
+        ], batch_size=1)
+        self.assertEqual(report.inserted, 2)
+        book = Book.get(Book.isbn == "1")
+        self.assertEqual(book.author_id.id, self.author.id)
+        self.assertEqual(book.publisher_id.id, self.publisher.id)
+        self.assertEqual(Genre.select().count(), 2)
+        self.assertEqual(BookGenre.select().count(), 3)
+
+    def test_import_books_rejects(self):
+        report = import_rows('books', [
+            (1, self.book_row("1")),
+            (2, self.book_row("1")),
+            (3, self.book_row("3", author="Nobody")),
+            (4, self.book_row("4", title="a" * 33)),
+            (5, self.book_row("5", published_at="yesterday")),
+            (6, None),
+        ])
+        self.assertEqual(report.inserted, 1)
+        self.assertEqual([line for line, _ in report.rejects],
+                         [3, 4, 5, 6, 2])
+
+    def test_read_rows_jsonl(self):
+        lines = io.StringIO(u'{"name": "a", "city": "b"}\n'
+                            u'\n'
+                            u'not json\n')
+        self.assertEqual(list(read_rows(lines, 'jsonl')),
+                         [(1, dict(name="a", city="b")), (3, None)])
+
+class TestBookSearch(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestBookSearch, self).setUp()
+        self.author = Author.create(name="Homer", biography="Greek poet",
+                                    age=60)
+        self.publisher = Publisher.create(name="Penguin", city="London")
+
+    def create_book(self, isbn, title, summary, language="English"):
+        return Book.create(isbn=isbn, title=title, author_id=self.author,
+                           publisher_id=self.publisher, amount_of_pages=300,
+                           book_print=1, edition=1, summary=summary,
+                           published_at="2001-02-03", language=language,
+                           book_type="paperback")
+
+    def test_search_title_ranks_first(self):
+        self.create_book("1", "Sailing", "a story about the odyssey")
+        self.create_book("2", "Odyssey", "a story about sailing")
+        books = Book.search("odyssey")
+        self.assertEqual([b.isbn for b in books], ["2", "1"])
+        self.assertEqual(books[0].author_name, "Homer")
+
+    def test_search_author(self):
+        self.create_book("1", "Iliad", "war")
+        self.assertEqual([b.isbn for b in Book.search("homer")], ["1"])
+
+    def test_search_no_match(self):
+        self.create_book("1", "Iliad", "war")
+        self.assertEqual(Book.search("cookbook"), [])
+        self.assertEqual(Book.search("  "), [])
+
+    def test_search_filters(self):
+        iliad = self.create_book("1", "Iliad", "war", language="Greek")
+        self.create_book("2", "Iliad", "war", language="English")
+        epic = Genre.create(genre="epic")
+        BookGenre.create(book_id=iliad, genre_id=epic)
+        self.assertEqual([b.isbn for b in Book.search("iliad",
+                                                      genre="epic")],
+                         ["1"])
+        self.assertEqual([b.isbn for b in Book.search("iliad",
+                                                      language="English")],
+                         ["2"])
+
+    def test_search_follows_updates(self):
+        book = self.create_book("1", "Iliad", "war")
+        book.title = "Odyssey"
+        book.save()
+        self.assertEqual(Book.search("iliad"), [])
+        self.assertEqual([b.isbn for b in Book.search("odyssey")], ["1"])
+        Author.update_selected(self.author.id, name="Homerus")
+        self.assertEqual([b.isbn for b in Book.search("homerus")], ["1"])
+        book.delete_instance()
+        self.assertEqual(Book.search("odyssey"), [])
+
+class TestSearchRoute(DatabaseTestCase):
+    # The app closes the connection after every request.
+    rollback = False
+    cleanup_models = [Book, Author, Publisher]
+
+    def setUp(self):
+        super(TestSearchRoute, self).setUp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        for i in range(3):
+            Book.create(isbn=str(i), title="War %d" % i, author_id=author,
+                        publisher_id=publisher, amount_of_pages=300,
+                        book_print=1, edition=1, summary="war",
+                        published_at="2001-02-03", language="English",
+                        book_type="paperback", amount=1)
+
+    def test_limit_is_clamped(self):
+        from app import app
+        client = app.test_client()
+        for limit, found in [(2, 2), (-1, 1), (0, 1), (1000, 3)]:
+            response = client.get('/search?q=war&limit=%d' % limit)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data.count(b'<td>War '), found)
+
+
+class TestModelCache(DatabaseTestCase):
+
+    def test_get_cached_reads_through(self):
+        publisher = Publisher.create(name="name", city="city")
+        before = model_cache.stats()
+        Publisher.get_cached(publisher.id)
+        cached = Publisher.get_cached(publisher.id)
+        after = model_cache.stats()
+        self.assertEqual(cached.name, "name")
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+
+    def test_get_cached_not_existing(self):
+        self.assertRaises(Publisher.DoesNotExist,
+                          Publisher.get_cached, 666)
+
+    def test_update_invalidates(self):
+        publisher = Publisher.create(name="name", city="city")
+        Publisher.get_cached(publisher.id)
+        Publisher.update_selected(publisher.id, name="new_name")
+        self.assertEqual(Publisher.get_cached(publisher.id).name,
+                         "new_name")
+
+    def test_delete_invalidates(self):
+        publisher = Publisher.create(name="name", city="city")
+        Publisher.get_cached(publisher.id)
+        Publisher.delete_selected(publisher.id)
+        self.assertRaises(Publisher.DoesNotExist,
+                          Publisher.get_cached, publisher.id)
+
+    def test_add_invalidates_listing(self):
+        Publisher.add_publisher("first", "city")
+        self.assertEqual(len(Publisher.select_all_cached()), 1)
+        Publisher.add_publisher("second", "city")
+        self.assertEqual([p.name for p in Publisher.select_all_cached()],
+                         ["first", "second"])
+
+    def test_cached_instance_is_a_copy(self):
+        publisher = Publisher.create(name="name", city="city")
+        Publisher.get_cached(publisher.id).name = "changed"
+        self.assertEqual(Publisher.get_cached(publisher.id).name, "name")
+
+
+class TestCompiledQueries(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestCompiledQueries, self).setUp()
+        self.publisher = Publisher.create(name="Penguin", city="London")
+
+    def test_get_by_id(self):
+        publisher = Publisher.get_by_id(self.publisher.id)
+        self.assertEqual((publisher.id, publisher.name, publisher.city),
+                         (self.publisher.id, "Penguin", "London"))
+        self.assertFalse(publisher.is_dirty())
+        self.assertEqual(Publisher.get_by_id(self.publisher).id,
+                         self.publisher.id)
+        self.assertRaises(Publisher.DoesNotExist, Publisher.get_by_id,
+                          self.publisher.id + 1)
+
+    def test_sql_is_compiled_once(self):
+        from models import _select_by_id
+        first = _select_by_id.compile(Publisher)
+        self.assertIs(_select_by_id.compile(Publisher), first)
+        self.assertEqual(_select_by_id.sql(Publisher, dict(pk="7")),
+                         (Publisher.select()
+                          .where(Publisher.id == 7).limit(1).sql()))
+
+    def test_update_and_delete_by_id(self):
+        pk = self.publisher.id
+        self.assertTrue(Publisher.update_by_id(pk, dict(city="Leiden")))
+        self.assertTrue(Publisher.update_by_id(pk, {}))
+        self.assertFalse(Publisher.update_by_id(pk + 1, dict(city="x")))
+        # Expressions go through peewee.
+        self.assertTrue(Publisher.update_by_id(
+            pk, dict(name=Publisher.city.concat("!"))))
+        self.assertEqual((Publisher.get_by_id(pk).name,
+                          Publisher.get_by_id(pk).city),
+                         ("Leiden!", "Leiden"))
+        self.assertTrue(Publisher.has_rows())
+        self.assertTrue(Publisher.delete_by_id(pk))
+        self.assertFalse(Publisher.delete_by_id(pk))
+        self.assertFalse(Publisher.has_rows())
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_size=2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        lru = LRUCache(ttl=0.01)
+        lru.set('a', 1)
+        lru.set('b', 2, None)
+        time.sleep(0.02)
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.get('b'), 2)
+        self.assertEqual(lru.stats()['expirations'], 1)
+
+    def test_counters_add_up_and_restart_when_expired(self):
+        lru = LRUCache(ttl=0.01)
+        self.assertEqual(lru.incr('a'), 1)
+        self.assertEqual(lru.incr('a', 2), 3)
+        time.sleep(0.02)
+        self.assertEqual(lru.incr('a'), 1)
+
+class TestLending(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestLending, self).setUp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        self.book = Book.create(isbn="1", title="Iliad", author_id=author,
+                                publisher_id=publisher, amount_of_pages=300,
+                                book_print=1, edition=1, summary="war",
+                                published_at="2001-02-03",
+                                language="English", book_type="paperback",
+                                amount=2)
+        self.customer = Customer.create(email="a@b.c", password="x",
+                                        first_name="Jan", surname="Smit")
+        self.return_date = datetime.date.today()
+
+    def available(self):
+        return Book.available_for([self.book.id])[self.book.id]
+
+    def test_new_book_all_copies_available(self):
+        self.assertEqual(self.available(), 2)
+
+    def test_checkout_and_return(self):
+        lend = Lend.checkout(self.book.id, self.customer.id,
+                             self.return_date)
+        self.assertTrue(isinstance(lend, Lend))
+        self.assertEqual(self.available(), 1)
+        self.assertTrue(Lend.return_book(lend.id))
+        self.assertEqual(self.available(), 2)
+        self.assertFalse(Lend.return_book(lend.id))
+        self.assertEqual(self.available(), 2)
+
+    def test_checkout_no_copies_left(self):
+        for _ in range(2):
+            Lend.checkout(self.book.id, self.customer.id, self.return_date)
+        self.assertTrue(Lend.checkout(self.book.id, self.customer.id,
+                                      self.return_date) is None)
+        self.assertEqual(Lend.select().count(), 2)
+
+    def test_return_not_existing(self):
+        self.assertFalse(Lend.return_book(666))
+
+    def test_available_for_several_books(self):
+        self.assertEqual(Book.available_for([self.book.id, 666]),
+                         {self.book.id: 2})
+        self.assertEqual(Book.available_for([]), {})
+
+    def test_update_amount(self):
+        Lend.checkout(self.book.id, self.customer.id, self.return_date)
+        self.assertTrue(Book.update_amount(self.book.id, 5))
+        self.assertEqual(self.available(), 4)
+        self.assertFalse(Book.update_amount(self.book.id, 0))
+        self.assertEqual(self.available(), 4)
+
+    def test_recount_available(self):
+        Lend.checkout(self.book.id, self.customer.id, self.return_date)
+        Book.update(available=2).execute()
+        Book.recount_available()
+        self.assertEqual(self.available(), 1)
+
+
+class TestHolds(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestHolds, self).setUp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        self.book = Book.create(isbn="1", title="Iliad", author_id=author,
+                                publisher_id=publisher, amount_of_pages=300,
+                                book_print=1, edition=1, summary="war",
+                                published_at="2001-02-03",
+                                language="English", book_type="paperback",
+                                amount=1, available=1)
+        self.customers = [
+            Customer.create(email="%d@b.c" % i, password="x",
+                            first_name="Jan", surname="Smit").id
+            for i in range(4)]
+        self.today = datetime.date(2017, 3, 1)
+
+    def available(self):
+        return Book.available_for([self.book.id])[self.book.id]
+
+    def status(self, hold):
+        return Hold.get(Hold.id == hold.id).status
+
+    def test_returned_copy_goes_to_first_holder(self):
+        lend = Lend.checkout(self.book.id, self.customers[0], self.today)
+        first = Hold.place(self.book.id, self.customers[1], self.today)
+        second = Hold.place(self.book.id, self.customers[2], self.today)
+        self.assertEqual((first.status, Hold.position(second.id)),
+                         ('waiting', 2))
+        self.assertTrue(Lend.return_book(lend.id, self.today))
+        self.assertEqual((self.status(first), self.status(second)),
+                         ('ready', 'waiting'))
+        self.assertEqual(Hold.position(second.id), 1)
+        self.assertEqual(self.available(), 0)
+        self.assertIsNone(Lend.checkout(self.book.id, self.customers[3],
+                                        self.today))
+        lend = Hold.collect(first.id, self.today)
+        self.assertEqual(lend.customer_id.id, self.customers[1])
+        self.assertEqual(self.status(first), 'collected')
+        self.assertIsNone(Hold.collect(first.id, self.today))
+
+    def test_place_takes_available_copy(self):
+        hold = Hold.place(self.book.id, self.customers[0], self.today)
+        self.assertEqual(hold.status, 'ready')
+        self.assertEqual(hold.ready_until, datetime.date(2017, 3, 8))
+        self.assertEqual(self.available(), 0)
+        self.assertIsNone(Hold.place(self.book.id, self.customers[0]))
+        Book.recount_available(self.book.id)
+        self.assertEqual(self.available(), 0)
+
+    def test_cancel_passes_copy_on(self):
+        first = Hold.place(self.book.id, self.customers[0], self.today)
+        second = Hold.place(self.book.id, self.customers[1], self.today)
+        self.assertTrue(Hold.cancel(first.id))
+        self.assertFalse(Hold.cancel(first.id))
+        self.assertEqual(self.status(second), 'ready')
+        self.assertTrue(Hold.cancel(second.id))
+        self.assertEqual(self.available(), 1)
+
+    def test_sweep_expires_uncollected_holds(self):
+        first = Hold.place(self.book.id, self.customers[0], self.today)
+        second = Hold.place(self.book.id, self.customers[1], self.today)
+        self.assertEqual(sweep(datetime.date(2017, 3, 8)), 0)
+        self.assertEqual(sweep(datetime.date(2017, 3, 9), batch_size=1), 1)
+        self.assertEqual(self.status(first), 'expired')
+        self.assertEqual(Hold.get(Hold.id == second.id).ready_until,
+                         datetime.date(2017, 3, 16))
+        self.assertEqual(sweep(datetime.date(2017, 3, 17)), 1)
+        self.assertEqual(self.available(), 1)
+
+    def test_new_copies_serve_the_queue(self):
+        Hold.place(self.book.id, self.customers[0], self.today)
+        waiting = Hold.place(self.book.id, self.customers[1], self.today)
+        self.assertTrue(Book.update_amount(self.book.id, 3))
+        self.assertEqual(self.status(waiting), 'ready')
+        self.assertEqual(self.available(), 1)
+
+
+class TestConcurrentHolds(DatabaseTestCase):
+    # The workers use their own connections, so the rows have to be
+    # committed for them to see.
+    rollback = False
+    cleanup_models = [Hold, Lend, Customer, Book, Author, Publisher,
+                      LendChange]
+
+    def setUp(self):
+        super(TestConcurrentHolds, self).setUp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        self.book = Book.create(isbn="1", title="Iliad", author_id=author,
+                                publisher_id=publisher, amount_of_pages=300,
+                                book_print=1, edition=1, summary="war",
+                                published_at="2001-02-03",
+                                language="English", book_type="paperback",
+                                amount=3, available=3)
+        self.customers = [
+            Customer.create(email="%d@b.c" % i, password="x",
+                            first_name="Jan", surname="Smit").id
+            for i in range(12)]
+        self.today = datetime.date.today()
+        for customer_id in self.customers[:3]:
+            Lend.checkout(self.book.id, customer_id, self.today)
+
+    def test_returns_and_holds_do_not_double_allocate(self):
+        book_id = self.book.id
+        errors = []
+
+        def work(seed):
+            rng = random.Random(seed)
+            db.connect()
+            try:
+                for _ in range(25):
+                    action = rng.random()
+                    if action < 0.4:
+                        Hold.place(book_id, rng.choice(self.customers))
+                    elif action < 0.7:
+                        lend = (Lend.select(Lend.id)
+                                .where((Lend.book_id == book_id) &
+                                       (Lend.returned_at >> None))
+                                .order_by(fn.Random()).first())
+                        if lend is not None:
+                            Lend.return_book(lend.id)
+                    elif action < 0.9:
+                        hold = (Hold.select(Hold.id)
+                                .where(Hold.status == 'ready')
+                                .order_by(fn.Random()).first())
+                        if hold is not None:
+                            Hold.collect(hold.id, self.today)
+                    else:
+                        hold = (Hold.select(Hold.id)
+                                .where(Hold.status << Hold.ACTIVE)
+                                .order_by(fn.Random()).first())
+                        if hold is not None:
+                            Hold.cancel(hold.id)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                db.close()
+
+        threads = [threading.Thread(target=work, args=(seed,))
+                   for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        available = Book.available_for([book_id])[book_id]
+        open_lends = Lend.select().where(Lend.returned_at >> None).count()
+        holds = dict(Hold.select(Hold.status, fn.COUNT(Hold.id))
+                     .group_by(Hold.status).tuples())
+        # Every copy is on the shelf, lent out or kept for one holder.
+        self.assertTrue(available >= 0)
+        self.assertEqual(available + open_lends + holds.get('ready', 0), 3)
+        self.assertEqual(Lend.select().count() - 3,
+                         holds.get('collected', 0))
+        if available:
+            self.assertEqual(holds.get('waiting', 0), 0)
+
+    def test_concurrent_places_keep_one_hold(self):
+        book_id, customer_id = self.book.id, self.customers[5]
+        errors = []
+
+        def work():
+            db.connect()
+            try:
+                for _ in range(5):
+                    Hold.place(book_id, customer_id)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                db.close()
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(Hold.select().where(
+            (Hold.customer_id == customer_id) &
+            (Hold.status << Hold.ACTIVE)).count(), 1)
+
+
+class TestConcurrentCheckout(DatabaseTestCase):
+    # The borrowing threads use their own connections, so the rows have
+    # to be committed for them to see.
+    rollback = False
+    cleanup_models = [Lend, Customer, Book, Author, Publisher]
+
+    def setUp(self):
+        super(TestConcurrentCheckout, self).setUp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        self.book = Book.create(isbn="1", title="Iliad", author_id=author,
+                                publisher_id=publisher, amount_of_pages=300,
+                                book_print=1, edition=1, summary="war",
+                                published_at="2001-02-03",
+                                language="English", book_type="paperback",
+                                amount=2)
+        self.customer = Customer.create(email="a@b.c", password="x",
+                                        first_name="Jan", surname="Smit")
+        self.return_date = datetime.date.today()
+
+    def available(self):
+        return Book.available_for([self.book.id])[self.book.id]
+
+    def test_concurrent_checkouts_do_not_oversell(self):
+        Book.update_amount(self.book.id, 10)
+        results = []
+
+        def borrow():
+            db.connect()
+            try:
+                for _ in range(5):
+                    results.append(Lend.checkout(
+                        self.book.id, self.customer.id, self.return_date))
+            finally:
+                db.close()
+
+        threads = [threading.Thread(target=borrow) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len([r for r in results if r is not None]), 10)
+        self.assertEqual(Lend.select().count(), 10)
+        self.assertEqual(self.available(), 0)
+
+
+class TestExport(DatabaseTestCase):
+    # Forked export workers use their own connections, so the rows have
+    # to be committed for them to see.
+    rollback = False
+    cleanup_models = [Lend, Customer, Book, Author, Publisher]
+
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        customer = Customer.create(email="a@b.c", password="x",
+                                   first_name="Jan", surname="Smit")
+        self.books = []
+        for i, title in enumerate(["Odyssey", "Iliad", "Aeneid", "Ilias"]):
+            book = Book.create(isbn=str(i), title=title, author_id=author,
+                               publisher_id=publisher, amount_of_pages=300,
+                               book_print=1, edition=1, summary="w\xe4r",
+                               published_at="200%d-01-02" % i,
+                               language="English", book_type="paperback",
+                               amount=2)
+            self.books.append(book.id)
+            Lend.create(book_id=book, customer_id=customer,
+                        return_date="2017-03-0%d" % (i + 1),
+                        returned_at="2017-03-01" if i % 2 else None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestExport, self).tearDown()
+
+    def export(self, kind, fmt, workers=1):
+        path = os.path.join(self.directory, '%s.%s' % (kind, fmt))
+        self.assertEqual(export.export(kind, path, fmt, workers,
+                                       chunk_size=3), 4)
+        with open(path, 'rb') as exported:
+            return exported.read()
+
+    def test_csv_joins_authors_and_publishers(self):
+        rows = list(csv.DictReader(io.StringIO(
+            self.export('books', 'csv').decode('utf-8'))))
+        self.assertEqual([row['title'] for row in rows],
+                         ["Odyssey", "Iliad", "Aeneid", "Ilias"])
+        self.assertEqual((rows[1]['author'], rows[1]['publisher_city'],
+                          rows[1]['published_at'], rows[1]['summary']),
+                         ("Homer", "London", "2001-01-02", "w\xe4r"))
+
+    def test_json_lines_keep_nulls(self):
+        lines = self.export('lends', 'jsonl').decode('utf-8').splitlines()
+        lends = [json.loads(line) for line in lines]
+        self.assertEqual([lend['returned_at'] for lend in lends],
+                         [None, "2017-03-01", None, "2017-03-01"])
+        self.assertEqual(lends[2]['isbn'], "2")
+
+    def test_columnar_round_trip(self):
+        columns, groups = export.read_row_groups(
+            io.BytesIO(self.export('lends', 'columnar')))
+        groups = list(groups)
+        self.assertEqual([len(group['id']) for group in groups], [3, 1])
+        self.assertEqual(columns[4], ('return_date', 'date'))
+        self.assertEqual(groups[0]['return_date'][2],
+                         datetime.date(2017, 3, 3))
+        self.assertEqual(groups[0]['returned_at'],
+                         [None, datetime.date(2017, 3, 1), None])
+        self.assertRaises(ValueError, export.read_row_groups,
+                          io.BytesIO(b'id,isbn'))
+
+    def test_partitions_cover_all_rows(self):
+        ranges = export.partitions('books', 3)
+        self.assertEqual(ranges[0][0], self.books[0])
+        self.assertEqual(ranges[-1][1], self.books[-1] + 1)
+        for fmt in ('csv', 'jsonl'):
+            self.assertEqual(self.export('books', fmt, workers=3),
+                             self.export('books', fmt))
+        Lend.delete().execute()
+        self.assertEqual(export.partitions('lends', 3), [])
+
+    def test_export_route_streams(self):
+        from app import app
+        client = app.test_client()
+        response = client.get('/admin/export/books.jsonl')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data.splitlines()), 4)
+        self.assertEqual(client.get('/admin/export/books.xml').status_code,
+                         404)
+
+
+class TestRollups(DatabaseTestCase):
+    # The dashboard test goes through the app, which closes the
+    # connection after every request.
+    rollback = False
+    cleanup_models = [Lend, BookGenre, Genre, Customer, Book, Author,
+                      Publisher, LendChange, LendRollup, Watermark]
+
+    def setUp(self):
+        super(TestRollups, self).setUp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        self.books = []
+        for i, title in enumerate(["Iliad", "Odyssey"]):
+            self.books.append(Book.create(
+                isbn=str(i), title=title, author_id=author,
+                publisher_id=publisher, amount_of_pages=300, book_print=1,
+                edition=1, summary="war", published_at="2001-02-03",
+                language="English", book_type="paperback", amount=2))
+        self.epic = Genre.create(genre="epic")
+        BookGenre.create(book_id=self.books[0], genre_id=self.epic)
+        customers = [Customer.create(email="%d@b.c" % i, password="x",
+                                     first_name="Jan", surname="Smit")
+                     for i in range(2)]
+        self.lends = [
+            Lend.create(book_id=book, customer_id=customer, lent_at=lent_at,
+                        return_date=return_date, returned_at=returned_at)
+            for book, customer, lent_at, return_date, returned_at in [
+                (self.books[0], customers[0], "2017-01-30", "2017-02-20",
+                 "2017-02-01"),
+                (self.books[1], customers[0], "2017-01-31", "2017-02-21",
+                 None),
+                (self.books[0], customers[1], "2017-02-02", "2017-02-23",
+                 "2017-02-25")]]
+        self.customers = customers
+        self.days = rollups.build(datetime.date(2017, 3, 1))
+
+    def day(self, day):
+        return datetime.date(2017, 2, day)
+
+    def test_build_counts_per_day_and_month(self):
+        rows = rollups.series(datetime.date(2017, 1, 30), self.day(2))
+        self.assertEqual([row.loans for row in rows], [1, 1, 0, 1])
+        self.assertEqual([row.returns for row in rows], [0, 0, 1, 0])
+        # Overdue on the day after the return date, the late return of
+        # the third lend counts as well.
+        rows = rollups.series(self.day(21), self.day(25))
+        self.assertEqual([row.overdues for row in rows], [0, 1, 0, 1, 0])
+        january, february = rollups.series(
+            datetime.date(2017, 1, 1), self.day(1), period='month')
+        self.assertEqual((january.loans, january.borrowers), (2, 1))
+        self.assertEqual((february.loans, february.returns,
+                          february.overdues), (1, 2, 2))
+        self.assertEqual(rollups.refresh(datetime.date(2017, 3, 1)), 0)
+
+    def test_top_across_month_boundary(self):
+        iliad, odyssey = [book.id for book in self.books]
+        self.assertEqual(rollups.top('book', datetime.date(2017, 1, 15),
+                                     self.day(28)),
+                         [(iliad, 2), (odyssey, 1)])
+        self.assertEqual(rollups.top('book', datetime.date(2017, 1, 31),
+                                     self.day(1)),
+                         [(odyssey, 1)])
+        genres = rollups.breakdown('genre', self.day(10))
+        self.assertEqual([(row.key_id, row.loans, row.returns)
+                          for row in genres], [(self.epic.id, 1, 2)])
+        self.assertRaises(ValueError, rollups.top, 'book', self.day(1),
+                          self.day(2), 'borrowers')
+
+    def test_refresh_folds_in_changes(self):
+        Lend.return_book(self.lends[1].id, self.day(27))
+        Lend.create(book_id=self.books[1], customer_id=self.customers[1],
+                    lent_at="2017-03-01", return_date="2017-03-01")
+        # Jan 31, Feb 22 and 27, Mar 1 and the new day Mar 2
+        self.assertEqual(rollups.refresh(datetime.date(2017, 3, 2)), 5)
+        rows = rollups.series(self.day(27), datetime.date(2017, 3, 2))
+        self.assertEqual([(row.loans, row.returns, row.overdues)
+                          for row in rows],
+                         [(0, 1, 0), (0, 0, 0), (1, 0, 0), (0, 0, 1)])
+        self.assertEqual(
+            rollups.series(self.day(22), self.day(22))[0].overdues, 1)
+        self.assertEqual(rollups.refresh(datetime.date(2017, 3, 2)), 0)
+
+    def test_dashboard(self):
+        from app import app
+        client = app.test_client()
+        response = client.get('/admin/lending?month=2017-02')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Iliad', response.data)
+        self.assertIn(b'epic', response.data)
+        # A refresh, e.g. by cron, changes the version of the dashboard
+        # although only the lends and rollups were written.
+        etag = response.headers['ETag']
+        self.assertEqual(client.get('/admin/lending?month=2017-02',
+                                    headers={'If-None-Match': etag})
+                         .status_code, 304)
+        Lend.update(returned_at=self.day(27)).where(
+            Lend.id == self.lends[1].id).execute()
+        rollups.refresh(datetime.date(2017, 3, 1))
+        self.assertEqual(client.get('/admin/lending?month=2017-02',
+                                    headers={'If-None-Match': etag})
+                         .status_code, 200)
+        self.assertEqual(client.get('/admin/lending?month=2017-13')
+                         .status_code, 302)
+
+
+class TestOverdueScanner(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestOverdueScanner, self).setUp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        self.book = Book.create(isbn="1", title="Iliad", author_id=author,
+                                publisher_id=publisher, amount_of_pages=300,
+                                book_print=1, edition=1, summary="war",
+                                published_at="2001-02-03",
+                                language="English", book_type="paperback",
+                                amount=10)
+        self.today = datetime.date(2016, 6, 1)
+
+    def lend(self, customer, days_overdue, returned=False):
+        return_date = self.today - datetime.timedelta(days=days_overdue)
+        return Lend.create(book_id=self.book, customer_id=customer,
+                           return_date=return_date,
+                           returned_at=return_date if returned else None)
+
+    def customer(self, name):
+        return Customer.create(email="%s@example.com" % name, password="x",
+                               first_name=name, surname="Smit")
+
+    def test_scan_groups_per_customer(self):
+        jan, piet = self.customer("Jan"), self.customer("Piet")
+        self.lend(jan, 3)
+        self.lend(piet, 5)
+        self.lend(jan, 1)
+        notices = list(scan_overdue(self.today, batch_size=1))
+        self.assertEqual([n.email for n in notices],
+                         ["Jan@example.com", "Piet@example.com"])
+        self.assertEqual(len(notices[0].lends), 2)
+        self.assertTrue("3 days overdue" in notices[0].format(self.today))
+
+    def test_scan_skips_returned_and_not_due(self):
+        jan = self.customer("Jan")
+        self.lend(jan, 3, returned=True)
+        self.lend(jan, 0)
+        self.lend(jan, -5)
+        self.assertEqual(list(scan_overdue(self.today)), [])
+
+class TestBookRating(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestBookRating, self).setUp()
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        self.books = [Book.create(isbn=str(i), title="Book %d" % i,
+                                  author_id=author, publisher_id=publisher,
+                                  amount_of_pages=300, book_print=1,
+                                  edition=1, summary="", language="English",
+                                  published_at="2001-02-03",
+                                  book_type="paperback")
+                      for i in range(3)]
+        self.customer = Customer.create(email="a@b.c", password="x",
+                                        first_name="Jan", surname="Smit")
+        self.epic = Genre.create(genre="epic")
+
+    def summary(self, book):
+        return BookRating.get(BookRating.book_id == book.id)
+
+    def review(self, book, rating):
+        return Review.add_review(self.customer.id, book.id, "text", rating)
+
+    def test_add_review_updates_summary(self):
+        self.review(self.books[0], 4)
+        self.review(self.books[0], 5)
+        summary = self.summary(self.books[0])
+        self.assertEqual((summary.count, summary.total), (2, 9))
+        self.assertEqual((summary.stars_4, summary.stars_5), (1, 1))
+        self.assertEqual(summary.average, 4.5)
+
+    def test_add_review_rating_out_of_range(self):
+        self.assertTrue(self.review(self.books[0], 6) is None)
+        self.assertEqual(BookRating.select().count(), 0)
+
+    def test_update_and_delete_review(self):
+        review = self.review(self.books[0], 1)
+        self.review(self.books[0], 5)
+        Review.update_selected(review.id, rating=3)
+        summary = self.summary(self.books[0])
+        self.assertEqual((summary.stars_1, summary.stars_3), (0, 1))
+        self.assertEqual(summary.average, 4.0)
+        self.assertTrue(Review.delete_selected(review.id))
+        self.assertEqual(self.summary(self.books[0]).average, 5.0)
+        self.assertFalse(Review.delete_selected(review.id))
+
+    def test_top_rated(self):
+        BookGenre.create(book_id=self.books[0], genre_id=self.epic)
+        BookGenre.create(book_id=self.books[1], genre_id=self.epic)
+        self.review(self.books[0], 3)
+        self.review(self.books[1], 4)
+        self.review(self.books[2], 5)
+        self.assertEqual([b.id for b in BookRating.top_rated(limit=2)],
+                         [self.books[2].id, self.books[1].id])
+        top = BookRating.top_rated(genre="epic")
+        self.assertEqual([b.id for b in top],
+                         [self.books[1].id, self.books[0].id])
+        self.assertEqual(top[0].average, 4.0)
+
+    def test_genre_link_copies_average(self):
+        self.review(self.books[0], 4)
+        link = BookGenre.create(book_id=self.books[0], genre_id=self.epic)
+        self.assertEqual(link.average, 4.0)
+
+    def test_rebuild_repairs_drift(self):
+        BookGenre.create(book_id=self.books[0], genre_id=self.epic)
+        self.review(self.books[0], 2)
+        self.review(self.books[0], 4)
+        BookRating.update(count=10, average=1.0).execute()
+        BookRating.rebuild(batch_size=1)
+        summary = self.summary(self.books[0])
+        self.assertEqual((summary.count, summary.average), (2, 3.0))
+        self.assertEqual(BookRating.top_rated(genre="epic")[0].average, 3.0)
+
+class TestCatalogue(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestCatalogue, self).setUp()
+        self.queries = []
+        epic = Genre.create(genre="epic")
+        war = Genre.create(genre="war")
+        for i in range(3):
+            author = Author.create(name="Author %d" % i, biography="",
+                                   age=60)
+            publisher = Publisher.create(name="Publisher %d" % i,
+                                         city="London")
+            book = Book.create(isbn=str(i), title="Book %d" % i,
+                               author_id=author, publisher_id=publisher,
+                               amount_of_pages=300, book_print=1, edition=1,
+                               summary="", published_at="2001-02-03",
+                               language="English", book_type="paperback")
+            BookGenre.create(book_id=book, genre_id=epic)
+            if i:
+                BookGenre.create(book_id=book, genre_id=war)
+
+    def count_query(self, sql, params, seconds):
+        self.queries.append(sql)
+
+    def test_catalogue_page_fixed_queries(self):
+        db.add_query_hook(self.count_query)
+        try:
+            page = Book.catalogue_page(page_size=10)
+            rows = [(book.author_id.name, book.publisher_id.name,
+                     book.genres) for book in page]
+        finally:
+            db.remove_query_hook(self.count_query)
+        self.assertEqual(len(self.queries), 2)
+        self.assertEqual(rows[0], ("Author 0", "Publisher 0", ["epic"]))
+        self.assertEqual(rows[2], ("Author 2", "Publisher 2",
+                                   ["epic", "war"]))
+
+    def test_catalogue_page_paginates(self):
+        page = Book.catalogue_page(page_size=2, sort='title')
+        page = Book.catalogue_page(after=page.next_cursor, page_size=2,
+                                   sort='title')
+        self.assertEqual([book.title for book in page], ["Book 2"])
+        self.assertEqual(page.items[0].genres, ["epic", "war"])
+
+class TestCatalogueSnapshot(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestCatalogueSnapshot, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'catalogue.snapshot')
+        self.epic = Genre.create(genre="epic")
+        self.war = Genre.create(genre="war")
+        self.author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        self.books = []
+        for i, title in enumerate(["Odyssey", "Iliad", "Aeneid"]):
+            book = Book.create(isbn=str(i), title=title,
+                               author_id=self.author, publisher_id=publisher,
+                               amount_of_pages=300, book_print=1, edition=1,
+                               summary="", published_at="200%d-01-01" % i,
+                               language="English", book_type="paperback",
+                               amount=2)
+            BookGenre.create(book_id=book, genre_id=self.epic)
+            self.books.append(book.id)
+        snapshot.build(self.path)
+        self.catalogue = snapshot.Catalogue()
+        self.catalogue.load(self.path)
+
+    def tearDown(self):
+        snapshot.catalogue.unload()
+        shutil.rmtree(self.directory)
+        super(TestCatalogueSnapshot, self).tearDown()
+
+    def test_lookups_match_tables(self):
+        book = self.catalogue.book(self.books[1])
+        self.assertEqual((book.title, book.isbn, book.published_at,
+                          book.amount, book.genres),
+                         ("Iliad", "1", "2001-01-01", 2, ["epic"]))
+        self.assertEqual(book.author_id.name, "Homer")
+        self.assertEqual(book.publisher_id.city, "London")
+        self.assertIsNone(book.available)
+        self.assertEqual(self.catalogue.genre(self.war.id).genre, "war")
+        self.assertIsNone(self.catalogue.book(-1))
+
+    def test_pages_match_live_pages(self):
+        for sort in Book.sortable_fields:
+            live = Book.catalogue_page(page_size=2, sort=sort)
+            page = self.catalogue.page('book', page_size=2, sort=sort)
+            self.assertEqual([book.id for book in page],
+                             [book.id for book in live])
+            self.assertEqual(page.next_cursor, live.next_cursor)
+            page = self.catalogue.page('book', after=live.next_cursor,
+                                       page_size=2, sort=sort)
+            live = Book.catalogue_page(after=live.next_cursor,
+                                       page_size=2, sort=sort)
+            self.assertEqual([book.id for book in page],
+                             [book.id for book in live])
+            self.assertEqual(page.prev_cursor, live.prev_cursor)
+        # A cursor of a page sorted on id.
+        self.assertRaises(ValueError, self.catalogue.page, 'book',
+                          after=encode_cursor(1, 1), sort='title')
+        # MySQL hands dates back as dates.
+        cursor = encode_cursor(datetime.date(2001, 1, 1), 0)
+        self.assertEqual(decode_cursor(cursor), (datetime.date(2001, 1, 1), 0))
+        self.assertEqual(
+            [book.id for book in self.catalogue.page(
+                'book', after=cursor, page_size=2, sort='published_at')],
+            [book.id for book in Book.catalogue_page(
+                after=cursor, page_size=2, sort='published_at')])
+
+    def test_catalogue_page_answers_from_snapshot(self):
+        snapshot.catalogue.load(self.path)
+        Book.update(available=1).where(Book.id == self.books[0]).execute()
+        page = Book.catalogue_page(sort='title')
+        self.assertIsInstance(page.items[0], snapshot.BookRecord)
+        self.assertEqual([book.title for book in page],
+                         ["Aeneid", "Iliad", "Odyssey"])
+        self.assertEqual(page.items[2].available, 1)
+
+    def test_refresh_applies_logged_changes(self):
+        changes = snapshot.latest_change()
+        # Lends change the available copies only, which are not logged.
+        Book.update(available=0).where(Book.id == self.books[0]).execute()
+        self.assertEqual(snapshot.latest_change(), changes)
+        Author.update_by_id(self.author.id, dict(name="Vergil"))
+        BookGenre.create(book_id=self.books[2], genre_id=self.war)
+        Book.delete_by_id(self.books[0])
+        self.assertEqual(self.catalogue.book(self.books[0]).title, "Odyssey")
+        self.assertEqual(self.catalogue.refresh(), 3)
+        self.assertIsNone(self.catalogue.book(self.books[0]))
+        book = self.catalogue.book(self.books[2])
+        self.assertEqual(book.author_id.name, "Vergil")
+        self.assertEqual(book.genres, ["epic", "war"])
+        self.assertEqual([b.id for b in self.catalogue.page('book')],
+                         self.books[1:])
+        self.assertEqual(self.catalogue.refresh(), 0)
+
+    def test_rewrite_folds_in_changes(self):
+        Book.update_by_id(self.books[1], dict(title="Ilias"))
+        snapshot.rewrite(self.path)
+        self.catalogue.refresh()
+        self.assertEqual(self.catalogue.change_id, snapshot.latest_change())
+        self.assertEqual(self.catalogue.book(self.books[1]).title, "Ilias")
+        self.assertEqual([b.title for b in
+                          self.catalogue.page('book', sort='title')],
+                         ["Aeneid", "Ilias", "Odyssey"])
+
+
+@unittest.skipIf(recommender is None, "needs requirements-recommend.txt")
+class TestRecommender(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestRecommender, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.state = os.path.join(self.directory, 'recommender.npz')
+        author = Author.create(name="Homer", biography="", age=60)
+        publisher = Publisher.create(name="Penguin", city="London")
+        epic = Genre.create(genre="epic")
+        poetry = Genre.create(genre="poetry")
+        self.books = []
+        for i, genre in enumerate([epic, epic, poetry, poetry, epic]):
+            book = Book.create(isbn=str(i), title="Book %d" % i,
+                               author_id=author, publisher_id=publisher,
+                               amount_of_pages=300, book_print=1, edition=1,
+                               summary="", published_at="2001-02-03",
+                               language="English", book_type="paperback")
+            BookGenre.create(book_id=book, genre_id=genre)
+            self.books.append(book.id)
+        self.customers = [Customer.create(email="%d@b.c" % i, password="x",
+                                          first_name="Jan", surname="Smit")
+                          for i in range(4)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestRecommender, self).tearDown()
+
+    def lend(self, customer, book):
+        Lend.create(book_id=self.books[book],
+                    customer_id=self.customers[customer],
+                    return_date=datetime.date.today())
+
+    def recommended(self, book, k=10):
+        return [self.books.index(b.id) for b in Book.recommend(
+            self.books[book], k)]
+
+    def test_build_ranks_co_lent_books_first(self):
+        for customer in range(3):
+            self.lend(customer, 0)
+            self.lend(customer, 1)
+        self.lend(0, 2)
+        self.lend(3, 3)
+        self.assertEqual(recommender.build(self.state), 5)
+        self.assertEqual(self.recommended(0), [1, 2, 4])
+        self.assertEqual(self.recommended(0, k=1), [1])
+        scores = [b.score for b in Book.recommend(self.books[0])]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        # Never lent, so only books of the same genre.
+        self.assertEqual(self.recommended(4), [0, 1])
+
+    def test_refresh_reads_only_new_lends(self):
+        self.lend(0, 0)
+        self.lend(0, 1)
+        recommender.build(self.state)
+        self.assertNotIn(3, self.recommended(0))
+        self.lend(1, 0)
+        self.lend(1, 3)
+        # Only the books customer 1 lent are recomputed.
+        self.assertEqual(recommender.refresh(self.state), 2)
+        self.assertIn(3, self.recommended(0))
+        self.assertIn(0, self.recommended(3))
+        self.assertEqual(recommender.refresh(self.state), 0)
+
+class TestConditionalGet(DatabaseTestCase):
+
+    # The app closes the connection after every request, which would
+    # end the test transaction.
+    rollback = False
+    cleanup_models = [Publisher]
+
+    def setUp(self):
+        super(TestConditionalGet, self).setUp()
+        from app import app
+        self.client = app.test_client()
+        Publisher.add_publisher("Penguin", "London")
+
+    def test_unchanged_listing_is_not_modified(self):
+        response = self.client.get('/admin/publisher')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.client.get('/admin/publisher',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # Only the table versions are read.
+        self.assertEqual(response.headers['X-Query-Count'], '1')
+
+    def test_write_changes_the_etag(self):
+        etag = self.client.get('/admin/publisher').headers['ETag']
+        Publisher.update_selected(
+            Publisher.get(Publisher.name == "Penguin").id, city="Leiden")
+        response = self.client.get('/admin/publisher',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(b'Leiden', response.data)
+
+    def test_write_of_other_process_changes_the_etag(self):
+        etag = self.client.get('/admin/publisher').headers['ETag']
+        # As from another process, the model cache does not hear of it.
+        db.execute_sql("UPDATE publisher SET city = 'Leiden'")
+        response = self.client.get('/admin/publisher',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Leiden', response.data)
+
+    def test_rendered_page_is_cached(self):
+        first = self.client.get('/admin/publisher?sort=name')
+        second = self.client.get('/admin/publisher?sort=name')
+        self.assertEqual(second.headers['X-Query-Count'], '1')
+        self.assertEqual(first.data, second.data)
+
+class TestBenchmarkSeed(unittest.TestCase):
+
+    def setUp(self):
+        from benchmarks.load import seed
+        self.directory = tempfile.mkdtemp()
+        self.previous = db.obj
+        self.database = RoutingSqliteDatabase(
+            os.path.join(self.directory, 'load.db'))
+        db.initialize(self.database)
+        seed(self.database, 20, 20)
+
+    def tearDown(self):
+        self.database.close_all()
+        db.initialize(self.previous)
+        model_cache.backend.clear()
+        shutil.rmtree(self.directory)
+
+    def test_conditional_pages_of_the_load_test(self):
+        from app import app
+        client = app.test_client()
+        for path in ['/admin/publisher?sort=name', '/catalogue?sort=title']:
+            response = client.get(path)
+            self.assertEqual(response.status_code, 200)
+            response = client.get(path, headers={
+                'If-None-Match': response.headers['ETag']})
+            self.assertEqual(response.status_code, 304)
+
+class TestAuth(DatabaseTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.hasher = auth.PasswordHasher(workers=1, rounds=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.hasher.close()
+
+    def setUp(self):
+        super(TestAuth, self).setUp()
+        self.admin = Administrator.create(
+            email="admin@example.com",
+            password=auth.hash_password("secret", 4))
+        self.auth = auth.Authenticator(Administrator, self.hasher,
+                                       auth.RateLimiter(limit=2))
+
+    def test_authenticate_checks_password(self):
+        admin = self.auth.authenticate("admin@example.com", "secret")
+        self.assertEqual(admin.id, self.admin.id)
+        self.assertIsNone(self.auth.authenticate("admin@example.com",
+                                                 "wrong"))
+        self.assertIsNone(self.auth.authenticate("nobody@example.com",
+                                                 "secret"))
+
+    def test_login_rehashes_other_cost(self):
+        Administrator.update_by_id(self.admin.id, dict(
+            password=auth.hash_password("secret", 5)))
+        self.auth.authenticate("admin@example.com", "secret")
+        hashed = Administrator.get(Administrator.id == self.admin.id).password
+        self.assertTrue(hashed.startswith('$2b$04$'))
+        self.assertIsNotNone(self.auth.authenticate("admin@example.com",
+                                                    "secret"))
+
+    def test_failed_logins_are_limited(self):
+        for _ in range(2):
+            self.auth.authenticate("admin@example.com", "wrong",
+                                   client="10.0.0.1")
+        with self.assertRaises(auth.RateLimited):
+            self.auth.authenticate("admin@example.com", "secret")
+        # The client is limited for other emails too.
+        with self.assertRaises(auth.RateLimited):
+            self.auth.authenticate("other@example.com", "secret",
+                                   client="10.0.0.1")
+
+    def test_email_is_normalized_for_lookup_and_limit(self):
+        admin = self.auth.authenticate(" Admin@Example.com ", "secret")
+        self.assertEqual(admin.id, self.admin.id)
+        for email in ["ADMIN@example.com", "admin@example.com "]:
+            self.auth.authenticate(email, "wrong")
+        with self.assertRaises(auth.RateLimited):
+            self.auth.authenticate("admin@example.com", "secret")
+
+    def test_concurrent_failures_all_count(self):
+        limiter = auth.RateLimiter(limit=1000)
+
+        def fail():
+            for _ in range(200):
+                limiter.failed('email:admin@example.com')
+
+        threads = [threading.Thread(target=fail) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(limiter.attempts('email:admin@example.com'), 1600)
+
+    def test_full_queue_is_busy(self):
+        hasher = auth.PasswordHasher(workers=1, max_pending=1, wait=0,
+                                     rounds=4)
+        try:
+            sleeping = hasher.submit(time.sleep, 0.2)
+            self.assertRaises(auth.Busy, hasher.hash, "secret")
+            sleeping.result()
+            self.assertTrue(hasher.hash("secret").startswith('$2b$04$'))
+        finally:
+            hasher.close()
+
+    def test_session_tokens(self):
+        tokens = auth.SessionTokens('key', max_age=60)
+        token = tokens.issue(self.admin.id)
+        self.assertEqual(tokens.verify(token), self.admin.id)
+        self.assertIsNone(tokens.verify(token + 'x'))
+        self.assertIsNone(auth.SessionTokens('other').verify(token))
+        tokens.revoke(self.admin.id)
+        self.assertIsNone(tokens.verify(token))
+
+    def test_revocation_outlives_the_cache(self):
+        tokens = auth.SessionTokens('key', max_age=60)
+        token = tokens.issue(self.admin.id)
+        tokens.revoke(self.admin.id)
+        backend = model_cache.backend
+        for i in range(backend.max_size + 1):
+            backend.set('filler:%d' % i, i)
+        self.assertIsNone(tokens.verify(token))
+        self.assertGreater(backend.stats()['evictions'], 0)
+
+
+class TestAdminLogin(DatabaseTestCase):
+
+    # The app closes the connection after every request.
+    rollback = False
+    cleanup_models = [Administrator, Publisher]
+
+    def setUp(self):
+        super(TestAdminLogin, self).setUp()
+        from app import app
+        app.config['ADMIN_LOGIN_REQUIRED'] = True
+        self.app = app
+        self.client = app.test_client()
+        self.hasher = auth.PasswordHasher(workers=1, rounds=4)
+        auth.admin_auth.hasher = self.hasher
+        Administrator.create(email="admin@example.com",
+                             password=auth.hash_password("secret", 4))
+        Publisher.add_publisher("Penguin", "London")
+
+    def tearDown(self):
+        self.app.config['ADMIN_LOGIN_REQUIRED'] = False
+        auth.admin_auth.hasher = None
+        self.hasher.close()
+        super(TestAdminLogin, self).tearDown()
+
+    def login(self, password):
+        return self.client.post('/admin/login?next=/admin/publisher',
+                                data=dict(email="admin@example.com",
+                                          password=password))
+
+    def test_admin_pages_need_login(self):
+        response = self.client.get('/admin/publisher')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/admin/login?next=', response.headers['Location'])
+
+    def test_logged_in_requests_skip_the_password(self):
+        response = self.login("secret")
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].endswith(
+            '/admin/publisher'))
+        etag = self.client.get('/admin/publisher').headers['ETag']
+        response = self.client.get('/admin/publisher',
+                                   headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # The table versions, no query for the login.
+        self.assertEqual(response.headers['X-Query-Count'], '1')
+        self.client.get('/admin/logout')
+        self.assertEqual(self.client.get('/admin/publisher').status_code,
+                         302)
+
+    def test_wrong_password_is_unauthorized(self):
+        self.assertEqual(self.login("wrong").status_code, 401)
+
+    def test_logout_revokes_the_token(self):
+        from app import admin_sessions
+        self.login("secret")
+        with self.client.session_transaction() as sess:
+            token = sess['admin']
+        self.assertIsNotNone(admin_sessions.verify(token))
+        self.client.get('/admin/logout')
+        self.assertIsNone(admin_sessions.verify(token))
+        with self.client.session_transaction() as sess:
+            sess['admin'] = token
+        self.assertEqual(self.client.get('/admin/publisher').status_code,
+                         302)
+
+    def test_only_local_next_urls(self):
+        from app import _local_url
+        self.assertEqual(_local_url('/admin/publisher?sort=name'),
+                         '/admin/publisher?sort=name')
+        for url in ['//evil.com', '/\\evil.com', '/\tevil.com',
+                    'http://evil.com', '', None]:
+            self.assertIsNone(_local_url(url))
+
+
+class TestReplicaRouting(unittest.TestCase):
+
+    def setUp(self):
+        # Copies of one schema, every file gets a publisher named after
+        # it so the tests can tell which database answered.
+        self.directory = tempfile.mkdtemp()
+        template = build_template(self.directory)
+        self.paths = {}
+        for name in ['primary', 'replica1', 'replica2']:
+            path = os.path.join(self.directory, name + '.db')
+            shutil.copyfile(template, path)
+            database = SqliteDatabase(path)
+            with Using(database, [Publisher]):
+                Publisher.create(name=name, city="London")
+            if not database.is_closed():
+                database.close()
+            self.paths[name] = path
+        self.database = RoutingSqliteDatabase(self.paths['primary'],
+                                              retry_interval=0)
+        self.using = Using(self.database, MODELS, with_transaction=False)
+        self.using.__enter__()
+
+    def tearDown(self):
+        self.using.__exit__(None, None, None)
+        self.database.close()
+        shutil.rmtree(self.directory)
+
+    def names(self):
+        return [p.name for p in Publisher.select().order_by(Publisher.id)]
+
+    def test_without_replicas_reads_from_primary(self):
+        self.assertEqual(self.names(), ['primary'])
+
+    def test_reads_stick_to_one_replica_per_session(self):
+        self.database.add_replica(database=self.paths['replica1'])
+        self.database.add_replica(database=self.paths['replica2'])
+        self.assertEqual(self.names(), ['replica1'])
+        self.assertEqual(self.names(), ['replica1'])
+        self.database.close()
+        self.assertEqual(self.names(), ['replica2'])
+
+    def test_reads_own_writes(self):
+        self.database.add_replica(database=self.paths['replica1'])
+        Publisher.update_selected(1, city="Leiden")
+        self.assertTrue(self.database.has_written())
+        self.assertEqual(self.names(), ['primary'])
+        self.database.close()
+        self.assertFalse(self.database.has_written())
+        self.assertEqual(self.names(), ['replica1'])
+
+    def test_transactions_and_overrides_use_primary(self):
+        self.database.add_replica(database=self.paths['replica1'])
+        with self.database.transaction():
+            self.assertEqual(self.names(), ['primary'])
+        with self.database.primary():
+            self.assertEqual(self.names(), ['primary'])
+        self.assertEqual(self.names(), ['replica1'])
+        self.database.force_primary()
+        self.assertEqual(self.names(), ['primary'])
+        self.assertFalse(self.database.has_written())
+
+    def test_reading_from_names_the_replica(self):
+        replica = self.database.add_replica(database=self.paths['replica1'])
+        self.assertIsNone(self.database.reading_from())
+        self.names()
+        self.assertIs(self.database.reading_from().database, replica)
+        with self.database.primary():
+            self.assertIsNone(self.database.reading_from())
+        Publisher.update_selected(1, city="Leiden")
+        self.assertIsNone(self.database.reading_from())
+
+    def test_session_spans_threads(self):
+        self.database.add_replica(database=self.paths['replica1'])
+        self.database.add_replica(database=self.paths['replica2'])
+        session = RoutingSession()
+        names = []
+
+        def read():
+            with self.database.session(session):
+                names.append(self.names())
+
+        for _ in range(2):
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+        self.assertEqual(names, [['replica1'], ['replica1']])
+        self.assertTrue(self.database.is_closed())
+        with self.database.session(session):
+            Publisher.update_selected(1, city="Leiden")
+        self.assertTrue(session.wrote)
+        self.assertIsNone(session.reading_from())
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        self.assertEqual(names[-1], ['primary'])
+
+    def test_failover_and_recovery(self):
+        broken = os.path.join(self.directory, 'missing', 'replica.db')
+        replica = self.database.add_replica(database=broken)
+        with self.assertLogs('routing', 'WARNING'):
+            self.assertEqual(self.names(), ['primary'])
+        self.assertFalse(self.database.replicas[0].healthy)
+        self.assertEqual(self.database.check_replicas(), 0)
+        replica.init(self.paths['replica1'])
+        self.database.close()
+        self.assertEqual(self.names(), ['replica1'])
+        self.assertTrue(self.database.replicas[0].healthy)
+
+@unittest.skipIf(async_app is None, "needs requirements-async.txt")
+class TestAsyncApp(unittest.TestCase):
+
+    def setUp(self):
+        self.publisher = Publisher.add_publisher("Penguin", "London")
+        db.close()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        async def start():
+            client = TestClient(TestServer(async_app.create_app(workers=2)))
+            await client.start_server()
+            return client
+        self.client = self.loop.run_until_complete(start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.client.close())
+        self.loop.close()
+        Publisher.delete().execute()
+        for model in MODELS:
+            model_cache.invalidate(model)
+        db.close()
+
+    def request(self, method, path, **kwargs):
+        async def fetch():
+            response = await self.client.request(
+                method, path, allow_redirects=False, **kwargs)
+            response.body = await response.text()
+            return response
+        return self.loop.run_until_complete(fetch())
+
+    def test_unchanged_page_is_not_modified(self):
+        response = self.request('GET', '/admin/publisher')
+        self.assertEqual(response.status, 200)
+        etag = response.headers['ETag']
+        response = self.request('GET', '/admin/publisher',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+        Publisher.update_selected(self.publisher.id, city="Leiden")
+        db.close()
+        response = self.request('GET', '/admin/publisher',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertIn('Leiden', response.body)
+
+    def test_write_sends_reads_to_the_primary(self):
+        response = self.request(
+            'POST', '/admin/publisher/update/%d' % self.publisher.id,
+            data=dict(name="Penguin", city="Leiden"))
+        self.assertEqual(response.status, 302)
+        self.assertIn(async_app.PRIMARY_COOKIE, response.cookies)
+        response = self.request('GET', '/admin/publisher')
+        self.assertNotIn(async_app.PRIMARY_COOKIE, response.cookies)
+
+    def test_routes_of_app(self):
+        self.assertEqual(self.request('GET', '/admin/lending').status, 200)
+        response = self.request('GET', '/admin/export/lends.csv')
+        self.assertEqual(response.status, 200)
+        self.assertTrue(response.body.startswith('id,book_id,isbn'))
+        self.assertEqual(
+            self.request('GET', '/admin/export/lends.xls').status, 404)
+        response = self.request('GET', '/metrics')
+        self.assertIn('http_request_duration_seconds_count'
+                      '{route="view_lending"} 1', response.body)
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.names = sorted(name[:-3] for name in os.listdir(MIGRATIONS_DIR)
+                            if MIGRATION_FILE.match(name))
+        for name in self.names:
+            shutil.copy(os.path.join(MIGRATIONS_DIR, name + '.py'),
+                        self.directory)
+        self.path = os.path.join(self.directory, 'migrate.db')
+        self.database = SqliteDatabase(self.path)
+        self.runner = MigrationRunner(self.database, self.directory,
+                                      batch_size=2)
+        self.migrator = Migrator(self.database, batch_size=2)
+        self.using = Using(self.database, MODELS, with_transaction=False)
+        self.using.__enter__()
+
+    def tearDown(self):
+        self.using.__exit__(None, None, None)
+        if not self.database.is_closed():
+            self.database.close()
+        shutil.rmtree(self.directory)
+
+    def add_books(self, amount):
+        author = Author.create(name="Author", biography="", age=60)
+        publisher = Publisher.create(name="Publisher", city="London")
+        for i in range(amount):
+            Book.create(isbn=str(i), title="Book %d" % i, author_id=author,
+                        publisher_id=publisher, amount_of_pages=300,
+                        book_print=1, edition=1, summary="",
+                        published_at="2001-02-03", language="English",
+                        book_type="paperback", amount=i + 1)
+
+    def test_upgrade_applies_once(self):
+        self.assertEqual(self.runner.upgrade(), self.names)
+        self.assertEqual(self.runner.upgrade(), [])
+        self.assertEqual(self.runner.applied(), self.names)
+        self.assertEqual(diff(self.database), [])
+
+    def test_initial_schema_is_fixed(self):
+        self.runner.upgrade('0001_initial')
+        tables = self.database.get_tables()
+        self.assertIn('book', tables)
+        self.assertNotIn('hold', tables)
+        self.assertNotIn('lent_at', self.migrator.columns('lend'))
+
+    def test_baseline_database_upgrades(self):
+        # Rows as the old refresh functions left them, before migrations.
+        self.runner.upgrade('0001_initial')
+        for sql in [
+                "INSERT INTO publisher VALUES (1, 'Penguin', 'London')",
+                "INSERT INTO author VALUES (1, 'Homer', '', 60)",
+                "INSERT INTO book VALUES (1, '1', 'Iliad', 1, 1, 300, 1, 1, "
+                "'war', '2001-02-03', 'English', 'paperback', 3)",
+                "INSERT INTO genre VALUES (1, 'epic')",
+                "INSERT INTO bookgenre VALUES (1, 1, 1)",
+                "INSERT INTO customer VALUES (1, 'a@b.c', 'x', 'Jan', "
+                "'Smit')",
+                "INSERT INTO lend VALUES (1, 1, 1, '2017-01-21', "
+                "'2017-01-20')",
+                "INSERT INTO review VALUES (1, 1, 1, 'Good', '2017-01-01', "
+                "4)",
+                "INSERT INTO review VALUES (2, 1, 1, 'Fine', '2017-01-02', "
+                "3)"]:
+            self.database.execute_sql(sql)
+        self.runner.upgrade()
+        self.assertEqual(diff(self.database), [])
+        self.assertEqual(Book.get(Book.id == 1).available, 3)
+        rating = BookRating.get(BookRating.book_id == 1)
+        self.assertEqual((rating.count, rating.stars_4, rating.average),
+                         (2, 1, 3.5))
+        self.assertEqual(BookGenre.get(BookGenre.id == 1).average, 3.5)
+        lend = Lend.checkout(1, 1, datetime.date(2017, 2, 1))
+        self.assertEqual(Book.get(Book.id == 1).available, 2)
+        self.assertTrue(Lend.return_book(lend.id))
+        self.assertEqual(Book.get(Book.id == 1).available, 3)
+
+    def test_diff_and_make_round_trip(self):
+        self.runner.upgrade()
+        self.add_books(5)
+        self.migrator.drop_index('book', 'book_title_id')
+        self.migrator.drop_column('book', 'available')
+        changes = [repr(change) for change in diff(self.database)]
+        self.assertEqual(changes,
+                         ["migrator.add_column(Book, 'available')",
+                          "migrator.add_index(Book, ['title', 'id'])"])
+        self.runner.make('book_available', diff(self.database))
+        name = '%04d_book_available' % (len(self.names) + 1)
+        self.assertEqual(self.runner.pending(), [name])
+        self.assertEqual(self.runner.upgrade(), [name])
+        self.assertEqual(diff(self.database), [])
+        self.assertEqual(Book.select().count(), 5)
+
+    def test_add_column_backfills_existing_rows(self):
+        self.runner.upgrade()
+        self.add_books(5)
+        self.migrator.drop_column('book', 'available')
+        self.migrator.add_column(Book, 'available', Book.amount)
+        self.assertEqual([(b.amount, b.available) for b in Book.select()],
+                         [(i, i) for i in range(1, 6)])
+        column = [c for c in self.database.get_columns('book')
+                  if c.name == 'available'][0]
+        self.assertFalse(column.null)
+
+    def test_add_column_without_value_raises(self):
+        self.runner.upgrade()
+        self.migrator.drop_column('book', 'summary')
+        self.assertRaises(ValueError, self.migrator.add_column, Book,
+                          'summary')
+        self.migrator.add_column(Book, 'summary', '')
+        self.assertEqual(diff(self.database), [])
+
+    def test_backfill_in_batches(self):
+        self.runner.upgrade()
+        self.add_books(5)
+        updated = self.migrator.backfill(Book, dict(available=0),
+                                         Book.amount > 2)
+        self.assertEqual(updated, 3)
+        self.assertEqual(Book.select().where(Book.available == 0).count(),
+                         3)
+
+    def test_upgrade_to_unknown_migration_raises(self):
+        self.assertRaises(ValueError, self.runner.upgrade, '0099_missing')
+
+class TestQueryProfile(DatabaseTestCase):
+
+    def setUp(self):
+        super(TestQueryProfile, self).setUp()
+        for i in range(3):
+            Publisher.create(name="Publisher %d" % i, city="London")
+
+    def tearDown(self):
+        db.stop_profile()
+        super(TestQueryProfile, self).tearDown()
+
+    def test_profile_counts_queries_and_rows(self):
+        profile = db.start_profile()
+        publishers = list(Publisher.select())
+        Publisher.select().where(Publisher.name == "Publisher 1").get()
+        self.assertIs(db.stop_profile(), profile)
+        self.assertEqual(len(publishers), 3)
+        self.assertEqual(profile.queries, 2)
+        self.assertEqual(profile.rows, 4)
+        self.assertGreater(profile.seconds, 0)
+        seconds, sql, params = profile.slowest
+        self.assertTrue(sql.startswith('SELECT'))
+
+    def test_no_profile_outside_start_and_stop(self):
+        list(Publisher.select())
+        self.assertIsNone(db.stop_profile())
+
+    def test_profile_is_per_thread(self):
+        profile = db.start_profile()
+        thread = threading.Thread(target=db.stop_profile)
+        thread.start()
+        thread.join()
+        Publisher.select().count()
+        # The other thread stopped a profile of its own, not this one.
+        self.assertIs(db.stop_profile(), profile)
+        self.assertEqual(profile.queries, 1)
+
+    def test_slow_query_log(self):
+        logger = logging.getLogger('test_slow_queries')
+        hook = SlowQueryLog(0.5, logger)
+        with self.assertLogs(logger, 'WARNING') as logs:
+            hook('SELECT 1', (), 0.7)
+            hook('SELECT 2', (), 0.1)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('SELECT 1', logs.output[0])
+
+class TestRouteMetrics(unittest.TestCase):
+
+    def test_histograms_are_cumulative(self):
+        metrics = RouteMetrics(buckets=(0.1, 1.0))
+        metrics.observe('view_catalogue', 0.05)
+        metrics.observe('view_catalogue', 0.5)
+        metrics.observe('view_catalogue', 5)
+        lines = metrics.render().splitlines()
+        self.assertIn('http_request_duration_seconds_bucket'
+                      '{route="view_catalogue",le="0.1"} 1', lines)
+        self.assertIn('http_request_duration_seconds_bucket'
+                      '{route="view_catalogue",le="1.0"} 2', lines)
+        self.assertIn('http_request_duration_seconds_bucket'
+                      '{route="view_catalogue",le="+Inf"} 3', lines)
+        self.assertIn('http_request_duration_seconds_count'
+                      '{route="view_catalogue"} 3', lines)
+
+    def test_database_figures_only_for_profiled_requests(self):
+        metrics = RouteMetrics()
+        profile = QueryProfile()
+        profile.record('SELECT 1', (), 0.002)
+        profile.rows = 7
+        metrics.observe('view_publishers', 0.01, profile)
+        metrics.observe('view_publishers', 0.01)
+        lines = metrics.render().splitlines()
+        self.assertIn('db_queries_total{route="view_publishers"} 1', lines)
+        self.assertIn('db_rows_total{route="view_publishers"} 7', lines)
+        self.assertIn('db_request_duration_seconds_count'
+                      '{route="view_publishers"} 1', lines)
+
 if __name__ == '__main__':
-    db.init(host=os.getenv('DB_HOST', 'localhost'),
-            user='unittest',
-            password='test_db',
-            database='test_db',
-            charset='utf8')
-    unittest.main()
+    # "python unittests.py --workers 4" runs the test cases in parallel,
+    # other arguments go to unittest as usual.
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--workers', type=int, default=1)
+    args, rest = parser.parse_known_args()
+    if args.workers > 1:
+        sys.exit(run_parallel('unittests', args.workers, rest))
+    use_test_database()
+    unittest.main(argv=sys.argv[:1] + rest)
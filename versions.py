@@ -0,0 +1,117 @@
+"""Versions of tables kept in the database, for the ETags of pages.
+
+Triggers count every insert, update and delete of a versioned table in
+the tableversion table, in the transaction of the write. Every process
+therefore sees the same versions, including the writes of other
+workers and of cron jobs, and a replica has the versions of the rows it
+has. The version tokens of the model cache only change by the
+invalidate() calls of the process itself unless its backend is shared.
+
+A version starts from the time its row was made, so a table whose row
+was made again never repeats a version a client may still have. On
+MySQL the counter row of a table is locked by a write until its commit,
+which makes concurrent writes to one table wait for each other.
+"""
+import calendar
+import datetime
+import hashlib
+import time
+
+from models import *
+
+# Tables the pages of app.py are built from. The lending dashboard takes
+# the version of the watermarks, which the rollups move in the
+# transactions that write them, instead of counting every rollup row.
+VERSIONED_MODELS = [Publisher, Author, Book, Genre, BookGenre, Watermark]
+
+_SQLITE_TRIGGERS = [
+    (suffix, """CREATE TRIGGER IF NOT EXISTS {name} AFTER %s ON {table}
+    BEGIN
+        UPDATE {versions} SET version = version + 1,
+            changed_at = CURRENT_TIMESTAMP
+        WHERE name = '{table}';
+    END""" % event)
+    for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'),
+                          ('ad', 'DELETE'))
+]
+
+_MYSQL_TRIGGERS = [
+    (suffix, """CREATE TRIGGER `{name}` AFTER %s ON `{table}`
+    FOR EACH ROW
+        UPDATE `{versions}` SET version = version + 1,
+            changed_at = UTC_TIMESTAMP()
+        WHERE name = '{table}'""" % event)
+    for suffix, event in (('ai', 'INSERT'), ('au', 'UPDATE'),
+                          ('ad', 'DELETE'))
+]
+
+
+def create_version_log(database=None):
+    """Create the version rows and the triggers counting the writes, safe
+    to call more than once. Does nothing while the tableversion table is
+    missing.
+
+    database - defaults to the database of the TableVersion model
+    """
+    database = database or TableVersion._meta.database
+    database = getattr(database, 'obj', database)
+    versions = TableVersion._meta.db_table
+    if versions not in database.get_tables():
+        return
+    mysql = isinstance(database, MySQLDatabase)
+    existing = set()
+    if mysql:
+        existing = set(row[0] for row in database.execute_sql(
+            'SELECT trigger_name FROM information_schema.triggers '
+            'WHERE trigger_schema = DATABASE()'))
+    names = set(row[0] for row in database.execute_sql(
+        'SELECT name FROM %s' % versions))
+    insert = 'INSERT INTO %s (name, version, changed_at) VALUES (%s)' % (
+        versions, ', '.join([database.interpolation] * 3))
+    for model in VERSIONED_MODELS:
+        if model._meta.db_table not in names:
+            database.execute_sql(insert, (
+                model._meta.db_table, int(time.time() * 1000),
+                datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')))
+    for model in VERSIONED_MODELS:
+        values = dict(table=model._meta.db_table, versions=versions)
+        for suffix, statement in (_MYSQL_TRIGGERS if mysql
+                                  else _SQLITE_TRIGGERS):
+            values['name'] = '%s_version_%s' % (values['table'], suffix)
+            if values['name'] not in existing:
+                database.execute_sql(statement.format(**values))
+
+
+def read_versions(models):
+    """Return the combined version of the tables of several models.
+
+    Read from the database the rows of the request are read from, a
+    replica gives the versions of the rows it has.
+
+    return - (tag, timestamp) where tag changes on every write to one
+        of the tables and timestamp is the start of the second of the
+        last write
+    raises - ValueError when a table has no version row
+    """
+    tables = [model._meta.db_table for model in models]
+    rows = dict((name, (version, changed_at)) for name, version, changed_at
+                in TableVersion.select(TableVersion.name,
+                                       TableVersion.version,
+                                       TableVersion.changed_at)
+                .where(TableVersion.name << tables)
+                .tuples())
+    missing = [table for table in tables if table not in rows]
+    if missing:
+        raise ValueError("Tables without a version: %s, run the "
+                         "migrations" % ', '.join(missing))
+    tokens = ['%s:%s' % (table, rows[table][0]) for table in tables]
+    tag = hashlib.sha1(' '.join(tokens).encode('ascii')).hexdigest()
+    changed_at = max(_as_datetime(rows[table][1]) for table in tables)
+    return tag[:20], calendar.timegm(changed_at.utctimetuple())
+
+
+def _as_datetime(value):
+    # The triggers of SQLite write the time as text without fractions.
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')